@@ -0,0 +1,165 @@
+"""集計バックエンドのベンチマーク.
+
+指定した数のメッセージとリアクションを持つデータベースを作成し、
+leaderboard/teamの集計(reports.aggregate)をSQL(日毎の集計テーブル)と
+NumPy(--backend numpy)のそれぞれで行って所要時間を比較します。
+両者の集計結果が一致することも確認します。
+全期間の週/月毎の時系列を ``leaderboard --bucket`` の1プロセスで集計する場合と、
+期間毎にleaderboardを起動する場合の所要時間も比較します。
+
+    $ python benchmarks/bench_aggregate.py --messages 10000000
+    $ python benchmarks/bench_aggregate.py --db bench.sqlite  # 作成済みのDBを再利用
+"""
+from argparse import ArgumentParser
+from datetime import datetime, timedelta
+import os
+import sys
+import tempfile
+import time
+from typing import Any, Dict, Iterator, List, Tuple
+
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+from slack_message_analysis import models  # noqa: E402
+from slack_message_analysis.models import (  # noqa: E402
+    backfill_rollups, init_db, transaction, upsert, Message, Reaction)
+from slack_message_analysis.reports import (  # noqa: E402
+    aggregate, bucket_ranges, Ranking, Totals)
+from harness import run_command  # noqa: E402
+from synth import BASE_TS, REACTIONS  # noqa: E402
+
+SOURCES = ['user_posts', 'channel_posts', 'reaction_users', 'reactions']
+
+
+def write_db(path: str, messages: int, users: int, channels: int,
+             days: int, seed: int = 0) -> None:
+    """集計に必要な列のみを持つメッセージとリアクションを書き込みます."""
+    models._session = None
+    init_db(path)
+    rnd = np.random.default_rng(seed)
+    with transaction() as s:
+        for start in range(0, messages, 1000000):
+            n = min(1000000, messages - start)
+            ts = BASE_TS + (np.arange(start, start + n) + 0.5) * (
+                days * 86400 / messages)
+            user = rnd.integers(0, users, n)
+            channel = rnd.integers(0, channels, n)
+            # 2%は集計対象外のsubtype
+            subtype = np.where(rnd.random(n) < 0.02, 'bot_message', '')
+            upsert(s, Message.__table__, _messages(ts, user, channel, subtype))
+            upsert(s, Reaction.__table__, _reactions(
+                rnd, ts, channel, subtype, users))
+        backfill_rollups(s)
+
+
+def run(backend: str, since: datetime, until: datetime, n: int
+        ) -> Tuple[float, Dict[str, Any]]:
+    rankings = {source: Ranking(source, n) for source in SOURCES}
+    totals = Totals('user_posts')
+    started = time.perf_counter()
+    with transaction() as s:
+        aggregate(s, since, until, list(rankings.values()) + [totals],
+                  backend)
+    elapsed = time.perf_counter() - started
+    result = {source: r.result() for source, r in rankings.items()}
+    result['team'] = dict(totals.counts)
+    return elapsed, result
+
+
+def main() -> None:
+    parser = ArgumentParser()
+    parser.add_argument('--messages', type=int, default=10000000)
+    parser.add_argument('--users', type=int, default=5000)
+    parser.add_argument('--channels', type=int, default=500)
+    parser.add_argument('--days', type=int, default=365)
+    parser.add_argument('-n', type=int, default=10)
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument(
+        '--db', help='データベースのパス。存在しない場合は作成して残します')
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as d:
+        path = args.db or os.path.join(d, 'bench.sqlite')
+        if not os.path.exists(path):
+            started = time.perf_counter()
+            write_db(path, args.messages, args.users, args.channels,
+                     args.days)
+            print('created {} ({:.1f}s)'.format(
+                path, time.perf_counter() - started), flush=True)
+        models._session = None
+        init_db(path)
+
+        base = datetime.fromtimestamp(BASE_TS)
+        ranges = [
+            ('1 day', base + timedelta(days=10), base + timedelta(days=11)),
+            ('1 month', base, base + timedelta(days=30)),
+            ('all (partial)', base + timedelta(hours=12),
+             base + timedelta(days=args.days, hours=-12)),
+        ]
+        print('{:16s} {:>8s} {:>10s} {:>10s}'.format(
+            'range', 'backend', 'best[s]', 'median[s]'))
+        for label, since, until in ranges:
+            results: List[Dict[str, Any]] = []
+            for backend in ('sql', 'numpy'):
+                times = []
+                for _ in range(args.repeat):
+                    elapsed, result = run(backend, since, until, args.n)
+                    times.append(elapsed)
+                results.append(result)
+                median = sorted(times)[len(times) // 2]
+                print('{:16s} {:>8s} {:10.3f} {:10.3f}'.format(
+                    label, backend, min(times), median), flush=True)
+            if results[0] != results[1]:
+                print('  results differ!', file=sys.stderr)
+                sys.exit(1)
+
+        print('{:16s} {:>9s} {:>10s}'.format(
+            'series', 'processes', 'time[s]'))
+        since, until = base, base + timedelta(days=args.days)
+        for bucket in ('week', 'month'):
+            argv = ['leaderboard', '--db', os.path.abspath(path),
+                    '-n', str(args.n)]
+            elapsed, _ = run_command(argv + [
+                '--since', since.isoformat(), '--until', until.isoformat(),
+                '--bucket', bucket], d)
+            print('{:16s} {:9d} {:10.3f}'.format(
+                '--bucket ' + bucket, 1, elapsed), flush=True)
+            ranges = bucket_ranges(since, until, bucket)
+            elapsed = sum(run_command(argv + [
+                '--since', a.isoformat(), '--until', b.isoformat(),
+                '--dry-run'], d)[0] for a, b in ranges)
+            print('{:16s} {:9d} {:10.3f}'.format(
+                bucket + ' windows', len(ranges), elapsed), flush=True)
+
+
+def _messages(ts: Any, user: Any, channel: Any, subtype: Any
+              ) -> Iterator[Dict[str, Any]]:
+    empty = dict(raw=None, text='', reactions=None, bot_id=None,
+                 thread_ts=None, reply_count=None, cold=None)
+    for t, u, c, st in zip(ts.tolist(), user.tolist(), channel.tolist(),
+                           subtype.tolist()):
+        yield dict(empty, timestamp=t, channel_id='C{:05d}'.format(c),
+                   user_id='U{:05d}'.format(u), subtype=st)
+
+
+def _reactions(rnd: Any, ts: Any, channel: Any, subtype: Any, users: int
+               ) -> Iterator[Dict[str, Any]]:
+    # 1割のメッセージに1〜3人のリアクションを付ける。
+    # 5%は利用者の省略(user_id='')を含む
+    idx = np.flatnonzero(rnd.random(len(ts)) < 0.1)
+    for i in idx.tolist():
+        k = int(rnd.integers(1, 4))
+        name = REACTIONS[int(rnd.integers(0, len(REACTIONS)))]
+        key = dict(timestamp=float(ts[i]),
+                   channel_id='C{:05d}'.format(int(channel[i])),
+                   subtype=str(subtype[i]), reaction=name)
+        for u in sorted(set(rnd.integers(0, users, k).tolist())):
+            yield dict(key, user_id='U{:05d}'.format(u), count=1)
+        if rnd.random() < 0.05:
+            yield dict(key, user_id='', count=int(rnd.integers(1, 5)))
+
+
+if __name__ == '__main__':
+    main()
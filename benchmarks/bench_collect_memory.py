@@ -0,0 +1,63 @@
+"""collectの最大メモリ使用量のベンチマーク.
+
+1つのチャンネルの履歴の長さ(--sizes)毎に合成したワークスペース(synth.py)を
+Slack API代替サーバ(fake_slack.py)から空のデータベースに収集し、collectの
+プロセスの最大RSSを表示します。ユーザ数はメッセージ数に比例させます。
+取得したページ毎にデータベースへ書き込むため、最大RSSは履歴の長さや
+ユーザ数によらずほぼ一定になります (WALモードではSQLiteのページキャッシュ
+(cache_size)の分だけ増えて頭打ちになります)。
+
+    $ python benchmarks/bench_collect_memory.py --sizes 10000,100000,300000
+"""
+from argparse import ArgumentParser
+import os
+import sys
+import tempfile
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+sys.path.insert(0, os.path.dirname(__file__))
+
+from slack_message_analysis.models import (  # noqa: E402
+    DEFAULT_PROFILE, ENGINE_PROFILES)
+from fake_slack import FakeSlack  # noqa: E402
+from harness import run_command  # noqa: E402
+from synth import generate  # noqa: E402
+
+
+def main() -> None:
+    parser = ArgumentParser()
+    parser.add_argument('--sizes', default='10000,100000,300000',
+                        help='チャンネルのメッセージ数 (カンマ区切り)')
+    parser.add_argument('--users-ratio', type=float, default=0.2,
+                        help='メッセージ数に対するユーザ数の割合')
+    parser.add_argument('--concurrency', type=int, default=1)
+    parser.add_argument('--sqlite-profile', choices=ENGINE_PROFILES,
+                        default=DEFAULT_PROFILE)
+    args = parser.parse_args()
+
+    print('{:>9s} {:>9s} {:>7s} {:>8s} {:>9s}'.format(
+        'messages', '+replies', 'users', 'time[s]', 'RSS[MB]'))
+    base = None
+    for size in [int(s) for s in args.sizes.split(',')]:
+        users = max(50, min(99999, int(size * args.users_ratio)))
+        ws = generate(messages=size, channels=1, users=users)
+        fake = FakeSlack(ws).start()
+        try:
+            with tempfile.TemporaryDirectory() as d:
+                elapsed, rss = run_command(
+                    ['collect', '--token', 'dummy',
+                     '--base-url', fake.base_url,
+                     '--db', os.path.join(d, 'collect.sqlite'),
+                     '--since', '2020-09-01', '--until', '2020-10-01',
+                     '--concurrency', str(args.concurrency),
+                     '--sqlite-profile', args.sqlite_profile], d)
+        finally:
+            fake.stop()
+        base = rss if base is None else base
+        print('{:9d} {:9d} {:7d} {:8.1f} {:9.1f} ({:+.1f})'.format(
+            size, ws.count(), users, elapsed, rss / 1024,
+            (rss - base) / 1024), flush=True)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,165 @@
+"""書き込みと集計を並行して実行した場合のベンチマーク.
+
+合成したワークスペース(synth.py)のデータベースに対して、collectと同様に
+メッセージを書き込み続けるプロセス1つと、leaderboard/teamと同様の集計を
+読み取り専用の接続(models.read_transaction)で繰り返すプロセスを同時に実行し、
+SQLiteの接続設定(models.ENGINE_PROFILES)毎に1秒あたりのコミット数・集計数と
+集計の所要時間のパーセンタイル、``database is locked`` で失敗した回数を表示します。
+
+    $ python benchmarks/bench_concurrency.py --messages 100000 --readers 4
+    $ python benchmarks/bench_concurrency.py --backend numpy  # メッセージを走査する集計
+"""
+from argparse import ArgumentParser, Namespace
+from datetime import datetime
+import multiprocessing
+import os
+import shutil
+import sys
+import tempfile
+import time
+from typing import Any, Dict, List
+
+from sqlalchemy.exc import OperationalError
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+from slack_message_analysis import models  # noqa: E402
+from slack_message_analysis.models import (  # noqa: E402
+    init_db, read_transaction, transaction, upsert_messages, vacuum,
+    ENGINE_PROFILES)
+from slack_message_analysis.reports import (  # noqa: E402
+    aggregate, Ranking, SOURCES)
+from synth import generate, write_db, BASE_TS  # noqa: E402
+
+# 書き込むメッセージのts (合成したワークスペースより後の時刻)
+_WRITE_BASE_TS = BASE_TS + 400 * 86400
+
+
+def writer(path: str, profile: str, args: Namespace, start: float,
+           results: Any) -> None:
+    """args.batch件のメッセージを1トランザクションで書き込み続けます."""
+    models._session = None
+    init_db(path, profile=profile)
+    commits = errors = 0
+    latencies: List[float] = []
+    time.sleep(max(0.0, start - time.time()))
+    deadline = start + args.duration
+    i = 0
+    while time.time() < deadline:
+        rows = []
+        for _ in range(args.batch):
+            ts = _WRITE_BASE_TS + i
+            rows.append(dict(
+                timestamp=ts, channel_id='C{:04d}'.format(i % 20),
+                user_id='U{:05d}'.format(i % 50), subtype='',
+                raw={'type': 'message', 'ts': '{:.6f}'.format(ts),
+                     'user': 'U{:05d}'.format(i % 50),
+                     'text': 'ベンチマーク {}'.format(i)}))
+            i += 1
+        started = time.perf_counter()
+        try:
+            with transaction() as s:
+                upsert_messages(s, rows)
+        except OperationalError:
+            errors += 1
+            continue
+        latencies.append(time.perf_counter() - started)
+        commits += 1
+    results.put(('writer', commits, errors, latencies))
+
+
+def reader(path: str, profile: str, args: Namespace, start: float,
+           results: Any) -> None:
+    """全期間の順位表の集計を繰り返します."""
+    models._session = None
+    init_db(path, profile=profile)
+    since, until = datetime(2000, 1, 1), datetime(2100, 1, 1)
+    reads = errors = 0
+    latencies: List[float] = []
+    time.sleep(max(0.0, start - time.time()))
+    deadline = start + args.duration
+    while time.time() < deadline:
+        started = time.perf_counter()
+        try:
+            with read_transaction() as s:
+                aggregate(s, since, until,
+                          [Ranking(source, 10) for source in SOURCES],
+                          args.backend)
+        except OperationalError:
+            errors += 1
+            continue
+        latencies.append(time.perf_counter() - started)
+        reads += 1
+    results.put(('reader', reads, errors, latencies))
+
+
+def run(path: str, profile: str, args: Namespace) -> Dict[str, Any]:
+    results: Any = multiprocessing.Queue()
+    # 全プロセスの初期化(スキーマの確認等)が終わってから同時に開始する
+    start = time.time() + 2.0
+    procs = [multiprocessing.Process(
+        target=writer, args=(path, profile, args, start, results))]
+    procs += [multiprocessing.Process(
+        target=reader, args=(path, profile, args, start, results))
+        for _ in range(args.readers)]
+    for p in procs:
+        p.start()
+    totals: Dict[str, Any] = {
+        role: dict(count=0, errors=0, latencies=[])
+        for role in ('writer', 'reader')}
+    for _ in procs:
+        role, count, errors, latencies = results.get()
+        totals[role]['count'] += count
+        totals[role]['errors'] += errors
+        totals[role]['latencies'] += latencies
+    for p in procs:
+        p.join()
+    return totals
+
+
+def _percentile(values: List[float], p: float) -> float:
+    if not values:
+        return float('nan')
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * p))]
+
+
+def main() -> None:
+    parser = ArgumentParser()
+    parser.add_argument('--messages', type=int, default=100000)
+    parser.add_argument('--readers', type=int, default=4)
+    parser.add_argument('--duration', type=float, default=10.0)
+    parser.add_argument('--batch', type=int, default=200,
+                        help='1トランザクションで書き込むメッセージ数')
+    parser.add_argument('--backend', choices=['sql', 'numpy'], default='sql')
+    parser.add_argument('--profiles', default=','.join(ENGINE_PROFILES))
+    args = parser.parse_args()
+
+    print('{:9s} {:>9s} {:>8s} {:>8s} {:>9s} {:>8s} {:>8s} {:>8s}'.format(
+        'profile', 'commit/s', 'p95[s]', 'errors', 'read/s', 'p50[s]',
+        'p95[s]', 'errors'))
+    with tempfile.TemporaryDirectory() as d:
+        base = os.path.join(d, 'base.sqlite')
+        write_db(generate(messages=args.messages), base)
+        # WALの内容をデータベースファイルに反映してからコピーする
+        vacuum()
+        for profile in args.profiles.split(','):
+            path = os.path.join(d, '{}.sqlite'.format(profile))
+            shutil.copy(base, path)
+            # 接続設定の変更(journal_mode)を子プロセスの開始前に済ませる
+            models._session = None
+            init_db(path, profile=profile)
+            models._session = None
+            t = run(path, profile, args)
+            w, r = t['writer'], t['reader']
+            print('{:9s} {:9.1f} {:8.3f} {:8d} {:9.1f} {:8.3f} {:8.3f} {:8d}'
+                  .format(profile, w['count'] / args.duration,
+                          _percentile(w['latencies'], 0.95), w['errors'],
+                          r['count'] / args.duration,
+                          _percentile(r['latencies'], 0.5),
+                          _percentile(r['latencies'], 0.95), r['errors']),
+                  flush=True)
+
+
+if __name__ == '__main__':
+    main()
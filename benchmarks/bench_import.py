@@ -0,0 +1,87 @@
+"""CLI起動時のimport時間のベンチマーク.
+
+サブコマンド毎に ``python -X importtime`` で ``<サブコマンド> --help`` を実行し、
+importに要した時間とimportされたモジュール数、重い依存ライブラリが
+importされたかどうかを表示します。dispatch列はそれに加えてサブコマンドを
+実装するモジュールをimportした(サブコマンドの実行開始までの)時間です。
+``--root`` に過去のリビジョンをチェックアウトしたディレクトリを指定すると
+変更前後の比較ができます。
+
+    $ python benchmarks/bench_import.py
+    $ git worktree add /tmp/old <revision>
+    $ python benchmarks/bench_import.py --root /tmp/old
+"""
+from argparse import ArgumentParser
+import os
+import subprocess
+import sys
+from typing import List, Tuple
+
+COMMANDS = ['collect', 'leaderboard', 'team', 'wordcloud', 'export', 'migrate']
+
+# 起動時にimportされないことが望ましいライブラリ
+HEAVY_MODULES = ['slack', 'sqlalchemy', 'fugashi', 'wordcloud', 'numpy']
+
+_SCRIPT = '''
+import sys
+sys.argv[0] = 'slack-message-analysis'
+from slack_message_analysis.cli import main
+try:
+    main()
+except SystemExit:
+    pass
+'''
+_DISPATCH = 'import slack_message_analysis.{}'
+
+
+def measure(root: str, argv: List[str],
+            dispatch: bool = False) -> Tuple[float, List[str]]:
+    """CLIを実行しimport時間(秒)とimportされたモジュール名の配列を返します."""
+    script = _SCRIPT
+    if dispatch:
+        script += _DISPATCH.format(argv[0])
+    env = dict(os.environ, PYTHONPATH=root)
+    r = subprocess.run(
+        [sys.executable, '-X', 'importtime', '-c', script] + argv,
+        cwd=root, env=env, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE,
+        universal_newlines=True)
+    total = 0.0
+    modules = []
+    for line in r.stderr.splitlines():
+        if not line.startswith('import time:') or 'cumulative' in line:
+            continue
+        _, cumulative, name = line[len('import time:'):].split('|')
+        modules.append(name.strip())
+        # インデントの無い行がトップレベルのimport
+        if not name[1:].startswith(' '):
+            total += int(cumulative) / 1e6
+    return total, modules
+
+
+def main() -> None:
+    parser = ArgumentParser()
+    parser.add_argument(
+        '--root', default=os.path.join(os.path.dirname(__file__), '..'))
+    parser.add_argument('--repeat', type=int, default=5)
+    args = parser.parse_args()
+
+    for command in [None] + COMMANDS:
+        argv = ([command] if command else []) + ['--help']
+        times, dispatch_times = [], []
+        for _ in range(args.repeat):
+            elapsed, modules = measure(os.path.abspath(args.root), argv)
+            times.append(elapsed)
+            if command:
+                elapsed, _ = measure(os.path.abspath(args.root), argv, True)
+                dispatch_times.append(elapsed)
+        heavy = [m for m in HEAVY_MODULES if m in modules]
+        print('{:12s} --help {:8.1f}ms {:>5d} modules {:32s} '
+              'dispatch {}'.format(
+                  command or '(none)', min(times) * 1000, len(modules),
+                  ','.join(heavy) or '-',
+                  '{:8.1f}ms'.format(min(dispatch_times) * 1000)
+                  if dispatch_times else '-'))
+
+
+if __name__ == '__main__':
+    main()
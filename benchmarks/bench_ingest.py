@@ -0,0 +1,169 @@
+"""イベントによる取り込み(ingest)のベンチマーク.
+
+合成したワークスペース(synth.py)の投稿、返信、リアクション、編集、削除を
+Events APIのイベントログとして生成し、``ingest --replay`` と同じ処理で空の
+データベースに反映して1秒あたりのイベント数を表示します。
+反映後のmessages/users/channelsが、collectで収集した場合と同じ形式で書き込んだ
+データベース(synth.write_db)と一致することも確認します。
+
+    $ python benchmarks/bench_ingest.py --messages 100000
+    $ python benchmarks/bench_ingest.py --log events.jsonl  # イベントログを残す
+    $ slack-message-analysis ingest --replay events.jsonl
+"""
+from argparse import ArgumentParser
+import json
+import os
+import random
+import sys
+import tempfile
+import time
+from typing import Any, Dict, Iterator, List, Tuple
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+from slack_message_analysis import models  # noqa: E402
+from slack_message_analysis.ingest import EventApplier, ingest  # noqa: E402
+from slack_message_analysis.models import (  # noqa: E402
+    init_db, message_payload, transaction, Channel, Message, User)
+from synth import generate, write_db, Workspace  # noqa: E402
+
+# スレッドの親メッセージの項目のうち返信のイベントから求めるもの
+_THREAD_FIELDS = ('thread_ts', 'reply_count', 'latest_reply')
+# 合成したワークスペースが持たない親メッセージの項目
+_IGNORED_FIELDS = ('reply_users', 'reply_users_count')
+
+
+def events(ws: Workspace, edit_ratio: float = 0.01,
+           delete_ratio: float = 0.01, duplicate_ratio: float = 0.01,
+           seed: int = 0) -> Iterator[Dict[str, Any]]:
+    """ワークスペースを投稿順に再現するevent_callbackを生成します.
+
+    参加しているチャンネルの投稿と返信を時刻順に ``message`` で、リアクションを
+    ``reaction_added`` で送ります。edit_ratioの割合の投稿は仮の本文で投稿して
+    ``message_changed`` で本来の本文に、delete_ratioの割合で後に
+    ``message_deleted`` で削除する余分な投稿を、duplicate_ratioの割合で
+    同じevent_idのイベントの再送を加えます。
+    """
+    rnd = random.Random(seed)
+    n = 0
+
+    def _envelope(event: Dict[str, Any]) -> Dict[str, Any]:
+        nonlocal n
+        n += 1
+        return {'type': 'event_callback', 'event_id': 'Ev{:08d}'.format(n),
+                'event': event}
+
+    for c in ws.channels:
+        yield _envelope({'type': 'channel_created', 'channel': c})
+    for u in ws.users:
+        yield _envelope({'type': 'user_change', 'user': u})
+
+    members = set(c['id'] for c in ws.channels if c['is_member'])
+    posts: List[Tuple[str, Dict[str, Any]]] = []
+    for channel_id, messages in ws.messages.items():
+        posts += [(channel_id, m) for m in messages
+                  if m.get('subtype') != 'thread_broadcast']
+    for (channel_id, _), replies in ws.replies.items():
+        posts += [(channel_id, m) for m in replies]
+    posts.sort(key=lambda p: float(p[1]['ts']))
+
+    for channel_id, m in posts:
+        if channel_id not in members:
+            continue
+        m = {k: v for k, v in m.items() if k != 'reactions'}
+        if m.get('thread_ts') == m['ts']:
+            for k in _THREAD_FIELDS:
+                m.pop(k)
+        edited = rnd.random() < edit_ratio
+        e = _envelope(dict(
+            m, channel=channel_id,
+            text='(編集前) ' + m['text'] if edited else m['text']))
+        yield e
+        if rnd.random() < duplicate_ratio:
+            yield e
+        if edited:
+            yield _envelope({'type': 'message', 'subtype': 'message_changed',
+                             'channel': channel_id, 'message': m})
+        if rnd.random() < delete_ratio:
+            extra = dict(m, ts='{:.6f}'.format(float(m['ts']) + 1e-6),
+                         text='削除される投稿')
+            extra.pop('thread_ts', None)
+            extra.pop('subtype', None)
+            yield _envelope(dict(extra, channel=channel_id))
+            yield _envelope({'type': 'message', 'subtype': 'message_deleted',
+                             'channel': channel_id, 'deleted_ts': extra['ts'],
+                             'previous_message': extra})
+    for channel_id, m in posts:
+        if channel_id not in members:
+            continue
+        for r in m.get('reactions', []):
+            for user_id in r['users']:
+                yield _envelope({
+                    'type': 'reaction_added', 'user': user_id,
+                    'reaction': r['name'],
+                    'item': {'type': 'message', 'channel': channel_id,
+                             'ts': m['ts']}})
+
+
+def snapshot(path: str) -> Dict[str, Any]:
+    """比較用にmessages/users/channelsの内容を読み出します."""
+    models._session = None
+    init_db(path)
+    with transaction() as s:
+        messages = {}
+        for m in s.query(*Message.__table__.columns):
+            payload = message_payload(m)
+            for k in _IGNORED_FIELDS:
+                payload.pop(k, None)
+            messages[m.timestamp, m.channel_id, m.user_id, m.subtype] = (
+                payload)
+        return {
+            'messages': messages,
+            'users': {u.id: (u.name, u.email, u.raw) for u in s.query(User)},
+            'channels': {c.id: (c.name, c.is_member, c.raw)
+                         for c in s.query(Channel)},
+        }
+
+
+def main() -> None:
+    parser = ArgumentParser()
+    parser.add_argument('--messages', type=int, default=100000)
+    parser.add_argument('--batch-size', type=int, default=500)
+    parser.add_argument('--log', help='生成したイベントログの出力先')
+    args = parser.parse_args()
+
+    ws = generate(messages=args.messages)
+    log = list(events(ws))
+    if args.log:
+        with open(args.log, 'w', encoding='utf8') as f:
+            for e in log:
+                f.write(json.dumps(e, ensure_ascii=False) + '\n')
+    with tempfile.TemporaryDirectory() as d:
+        expected = os.path.join(d, 'expected.sqlite')
+        write_db(ws, expected)
+
+        path = os.path.join(d, 'ingest.sqlite')
+        models._session = None
+        init_db(path)
+        applier = EventApplier()
+        started = time.perf_counter()
+        ingest(applier, log, args.batch_size, float('inf'))
+        elapsed = time.perf_counter() - started
+        print('{} events in {:.2f}s ({:.0f} events/s, batch {})'.format(
+            len(log), elapsed, len(log) / elapsed, args.batch_size))
+        print(dict(sorted(applier.counts.items())))
+
+        a, b = snapshot(expected), snapshot(path)
+        for table in a:
+            diff = [k for k in a[table].keys() | b[table].keys()
+                    if a[table].get(k) != b[table].get(k)]
+            if diff:
+                print('{} differ: {}'.format(table, diff[:3]),
+                      file=sys.stderr)
+                sys.exit(1)
+        print('messages/users/channels match collect ({} messages)'.format(
+            len(a['messages'])))
+
+
+if __name__ == '__main__':
+    main()
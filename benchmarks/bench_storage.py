@@ -0,0 +1,75 @@
+"""メッセージの保存形式のベンチマーク.
+
+合成したメッセージ全体をrawに保存した(v5より前の)形式のデータベースを作成し、
+圧縮方式と共有辞書のサイズ毎に ``migrate --compact`` と同じ変換を行って、
+ファイルサイズと全メッセージの走査時間を変換前と比較します。
+
+    $ python benchmarks/bench_storage.py --messages 100000
+"""
+from argparse import ArgumentParser
+import os
+import shutil
+import sys
+import tempfile
+import time
+from typing import List, Tuple
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+from slack_message_analysis import models  # noqa: E402
+from slack_message_analysis.blob import available  # noqa: E402
+from slack_message_analysis.migrate import measure  # noqa: E402
+from slack_message_analysis.models import (  # noqa: E402
+    compact_messages, init_db, set_codec, transaction, upsert, vacuum,
+    Message, HOT_FIELDS)
+from synth import generate, _rows, Workspace  # noqa: E402
+
+# (圧縮方式, 共有辞書のサイズ)
+CONFIGS: List[Tuple[str, int]] = [
+    ('zlib', 0), ('zlib', 4096), ('zstd', 0), ('zstd', 32 * 1024),
+    ('zstd', 110 * 1024)]
+
+
+def write_legacy_db(ws: Workspace, path: str) -> None:
+    """メッセージ全体をrawに保存した形式でメッセージを書き込みます."""
+    models._session = None
+    init_db(path)
+    with transaction() as s:
+        upsert(s, Message.__table__, (
+            dict(row, cold=None, **{name: None for name in HOT_FIELDS})
+            for row in _rows(ws)))
+    vacuum()
+
+
+def main() -> None:
+    parser = ArgumentParser()
+    parser.add_argument('--messages', type=int, default=100000)
+    args = parser.parse_args()
+
+    ws = generate(messages=args.messages)
+    print('{:6s} {:>8s} {:>10s} {:>10s} {:>10s} {:>10s}'.format(
+        'codec', 'dict', 'size[MB]', 'scan[s]', 'decode[s]', 'convert[s]'))
+    with tempfile.TemporaryDirectory() as d:
+        legacy = os.path.join(d, 'legacy.sqlite')
+        write_legacy_db(ws, legacy)
+        print('{:6s} {:>8s} {:10.2f} {:10.3f} {:10.3f}'.format(
+            'raw', '-', *measure()), flush=True)
+        for codec, dict_size in CONFIGS:
+            if not available(codec):
+                continue
+            path = os.path.join(d, '{}-{}.sqlite'.format(codec, dict_size))
+            shutil.copy(legacy, path)
+            models._session = None
+            init_db(path)
+            started = time.perf_counter()
+            with transaction() as s:
+                set_codec(s, codec, dict_size)
+            compact_messages()
+            vacuum()
+            elapsed = time.perf_counter() - started
+            print('{:6s} {:>8d} {:10.2f} {:10.3f} {:10.3f} {:10.2f}'.format(
+                codec, dict_size, *measure(), elapsed), flush=True)
+
+
+if __name__ == '__main__':
+    main()
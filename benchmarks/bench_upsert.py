@@ -0,0 +1,72 @@
+"""メッセージ書き込みのベンチマーク.
+
+合成したメッセージをORM (Session.add) とバルクUPSERT (models.upsert) の
+それぞれで空のSQLiteに書き込み、1秒あたりの書き込み行数を比較します。
+
+    $ python benchmarks/bench_upsert.py --messages 1000000
+"""
+from argparse import ArgumentParser
+import os
+import random
+import sys
+import tempfile
+import time
+from typing import Any, Dict, Iterator
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+from slack_message_analysis import models  # noqa: E402
+from slack_message_analysis.models import (  # noqa: E402
+    init_db, pack_message, transaction, upsert, Message)
+
+
+def synthetic_messages(n: int, channels: int = 100,
+                       users: int = 500) -> Iterator[Dict[str, Any]]:
+    rnd = random.Random(0)
+    base = 1590000000.0
+    for i in range(n):
+        ts = '{:.6f}'.format(base + i * 0.5)
+        user = 'U{:05d}'.format(rnd.randrange(users))
+        raw: Dict[str, Any] = {
+            'type': 'message', 'ts': ts, 'user': user,
+            'text': 'テストメッセージ {} です'.format(i)}
+        if i % 7 == 0:
+            raw['reactions'] = [
+                {'name': 'thumbsup', 'users': [user], 'count': 1}]
+        yield dict(timestamp=float(ts),
+                   channel_id='C{:04d}'.format(rnd.randrange(channels)),
+                   user_id=user, subtype='', raw=raw)
+
+
+def bench_orm(n: int) -> float:
+    t = time.perf_counter()
+    with transaction() as s:
+        for row in synthetic_messages(n):
+            s.add(Message(**pack_message(row)))
+    return time.perf_counter() - t
+
+
+def bench_upsert(n: int) -> float:
+    t = time.perf_counter()
+    with transaction() as s:
+        upsert(s, Message.__table__,
+               (pack_message(row) for row in synthetic_messages(n)))
+    return time.perf_counter() - t
+
+
+def main() -> None:
+    parser = ArgumentParser()
+    parser.add_argument('--messages', type=int, default=1000000)
+    args = parser.parse_args()
+
+    for name, func in (('orm', bench_orm), ('upsert', bench_upsert)):
+        with tempfile.TemporaryDirectory() as d:
+            models._session = None
+            init_db(os.path.join(d, 'bench.sqlite'))
+            elapsed = func(args.messages)
+        print('{:8s} {:>10d} rows {:8.2f}s {:>10.0f} rows/s'.format(
+            name, args.messages, elapsed, args.messages / elapsed))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,255 @@
+"""ベンチマーク用のSlack APIの代替サーバ.
+
+synth.pyで生成したワークスペースを conversations.list/history/replies と
+users.list として配信するローカルHTTPサーバです。カーソルによるページングと、
+一定間隔で ``ratelimited`` エラー(HTTP 429, Retry-After)を返す機能、メソッド毎の
+1分あたりの呼び出し回数の上限を超えた場合に ``ratelimited`` を返す機能と、
+一定間隔でHTTP 503(HTMLの応答)を返す機能を持ちます。
+各サブコマンドの ``--base-url`` にこのサーバのURLを指定して利用します。
+
+    $ python benchmarks/fake_slack.py --port 18765 --messages 10000
+    $ slack-message-analysis collect --token dummy \\
+        --base-url http://127.0.0.1:18765/api/
+"""
+from argparse import ArgumentParser
+from bisect import bisect_left, bisect_right
+from collections import Counter, deque
+import math
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import json
+import os
+import sys
+import threading
+import time
+from typing import Any, Deque, Dict, List, Optional, Tuple
+from urllib.parse import parse_qs, urlparse
+
+sys.path.insert(0, os.path.dirname(__file__))
+
+from synth import generate, Workspace  # noqa: E402
+
+
+class FakeSlack:
+    """Workspaceを配信するSlack APIの代替サーバ.
+
+    Args:
+        ws: 配信するワークスペース
+        port: 待ち受けるポート番号。0の場合は空いているポートを利用する
+        latency: 1リクエストあたりに加える遅延(秒)
+        ratelimit_every: N回のリクエスト毎に1回ratelimitedを返す。0の場合は返さない
+        retry_after: ratelimited応答のRetry-Afterヘッダの秒数
+        budget: メソッド毎の直近1分間の呼び出し回数の上限。超えた場合は
+            上限を下回るまでの秒数をRetry-Afterとしてratelimitedを返す。
+            0の場合は制限しない
+        error_every: N回のリクエスト毎に1回HTTP 503を返す。0の場合は返さない
+    """
+
+    def __init__(self, ws: Workspace, port: int = 0, latency: float = 0.0,
+                 ratelimit_every: int = 0, retry_after: int = 1,
+                 budget: int = 0, error_every: int = 0) -> None:
+        self.ws = ws
+        self.latency = latency
+        self.ratelimit_every = ratelimit_every
+        self.retry_after = retry_after
+        self.budget = budget
+        self.error_every = error_every
+        # メソッド毎のリクエスト数、ratelimitedとHTTP 503を返した回数
+        self.calls = Counter[str]()
+        self.ratelimited = Counter[str]()
+        self.errors = Counter[str]()
+        self._lock = threading.Lock()
+        self._requests = 0
+        # メソッド毎の直近1分間に受け付けたリクエストの時刻
+        self._accepted: Dict[str, Deque[float]] = {}
+        # 期間指定による検索用のチャンネル毎のタイムスタンプ(昇順)とスレッドの親
+        self._timestamps = {
+            channel_id: [float(m['ts']) for m in messages]
+            for channel_id, messages in ws.messages.items()}
+        self._parents = {
+            (channel_id, m['ts']): m
+            for channel_id, messages in ws.messages.items()
+            for m in messages if m.get('thread_ts') == m['ts']}
+        self._server = ThreadingHTTPServer(
+            ('127.0.0.1', port), _handler(self))
+        self._server.daemon_threads = True
+        self._thread: Optional[threading.Thread] = None
+
+    @property
+    def base_url(self) -> str:
+        return 'http://127.0.0.1:{}/api/'.format(self._server.server_port)
+
+    def start(self) -> 'FakeSlack':
+        self._thread = threading.Thread(
+            target=self._server.serve_forever, daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self) -> None:
+        self._server.shutdown()
+        self._server.server_close()
+
+    def serve_forever(self) -> None:
+        self._server.serve_forever()
+
+    def handle(self, method: str, params: Dict[str, str]
+               ) -> Tuple[int, Optional[Dict[str, Any]], Dict[str, str]]:
+        """APIメソッドを処理し(ステータス, 応答, ヘッダ)を返します.
+
+        HTTP 503の場合、応答はNone(本文はHTML)です。
+        """
+        if self.latency:
+            time.sleep(self.latency)
+        with self._lock:
+            self.calls[method] += 1
+            self._requests += 1
+            if self.error_every and self._requests % self.error_every == 0:
+                self.errors[method] += 1
+                return 503, None, {}
+            retry_after = self._throttle(method)
+            if retry_after:
+                self.ratelimited[method] += 1
+                return 429, {'ok': False, 'error': 'ratelimited'}, {
+                    'Retry-After': str(retry_after)}
+        return 200, self._dispatch(method, params), {}
+
+    def _throttle(self, method: str) -> int:
+        # ratelimitedを返す場合はRetry-Afterの秒数を返す
+        if (self.ratelimit_every and
+                self._requests % self.ratelimit_every == 0):
+            return self.retry_after
+        if not self.budget:
+            return 0
+        now = time.monotonic()
+        accepted = self._accepted.setdefault(method, deque())
+        while accepted and accepted[0] <= now - 60:
+            accepted.popleft()
+        if len(accepted) >= self.budget:
+            return max(1, math.ceil(accepted[0] + 60 - now))
+        accepted.append(now)
+        return 0
+
+    def _dispatch(self, method: str, params: Dict[str, str]
+                  ) -> Dict[str, Any]:
+
+        if method == 'conversations.list':
+            return _page(self.ws.channels, params, 'channels')
+        if method == 'users.list':
+            return _page(self.ws.users, params, 'members')
+        if method == 'conversations.history':
+            messages = self.ws.messages.get(params.get('channel', ''))
+            if messages is None:
+                return {'ok': False, 'error': 'channel_not_found'}
+            return self._history(messages, params)
+        if method == 'conversations.replies':
+            key = (params.get('channel', ''), params.get('ts', ''))
+            if key not in self._parents:
+                return {'ok': False, 'error': 'thread_not_found'}
+            return _page([self._parents[key]] + self.ws.replies.get(key, []),
+                         params, 'messages')
+        return {'ok': True}
+
+    def _history(self, messages: List[Dict[str, Any]],
+                 params: Dict[str, str]) -> Dict[str, Any]:
+        # oldest < ts < latest のメッセージを新しい順に返す
+        timestamps = self._timestamps[params['channel']]
+        lo = bisect_right(timestamps, float(params.get('oldest') or 0))
+        hi = bisect_left(timestamps, float(params.get('latest') or 1e12))
+        limit = min(int(params.get('limit') or 100), 1000)
+        start = hi - int(params.get('cursor') or 0)
+        end = max(lo, start - limit)
+        has_more = end > lo
+        return {
+            'ok': True, 'messages': messages[end:start][::-1],
+            'has_more': has_more,
+            'response_metadata': {
+                'next_cursor': str(hi - end) if has_more else ''},
+        }
+
+
+def _page(items: List[Dict[str, Any]], params: Dict[str, str],
+          key: str) -> Dict[str, Any]:
+    limit = min(int(params.get('limit') or 100), 1000)
+    offset = int(params.get('cursor') or 0)
+    ret: Dict[str, Any] = {'ok': True, key: items[offset:offset + limit]}
+    has_more = offset + limit < len(items)
+    ret['has_more'] = has_more
+    ret['response_metadata'] = {
+        'next_cursor': str(offset + limit) if has_more else ''}
+    return ret
+
+
+def _handler(fake: FakeSlack) -> Any:
+    class Handler(BaseHTTPRequestHandler):
+        # クライアントのKeep-Alive接続を受け付ける。ヘッダと本文を別々に
+        # 送信するため、Nagleアルゴリズムによる応答の遅延を避ける
+        protocol_version = 'HTTP/1.1'
+        disable_nagle_algorithm = True
+
+        def log_message(self, *args: Any) -> None:
+            pass
+
+        def do_GET(self) -> None:
+            self._dispatch({})
+
+        def do_POST(self) -> None:
+            n = int(self.headers.get('Content-Length') or 0)
+            body = self.rfile.read(n).decode('utf8')
+            if self.headers.get('Content-Type', '').startswith(
+                    'application/json'):
+                params = {k: str(v) for k, v in json.loads(body).items()}
+            else:
+                params = {k: v[0] for k, v in parse_qs(body).items()}
+            self._dispatch(params)
+
+        def _dispatch(self, params: Dict[str, str]) -> None:
+            u = urlparse(self.path)
+            params.update({k: v[0] for k, v in parse_qs(u.query).items()})
+            status, ret, headers = fake.handle(
+                u.path.rsplit('/', 1)[-1], params)
+            self._send(status, ret, headers)
+
+        def _send(self, status: int, body: Optional[Dict[str, Any]],
+                  headers: Dict[str, str] = {}) -> None:
+            if body is None:
+                b = b'<html><body>Service Unavailable</body></html>'
+                content_type = 'text/html'
+            else:
+                b = json.dumps(body).encode('utf8')
+                content_type = 'application/json'
+            self.send_response(status)
+            self.send_header('Content-Type', content_type)
+            self.send_header('Content-Length', str(len(b)))
+            for k, v in headers.items():
+                self.send_header(k, v)
+            self.end_headers()
+            self.wfile.write(b)
+    return Handler
+
+
+def main() -> None:
+    parser = ArgumentParser()
+    parser.add_argument('--port', type=int, default=18765)
+    parser.add_argument('--messages', type=int, default=10000)
+    parser.add_argument('--channels', type=int, default=20)
+    parser.add_argument('--users', type=int, default=50)
+    parser.add_argument('--latency', type=float, default=0.0)
+    parser.add_argument('--ratelimit-every', type=int, default=0)
+    parser.add_argument('--retry-after', type=int, default=1)
+    parser.add_argument('--budget', type=int, default=0,
+                        help='メソッド毎の1分あたりの呼び出し回数の上限')
+    parser.add_argument('--error-every', type=int, default=0,
+                        help='N回に1回HTTP 503を返す')
+    args = parser.parse_args()
+
+    fake = FakeSlack(
+        generate(messages=args.messages, channels=args.channels,
+                 users=args.users),
+        port=args.port, latency=args.latency,
+        ratelimit_every=args.ratelimit_every, retry_after=args.retry_after,
+        budget=args.budget, error_every=args.error_every)
+    print('Listening on {}'.format(fake.base_url))
+    fake.serve_forever()
+
+
+if __name__ == '__main__':
+    main()
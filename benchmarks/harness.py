@@ -0,0 +1,230 @@
+"""サブコマンドの性能を計測するベンチマークハーネス.
+
+データ量毎に合成ワークスペース(synth.py)を生成し、collectはローカルの
+Slack API代替サーバ(fake_slack.py)に対して、それ以外のサブコマンドは合成した
+データベースに対して実行します。各サブコマンドを別プロセスで複数回実行し、
+スループット(メッセージ数/秒)、所要時間のパーセンタイル、最大RSSを表示します。
+
+    $ python benchmarks/harness.py --sizes 1000,10000,100000 --json result.json
+    $ python benchmarks/harness.py --baseline result.json  # 前回の結果と比較
+
+wordcloudは ``--mecab-dicdir`` を指定した場合のみ計測します。wordcloudは
+形態素解析のキャッシュを削除してから、wordcloud-cachedはキャッシュが
+有効な状態で計測します。
+"""
+from argparse import ArgumentParser, Namespace
+import csv
+import json
+import os
+import sqlite3
+import subprocess
+import sys
+import tempfile
+import time
+from typing import Any, Dict, List, Optional, Tuple
+
+sys.path.insert(0, os.path.dirname(__file__))
+
+from fake_slack import FakeSlack  # noqa: E402
+from synth import generate, write_db, Workspace  # noqa: E402
+
+ROOT = os.path.abspath(os.path.join(os.path.dirname(__file__), '..'))
+# wordcloud-cachedは形態素解析のキャッシュが有効な状態でのwordcloud
+COMMANDS = ['collect', 'leaderboard', 'team', 'report', 'wordcloud',
+            'wordcloud-cached']
+
+# サブコマンドを起動するスクリプト。
+# 既定ではSlackのレート制限(Tier)による待ち時間を計測から除くため制限を緩和する。
+# fork元(ハーネス)のメモリ使用量を含めないよう、終了時にexec後のプロセスの
+# 最大RSS(/proc/self/statusのVmHWM)を{rss_file}に書き出す
+_BOOT = '''
+import atexit
+import sys
+
+def _write_rss():
+    try:
+        with open('/proc/self/status') as f:
+            hwm = [l.split()[1] for l in f if l.startswith('VmHWM:')][0]
+    except (OSError, IndexError):
+        return
+    with open({rss_file!r}, 'w') as f:
+        f.write(hwm)
+
+atexit.register(_write_rss)
+from slack_message_analysis import ratelimit
+if {relax}:
+    ratelimit.TIER_LIMITS.update({{1: 60000, 2: 60000, 3: 60000, 4: 60000}})
+sys.argv[0] = 'slack-message-analysis'
+from slack_message_analysis.cli import main
+main()
+'''
+
+
+def run_command(argv: List[str], cwd: str,
+                relax: bool = True) -> Tuple[float, int]:
+    """サブコマンドを別プロセスで実行し所要時間(秒)と最大RSS(KB)を返します."""
+    env = dict(os.environ, PYTHONPATH=ROOT, TZ='Asia/Tokyo')
+    rss_file = os.path.join(cwd, 'rss.txt')
+    if os.path.exists(rss_file):
+        os.remove(rss_file)
+    boot = _BOOT.format(relax=relax, rss_file=rss_file)
+    started = time.perf_counter()
+    r = subprocess.run(
+        [sys.executable, '-c', boot] + argv, cwd=cwd, env=env,
+        stdout=subprocess.DEVNULL, stderr=subprocess.PIPE)
+    elapsed = time.perf_counter() - started
+    if r.returncode != 0:
+        raise RuntimeError('{} failed:\n{}'.format(
+            ' '.join(argv), r.stderr.decode('utf8', 'replace')[-2000:]))
+    rss = 0
+    if os.path.exists(rss_file):
+        with open(rss_file) as f:
+            rss = int(f.read())
+    return elapsed, rss
+
+
+def percentile(values: List[float], p: float) -> float:
+    """最近傍順位法によるパーセンタイルを返します."""
+    ordered = sorted(values)
+    k = max(0, min(len(ordered) - 1, int(round(p / 100 * len(ordered))) - 1))
+    return ordered[k]
+
+
+def bench_size(size: int, args: Namespace, workdir: str
+               ) -> List[Dict[str, Any]]:
+    """1つのデータ量について全てのサブコマンドを計測します."""
+    ws = generate(messages=size, channels=args.channels, users=args.users)
+    db = os.path.join(workdir, 'bench-{}.sqlite'.format(size))
+    write_db(ws, db)
+    team = os.path.join(workdir, 'team_master.csv')
+    _write_team_master(ws, team)
+
+    period = ['--since', '2020-09-01', '--until', '2020-10-01']
+    analysis = period + ['--db', db, '--dry-run']
+    argvs: Dict[str, Optional[List[str]]] = {
+        'leaderboard': ['leaderboard'] + analysis,
+        'team': ['team', '--team', team] + analysis,
+        'report': ['report', '--team', team] + analysis,
+    }
+    if args.mecab_dicdir:
+        argvs['wordcloud'] = argvs['wordcloud-cached'] = [
+            'wordcloud', '-d', args.mecab_dicdir,
+            '-r', args.mecab_rcfile or os.path.join(
+                args.mecab_dicdir, 'mecabrc'),
+            '--font', args.font, '-j', str(args.jobs)] + analysis
+
+    results = []
+    for command in args.commands:
+        samples: List[Tuple[float, int]] = []
+        for _ in range(args.repeat):
+            if command == 'collect':
+                samples.append(_bench_collect(ws, args, workdir, period))
+                continue
+            argv = argvs.get(command)
+            if argv is None:
+                break
+            if command == 'wordcloud':
+                _drop_token_cache(db)
+            samples.append(run_command(argv, workdir))
+        if not samples:
+            continue
+        times = [t for t, _ in samples]
+        results.append(dict(
+            command=command, size=size, messages=ws.count(),
+            p50=percentile(times, 50), p95=percentile(times, 95),
+            max=max(times),
+            throughput=ws.count() / percentile(times, 50),
+            rss_mb=max(r for _, r in samples) / 1024))
+    return results
+
+
+def main() -> None:
+    parser = ArgumentParser()
+    parser.add_argument(
+        '--sizes', default='1000,10000,100000',
+        help='計測するメッセージ数 (カンマ区切り)')
+    parser.add_argument(
+        '--commands', default=','.join(COMMANDS),
+        type=lambda s: s.split(','),
+        help='計測するサブコマンド (カンマ区切り)')
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--channels', type=int, default=20)
+    parser.add_argument('--users', type=int, default=50)
+    parser.add_argument(
+        '--latency', type=float, default=0.0,
+        help='Slack API代替サーバの1リクエストあたりの遅延(秒)')
+    parser.add_argument(
+        '--ratelimit-every', type=int, default=0,
+        help='Slack API代替サーバがN回に1回ratelimitedを返す')
+    parser.add_argument(
+        '--real-rate-limits', action='store_true',
+        help='collectでSlackのレート制限(Tier)を緩和せずに計測する')
+    parser.add_argument('-d', '--mecab-dicdir')
+    parser.add_argument('-r', '--mecab-rcfile')
+    parser.add_argument('--font', default='meiryo.ttc')
+    parser.add_argument('-j', '--jobs', type=int, default=os.cpu_count() or 1)
+    parser.add_argument('--json', help='計測結果をJSONで保存するパス')
+    parser.add_argument('--baseline', help='比較対象の計測結果(JSON)のパス')
+    args = parser.parse_args()
+
+    baseline: Dict[Tuple[str, int], Dict[str, Any]] = {}
+    if args.baseline:
+        with open(args.baseline, encoding='utf8') as f:
+            baseline = {(r['command'], r['size']): r for r in json.load(f)}
+
+    print('{:16s} {:>8s} {:>9s} {:>9s} {:>9s} {:>12s} {:>8s}'.format(
+        'command', 'size', 'p50[s]', 'p95[s]', 'max[s]', 'msgs/s',
+        'RSS[MB]'))
+    results = []
+    with tempfile.TemporaryDirectory() as workdir:
+        for size in [int(s) for s in args.sizes.split(',')]:
+            for r in bench_size(size, args, workdir):
+                results.append(r)
+                line = '{:16s} {:>8d} {:9.3f} {:9.3f} {:9.3f} {:12.0f} ' \
+                    '{:8.1f}'.format(
+                        r['command'], r['size'], r['p50'], r['p95'],
+                        r['max'], r['throughput'], r['rss_mb'])
+                base = baseline.get((r['command'], r['size']))
+                if base:
+                    line += '  p50 {:+.1f}% RSS {:+.1f}%'.format(
+                        (r['p50'] / base['p50'] - 1) * 100,
+                        (r['rss_mb'] / base['rss_mb'] - 1) * 100)
+                print(line, flush=True)
+
+    if args.json:
+        with open(args.json, 'w', encoding='utf8') as f:
+            json.dump(results, f, indent=2)
+
+
+def _bench_collect(ws: Workspace, args: Namespace, workdir: str,
+                   period: List[str]) -> Tuple[float, int]:
+    fake = FakeSlack(ws, latency=args.latency,
+                     ratelimit_every=args.ratelimit_every).start()
+    db = os.path.join(workdir, 'collect.sqlite')
+    try:
+        if os.path.exists(db):
+            os.remove(db)
+        return run_command(
+            ['collect', '--token', 'dummy', '--base-url', fake.base_url,
+             '--db', db] + period, workdir, relax=not args.real_rate_limits)
+    finally:
+        fake.stop()
+
+
+def _drop_token_cache(db: str) -> None:
+    with sqlite3.connect(db) as conn:
+        for table in ('token_counts', 'token_cache'):
+            conn.execute('DELETE FROM {}'.format(table))
+
+
+def _write_team_master(ws: Workspace, path: str) -> None:
+    with open(path, 'w', newline='', encoding='utf8') as f:
+        w = csv.writer(f)
+        w.writerow(['email', 'team', 'name', 'note'])
+        for i, u in enumerate(ws.users):
+            w.writerow([u['profile']['email'], 'team{}'.format(i % 8),
+                        u['name'], ''])
+
+
+if __name__ == '__main__':
+    main()
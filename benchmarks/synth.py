@@ -0,0 +1,214 @@
+"""ベンチマーク用の合成ワークスペースの生成.
+
+指定した数のチャンネル、ユーザ、メッセージ、スレッド、リアクションを持つ
+ワークスペースを乱数から決定的に生成します。生成したワークスペースは
+fake_slack.pyでSlack APIとして配信するか、write_db()で直接SQLiteに書き込みます。
+
+    $ python benchmarks/synth.py bench.sqlite --messages 100000
+"""
+from argparse import ArgumentParser
+from dataclasses import dataclass, field
+import hashlib
+import os
+import random
+import sys
+from typing import Any, Dict, Iterator, List, Tuple
+import uuid
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+from slack_message_analysis import models  # noqa: E402
+from slack_message_analysis.models import (  # noqa: E402
+    channel_row, init_db, transaction, upsert, upsert_messages, user_row,
+    Channel, User)
+
+# 2020-09-01 00:00 JST
+BASE_TS = 1598886000.0
+
+TEAM_ID = 'T00000001'
+
+REACTIONS = ['+1', 'pray', 'tada', 'eyes', 'smile', 'ok_hand', 'clap', 'bow']
+
+# 日本語の本文を組み立てるための語彙
+_NOUNS = [
+    '今日', '明日', '会議', '資料', '確認', 'リリース', 'テスト', 'サーバ',
+    '障害', '対応', 'レビュー', 'デプロイ', 'データ', '分析', 'ランチ', '東京',
+    '大阪', 'プロジェクト', '予定', '変更', '共有', '設計', '仕様', '性能',
+    'お客様', '見積もり', '議事録', 'チーム', '勉強会', '新機能', 'Python', 'Slack',
+]
+_VERBS = ['確認し', '対応し', '共有し', '修正し', '追加し', '検討し', '実施し',
+          '作成し', '調査し', '更新し']
+_ENDINGS = ['ます', 'ました', 'ています', 'てください', 'ましょう', 'たいです']
+_EXTRAS = ['よろしくお願いします', 'ありがとうございます', '了解です', '承知しました',
+           'お疲れさまです']
+_PARTICLES = ['の', 'を', 'に', 'は', 'が', 'と', 'で']
+
+Key = Tuple[str, str]
+
+
+@dataclass
+class Workspace:
+    """合成したワークスペース.
+
+    messagesはチャンネル毎のconversations.historyに現れるメッセージ
+    (古い順)、repliesは(チャンネルID, thread_ts)毎のスレッドへの返信です。
+    """
+    users: List[Dict[str, Any]] = field(default_factory=list)
+    channels: List[Dict[str, Any]] = field(default_factory=list)
+    messages: Dict[str, List[Dict[str, Any]]] = field(default_factory=dict)
+    replies: Dict[Key, List[Dict[str, Any]]] = field(default_factory=dict)
+
+    def count(self) -> int:
+        """メッセージ(返信を含む)の総数を返します."""
+        return (sum(len(v) for v in self.messages.values()) +
+                sum(len(v) for v in self.replies.values()))
+
+
+def generate(messages: int = 10000, channels: int = 20, users: int = 50,
+             days: int = 30, thread_ratio: float = 0.1, replies: int = 3,
+             reaction_ratio: float = 0.3, bot_ratio: float = 0.02,
+             seed: int = 0) -> Workspace:
+    """ワークスペースを生成します.
+
+    Args:
+        messages: チャンネルに投稿されるメッセージ数 (スレッドへの返信を除く)
+        channels: チャンネル数
+        users: ユーザ数
+        days: メッセージを投稿する期間の日数 (BASE_TSから)
+        thread_ratio: スレッドが付くメッセージの割合
+        replies: スレッド1つあたりの平均返信数
+        reaction_ratio: リアクションが付くメッセージの割合
+        bot_ratio: botによるメッセージの割合
+        seed: 乱数のシード
+    Returns:
+        生成したワークスペース
+    """
+    rnd = random.Random(seed)
+    ws = Workspace()
+    ws.users = [{
+        'id': 'U{:05d}'.format(i), 'name': 'user{}'.format(i),
+        'real_name': 'ユーザ {}'.format(i),
+        'profile': {'display_name': '', 'real_name': 'ユーザ {}'.format(i),
+                    'email': 'user{}@example.com'.format(i)},
+    } for i in range(users)]
+    ws.channels = [{
+        'id': 'C{:05d}'.format(i), 'name': 'channel{}'.format(i),
+        'is_member': i % 10 != 9,
+    } for i in range(channels)]
+    for c in ws.channels:
+        ws.messages[c['id']] = []
+
+    user_ids = [u['id'] for u in ws.users]
+    step = days * 86400 / max(1, messages)
+    for i in range(messages):
+        channel_id = rnd.choice(ws.channels)['id']
+        ts = BASE_TS + (i + 0.5) * step
+        m = _message(rnd, ts, rnd.choice(user_ids), reaction_ratio, user_ids)
+        if rnd.random() < bot_ratio:
+            m['bot_id'] = 'B00001'
+        if rnd.random() < thread_ratio:
+            n = rnd.randint(1, replies * 2 - 1) if replies > 0 else 0
+            thread = []
+            for k in range(n):
+                r = _message(rnd, ts + (k + 1) * min(step, 60) / (n + 1),
+                             rnd.choice(user_ids), reaction_ratio, user_ids)
+                r['thread_ts'] = m['ts']
+                r['parent_user_id'] = m['user']
+                if rnd.random() < 0.05:
+                    # チャンネルにも送信された返信
+                    r['subtype'] = 'thread_broadcast'
+                    ws.messages[channel_id].append(r)
+                thread.append(r)
+            if thread:
+                m.update(thread_ts=m['ts'], reply_count=len(thread),
+                         latest_reply=thread[-1]['ts'])
+                ws.replies[(channel_id, m['ts'])] = thread
+        ws.messages[channel_id].append(m)
+    for v in ws.messages.values():
+        v.sort(key=lambda m: float(m['ts']))
+    return ws
+
+
+def write_db(ws: Workspace, path: str) -> None:
+    """collectで収集した場合と同じ形式でワークスペースをSQLiteに書き込みます."""
+    models._session = None
+    init_db(path)
+    with transaction() as s:
+        upsert(s, User.__table__, (user_row(u) for u in ws.users))
+        upsert(s, Channel.__table__, (channel_row(c) for c in ws.channels))
+        upsert_messages(s, _rows(ws))
+
+
+def japanese_text(rnd: random.Random) -> str:
+    """それらしい日本語の文をランダムに組み立てます."""
+    sentences = []
+    for _ in range(rnd.randint(1, 3)):
+        words = []
+        for _ in range(rnd.randint(1, 3)):
+            words += [rnd.choice(_NOUNS), rnd.choice(_PARTICLES)]
+        words += [rnd.choice(_VERBS), rnd.choice(_ENDINGS)]
+        sentences.append(''.join(words) + '。')
+    if rnd.random() < 0.3:
+        sentences.append(rnd.choice(_EXTRAS))
+    return ''.join(sentences)
+
+
+def _message(rnd: random.Random, ts: float, user: str, reaction_ratio: float,
+             user_ids: List[str]) -> Dict[str, Any]:
+    m: Dict[str, Any] = {
+        'type': 'message', 'ts': '{:.6f}'.format(ts), 'user': user,
+        'text': japanese_text(rnd)}
+    # 実際のAPIの応答と同様の付随する項目 (乱数の系列を変えないようtsから生成)
+    digest = hashlib.sha1(m['ts'].encode()).hexdigest()
+    m.update(
+        client_msg_id=str(uuid.UUID(digest[:32])), team=TEAM_ID,
+        blocks=[{'type': 'rich_text', 'block_id': digest[32:37], 'elements': [
+            {'type': 'rich_text_section', 'elements': [
+                {'type': 'text', 'text': m['text']}]}]}])
+    if rnd.random() < reaction_ratio:
+        m['reactions'] = []
+        for name in rnd.sample(REACTIONS, rnd.randint(1, 3)):
+            users = rnd.sample(user_ids, min(len(user_ids), rnd.randint(1, 5)))
+            m['reactions'].append(
+                {'name': name, 'users': users, 'count': len(users)})
+    return m
+
+
+def _rows(ws: Workspace) -> Iterator[Dict[str, Any]]:
+    # collectと同様に参加しているチャンネルのメッセージのみを対象とする
+    members = set(c['id'] for c in ws.channels if c['is_member'])
+    for channel_id, messages in ws.messages.items():
+        if channel_id not in members:
+            continue
+        for m in messages:
+            if m.get('subtype') != 'thread_broadcast':
+                yield _row(channel_id, m)
+    for (channel_id, _), replies in ws.replies.items():
+        if channel_id in members:
+            for m in replies:
+                yield _row(channel_id, m)
+
+
+def _row(channel_id: str, m: Dict[str, Any]) -> Dict[str, Any]:
+    return dict(timestamp=float(m['ts']), channel_id=channel_id,
+                user_id=m['user'], subtype=m.get('subtype', ''), raw=m)
+
+
+def main() -> None:
+    parser = ArgumentParser()
+    parser.add_argument('db', help='書き込み先のSQLiteのパス')
+    parser.add_argument('--messages', type=int, default=10000)
+    parser.add_argument('--channels', type=int, default=20)
+    parser.add_argument('--users', type=int, default=50)
+    parser.add_argument('--days', type=int, default=30)
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+
+    ws = generate(messages=args.messages, channels=args.channels,
+                  users=args.users, days=args.days, seed=args.seed)
+    write_db(ws, args.db)
+    print('{} messages'.format(ws.count()))
+
+
+if __name__ == '__main__':
+    main()
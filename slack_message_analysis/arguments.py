@@ -0,0 +1,83 @@
+from argparse import ArgumentParser
+from datetime import datetime
+
+# サブコマンド共通の引数定義。
+# サブコマンドの引数の定義(commands.py)から利用するため、Slack APIクライアント等の
+# 重い依存ライブラリをimportしないこと。
+
+
+def setup_common_args(p: ArgumentParser) -> ArgumentParser:
+    # 共通の引数を設定します.
+    # 親parser.add_argumentではサブパーサのhelpに表示されないため
+    # サブパーサ毎に設定します
+    p.add_argument(
+        '--db', default='slack.sqlite',
+        help='SQLiteのパス、またはPostgreSQLのURL(postgresql://user@host/db)を指定します。'
+        'デフォルトはカレントディレクトリの"slack.sqlite"です')
+    p.add_argument(
+        '--sqlite-profile', choices=['wal', 'rollback'], default='wal',
+        help='SQLiteの接続設定を指定します。walは書き込み中も集計を並行して実行できます。'
+        'rollbackはWALを利用できないネットワークファイルシステム向けです (デフォルト: wal)')
+    p.add_argument(
+        '--explain', action='store_true',
+        help='実行するSELECT文のクエリプラン(EXPLAIN QUERY PLAN)を標準エラー出力に表示します')
+    p.add_argument(
+        '--metrics', metavar='PATH',
+        help='フェーズ毎の所要時間やAPI呼び出し回数等の計測結果を実行終了時に書き出します。'
+        '拡張子が.promの場合はPrometheusのtextfile形式、それ以外はJSON形式です。'
+        '-を指定すると標準エラー出力にJSON形式で出力します')
+    p.add_argument(
+        '--profile', metavar='PATH',
+        help='cProfileの結果をpstats形式で書き出し、累積時間の上位を標準エラー出力に表示します')
+    p.add_argument(
+        '--tracemalloc', type=int, default=0, metavar='N',
+        help='tracemallocでメモリ確保量の多い上位N箇所を標準エラー出力に表示します')
+    p.add_argument(
+        '--base-url', default='https://api.slack.com/api/',
+        help='Slack APIのURLを指定します (デフォルト: https://api.slack.com/api/)')
+    return p
+
+
+def setup_token_args(p: ArgumentParser) -> ArgumentParser:
+    p.add_argument(
+        '--token',
+        help='APIトークンを指定します。省略した場合はTOKEN環境変数の値が利用されます。')
+    return p
+
+
+def setup_date_range_args(p: ArgumentParser) -> ArgumentParser:
+    p.add_argument(
+        '--since',
+        help='集計開始日時(ISO8601)を指定します',
+        type=datetime_parser)
+    p.add_argument(
+        '--until',
+        help='集計終了日時(ISO8601)を指定します',
+        type=datetime_parser)
+    p.add_argument(
+        '--day', action='store_true',
+        help='昨日の投稿を集計対象とします')
+    p.add_argument(
+        '--week', action='store_true',
+        help='先週の投稿を集計対象とします')
+    p.add_argument(
+        '--month', action='store_true',
+        help='先月の投稿を集計対象とします')
+    p.add_argument(
+        '--this-month', action='store_true',
+        help='今月の投稿を集計対象とします')
+    return p
+
+
+def setup_post_args(p: ArgumentParser) -> ArgumentParser:
+    p.add_argument(
+        '--post',
+        help='ポスト先チャンネルIDを指定します。--dry-run未指定時は必須オプションです')
+    p.add_argument(
+        '--dry-run', action='store_true',
+        help='API投稿を行わず集計のみを行います')
+    return p
+
+
+def datetime_parser(s: str) -> datetime:
+    return datetime.fromisoformat(s)
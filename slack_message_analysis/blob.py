@@ -0,0 +1,133 @@
+import struct
+import threading
+from typing import Any, Dict, List, Optional
+import zlib
+
+try:
+    import zstandard  # type: ignore
+except ImportError:  # pragma: no cover
+    zstandard = None
+
+# messages.coldに格納する圧縮データの形式。
+# 先頭5バイトのヘッダ(圧縮方式のID 1バイト + 共有辞書のID 4バイト)に
+# 圧縮したデータが続く。ヘッダにより展開時は書き込み時の設定に依らず
+# 復元できる。共有辞書のIDが0の場合は辞書を利用しない。
+
+CODECS = {'zlib': 1, 'zstd': 2}
+_CODEC_NAMES = {v: k for k, v in CODECS.items()}
+_HEADER = struct.Struct('>BI')
+
+# zlibはヘッダ等を省いたraw deflate形式とする。メッセージは小さいため
+# 参照範囲(window)を4KBに抑えて圧縮の初期化コストを下げる。
+# 直近のwindow内のみを参照するため、共有辞書もこれを上限とする
+ZLIB_WBITS = 12
+ZLIB_MAX_DICT_SIZE = 1 << ZLIB_WBITS
+
+
+def available(codec: str) -> bool:
+    """圧縮方式が利用可能かどうかを返します. zstdはzstandardパッケージが必要です."""
+    if codec == 'zstd':
+        return zstandard is not None
+    return codec in CODECS
+
+
+class BlobCodec:
+    """cold列の圧縮と展開を行います. スレッドセーフです.
+
+    Args:
+        codec: 圧縮に利用する方式 (CODECSのキー)
+        dict_id: 圧縮に利用する共有辞書のID。0の場合は利用しない
+        dicts: 共有辞書のIDと内容の辞書。展開時はヘッダのIDで参照する
+        level: 圧縮レベル。Noneの場合は各方式の既定値
+    """
+
+    def __init__(self, codec: str = 'zlib', dict_id: int = 0,
+                 dicts: Optional[Dict[int, bytes]] = None,
+                 level: Optional[int] = None) -> None:
+        if not available(codec):
+            raise ValueError('圧縮方式 {} は利用できません'.format(codec))
+        self.codec = codec
+        self.dict_id = dict_id
+        self.dicts = dict(dicts or {})
+        self.level = level
+        self._local = threading.local()
+
+    def compress(self, data: bytes) -> bytes:
+        header = _HEADER.pack(CODECS[self.codec], self.dict_id)
+        zdict = self.dicts[self.dict_id] if self.dict_id else None
+        if self.codec == 'zstd':
+            return header + self._zstd_compressor(zdict).compress(data)
+        level = 6 if self.level is None else self.level
+        if zdict:
+            c = zlib.compressobj(level, zlib.DEFLATED, -ZLIB_WBITS, 8,
+                                 zlib.Z_DEFAULT_STRATEGY, zdict)
+        else:
+            c = zlib.compressobj(level, zlib.DEFLATED, -ZLIB_WBITS)
+        return header + c.compress(data) + c.flush()
+
+    def decompress(self, blob: bytes) -> bytes:
+        codec_id, dict_id = _HEADER.unpack_from(blob)
+        body = memoryview(blob)[_HEADER.size:]
+        codec = _CODEC_NAMES.get(codec_id)
+        zdict = self.dicts[dict_id] if dict_id else None
+        if codec == 'zlib':
+            d = zlib.decompressobj(-ZLIB_WBITS, zdict) if zdict else \
+                zlib.decompressobj(-ZLIB_WBITS)
+            return d.decompress(body) + d.flush()
+        if codec == 'zstd':
+            if zstandard is None:
+                raise RuntimeError(
+                    'zstdで圧縮されたデータの展開にはzstandardパッケージが必要です')
+            return self._zstd_decompressor(dict_id, zdict).decompress(
+                bytes(body))
+        raise ValueError('未知の圧縮方式です: {}'.format(codec_id))
+
+    def _zstd_compressor(self, zdict: Optional[bytes]) -> Any:
+        # ZstdCompressor/ZstdDecompressorはスレッドセーフではないため
+        # スレッド毎に生成する
+        c = getattr(self._local, 'compressor', None)
+        if c is None:
+            kwargs: Dict[str, Any] = {'write_content_size': True}
+            if self.level is not None:
+                kwargs['level'] = self.level
+            if zdict:
+                kwargs['dict_data'] = zstandard.ZstdCompressionDict(zdict)
+            c = self._local.compressor = zstandard.ZstdCompressor(**kwargs)
+        return c
+
+    def _zstd_decompressor(self, dict_id: int, zdict: Optional[bytes]) -> Any:
+        cache = getattr(self._local, 'decompressors', None)
+        if cache is None:
+            cache = self._local.decompressors = {}
+        d = cache.get(dict_id)
+        if d is None:
+            if zdict:
+                d = zstandard.ZstdDecompressor(
+                    dict_data=zstandard.ZstdCompressionDict(zdict))
+            else:
+                d = zstandard.ZstdDecompressor()
+            cache[dict_id] = d
+        return d
+
+
+def train_dictionary(codec: str, samples: List[bytes], size: int) -> bytes:
+    """圧縮対象のサンプルから共有辞書を作成します.
+
+    zstdはzstandardの辞書学習を利用します。zlibは辞書の末尾ほど参照され
+    やすいため、サンプルを古い順に連結した末尾size bytesを辞書とします。
+
+    Args:
+        codec: 圧縮方式 (CODECSのキー)
+        samples: 圧縮対象のデータのサンプル (古い順)
+        size: 辞書の最大サイズ(bytes)
+    Returns:
+        共有辞書の内容。サンプルが少なく作成できない場合は空
+    """
+    if codec == 'zstd':
+        if zstandard is None:
+            raise RuntimeError('zstdの利用にはzstandardパッケージが必要です')
+        try:
+            return zstandard.train_dictionary(size, samples).as_bytes()
+        except zstandard.ZstdError:
+            return b''
+    return b''.join(samples)[-min(size, ZLIB_MAX_DICT_SIZE):]
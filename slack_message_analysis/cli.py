@@ -1,27 +1,46 @@
-from argparse import ArgumentParser
-import os
-from importlib import import_module
+from argparse import ArgumentParser, Namespace
 
+from .commands import COMMANDS
+from .metrics import metrics, Profiler
 
-def main() -> None:
+
+def build_parser() -> ArgumentParser:
+    """全てのサブコマンドを登録したArgumentParserを返します."""
     parser = ArgumentParser()
-    subparsers = parser.add_subparsers()
-    excludes = set(['common.py', 'cli.py', 'models.py'])
-    topdir = os.path.dirname(__file__)
-    ns_root = os.path.dirname(topdir)
-
-    for dirpath, _, filenames in os.walk(topdir):
-        ns = os.path.relpath(
-            dirpath, start=ns_root).replace('/', '.').replace('\\', '.') + '.'
-        for fn in filenames:
-            if not fn.endswith('.py') or fn.startswith('_') or fn in excludes:
-                continue
-            n, _ = os.path.splitext(fn)
-            m = import_module(ns + n)
-            getattr(m, 'init_argparser')(subparsers.add_parser)
+    subparsers = parser.add_subparsers(dest='command')
+    for init_argparser in COMMANDS:
+        init_argparser(subparsers.add_parser)
+    return parser
+
+
+def execute(args: Namespace) -> None:
+    """解釈済みの引数でサブコマンドを1回実行します.
 
+    計測値は実行毎に初期化し、--metrics/--profile/--tracemallocの指定に
+    応じて実行終了時に書き出します。serveは各ジョブをこの関数で実行します。
+    --workspaces指定時は設定ファイルの全てのワークスペースで並列に実行します。
+    """
+    metrics.reset(args.command)
+    profiler = Profiler(getattr(args, 'profile', None),
+                        getattr(args, 'tracemalloc', 0))
+    profiler.start()
+    try:
+        with metrics.phase('total'):
+            if getattr(args, 'workspaces', None):
+                from .workspaces import run
+                run(args)
+            else:
+                args.func(args)
+    finally:
+        if getattr(args, 'metrics', None):
+            metrics.write(args.metrics)
+        profiler.stop()
+
+
+def main() -> None:
+    parser = build_parser()
     args = parser.parse_args()
-    if hasattr(args, 'func'):
-        args.func(args)
-    else:
+    if not hasattr(args, 'func'):
         parser.print_help()
+        return
+    execute(args)
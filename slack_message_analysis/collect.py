@@ -1,53 +1,64 @@
-from argparse import ArgumentParser, Namespace
+from argparse import Namespace
+from concurrent.futures import (
+    Future as _Future, ThreadPoolExecutor, as_completed)
+from contextlib import contextmanager
 from functools import partial
+import threading
 import time
-from typing import Any, Callable, Dict, Tuple, Union, List, TYPE_CHECKING
+from typing import (
+    Any, Callable, Dict, Tuple, Union, List, Iterable, Iterator, Optional,
+    Sequence, TYPE_CHECKING)
 import sys
 
-from slack.errors import SlackApiError
+from slack import WebClient
 from slack.web.slack_response import SlackResponse
+from sqlalchemy import Table
+from sqlalchemy.orm import Session
 
-from .common import (
-    setup_common_args, setup_token_args, datetime_parser, create_slack_client)
-from .models import init_db, transaction, Channel, User, Message
+from .common import create_slack_client
+from .metrics import metrics
+from .models import (
+    channel_row, init_db, transaction, upsert, upsert_changed,
+    upsert_messages, user_row, Channel, User, CollectState)
+from .ratelimit import page_size, RateLimiter, RetryPolicy
 
 if TYPE_CHECKING:
     from asyncio import Future
 
+# 並列実行時にSQLiteへの書き込みを直列化する
+_write_lock = threading.Lock()
 
-def init_argparser(create_parser: Callable[..., ArgumentParser]) -> None:
-    parser = setup_token_args(setup_common_args(create_parser(
-        'collect', help='メッセージを収集しデータベースに格納します')))
-    parser.add_argument(
-        '--since', help='メッセージ取得開始日時(ISO8601)を指定します。'
-        '省略した場合はDBに保存されている最新のメッセージ以降を取得対象とします。',
-        type=datetime_parser)
-    parser.add_argument(
-        '--until', help='メッセージ取得終了日時(ISO8601)を指定します。'
-        '省略した場合はコマンド実行日の週の月曜日午前0時になります。',
-        type=datetime_parser)
-    parser.set_defaults(func=run)
+# 次のページを先読みするスレッド。スレッドを使い回すことで
+# keepalive.poolのスレッド毎の接続を再利用する。先読みもWebClientは
+# 先読みを行うスレッドのものを使う (_client_factory)
+_prefetcher = ThreadPoolExecutor(thread_name_prefix='prefetch')
 
 
 def run(args: Namespace) -> None:
-    client = create_slack_client(args)
-    init_db(args.db)
+    started = time.perf_counter()
+    limiter = RateLimiter(retry=RetryPolicy(args.retries))
+    client = _client_factory(args, limiter)
+    # トークンの指定漏れはDBの初期化前に検出する
+    client()
+    init_db(args.db, args.explain, args.sqlite_profile)
 
     # 全チャンネルをスキャンするしDBにUPSERTする
     #
     # https://api.slack.com/methods/conversations.list
-    # "We recommend no more than 200 results at a time."
-    # よりlimitに200を指定する (デフォルトは100)
+    # limitはTierに応じて指定する (ratelimit.page_size)
+    # joinしているチャンネル以外は読み取れないので会話ログの取得対象から除く
     print('チャンネル一覧を取得中 ', end='')
-    success, channels = _fetch_all_pages(
-        partial(client.conversations_list, exclude_archived=1, limit=200),
-        'channels')
-    with transaction() as s:
-        for c in channels:
-            s.add(Channel(id=c['id'], name=c['name'], is_member=c['is_member'],
-                          raw=c))
-    if success:
-        print(' Found {} channels'.format(len(channels)))
+    with metrics.phase('channels'):
+        channels = _Pages(
+            client, partial(WebClient.conversations_list, exclude_archived=1,
+                            limit=page_size('conversations.list')),
+            'channels')
+        counts = [0, 0, 0]
+        targets = [c for c in _upsert_pages(
+            channels, Channel.__table__, channel_row, counts)
+            if c['is_member']]
+    if not channels.failed:
+        print(' Found {} channels ({})'.format(sum(counts), _changes(counts)))
     else:
         print('[ERROR]')
         return
@@ -55,147 +66,414 @@ def run(args: Namespace) -> None:
     # 全ユーザをスキャンしDBにUPSERTする
     #
     # https://api.slack.com/methods/users.list
-    # "We recommend no more than 200 results at a time."
-    # よりlimitに200を指定する (デフォルトは0と記載があり謎)
+    # limitはTierに応じて指定する (ratelimit.page_size)
     print('ユーザ一覧を取得中 ', end='')
-    success, users = _fetch_all_pages(
-        partial(client.users_list, limit=200), 'members')
-    with transaction() as s:
-        for u in users:
-            name = (
-                u['profile'].get('display_name') or
-                u.get('real_name') or
-                u['profile'].get('real_name') or
-                u['name'])
-            email = u['profile'].get('email')
-            s.add(User(id=u['id'], name=name, email=email, raw=u))
-    if success:
-        print(' Found {} users'.format(len(users)))
+    with metrics.phase('users'):
+        users = _Pages(
+            client, partial(WebClient.users_list,
+                            limit=page_size('users.list')),
+            'members')
+        counts = [0, 0, 0]
+        for _ in _upsert_pages(users, User.__table__, user_row, counts):
+            pass
+    if not users.failed:
+        print(' Found {} users ({})'.format(sum(counts), _changes(counts)))
     else:
         print('[ERROR]')
         return
 
-    def _ts_tostring(ts: float) -> str:
-        return '{:.6f}'.format(ts)
-
     # 各チャンネルの会話を取得しDBにUPSERTする
+    elapsed = _Elapsed()
+    elapsed.add(time.perf_counter() - started)
+    with metrics.phase('messages'):
+        if args.concurrency <= 1:
+            _collect_serial(client, targets, args, elapsed)
+        else:
+            _collect_concurrent(client, targets, args, elapsed)
+    print('所要時間 {:.1f}s (逐次実行換算 {:.1f}s)'.format(
+        time.perf_counter() - started, elapsed.total))
+    _print_throttling(limiter)
+
+
+def _client_factory(args: Namespace,
+                    limiter: RateLimiter) -> Callable[[], WebClient]:
+    # WebClientはスレッド間で共有せず、呼び出したスレッド毎に生成する。
+    # RateLimiterを共有することで全体の呼び出し頻度を抑える
+    local = threading.local()
+
+    def _client() -> WebClient:
+        if not hasattr(local, 'client'):
+            local.client = create_slack_client(args, limiter)
+        return local.client
+    return _client
+
+
+def _collect_serial(client: Callable[[], WebClient],
+                    channels: List[Dict[str, Any]],
+                    args: Namespace, elapsed: '_Elapsed') -> None:
     for c in channels:
-        if not c['is_member']:  # joinしているチャンネル以外は読み取れないのでskip
-            continue
         print('会話ログを取得中 id:{} #{} '.format(
             c['id'], c['name']), end='')
-
-        # since/until引数が指定されていたときや無指定の場合にAPIに渡す引数を設定
-        kwargs = {}
-        if not args.since:
-            with transaction() as s:
-                ret = s.query(
-                    Message.timestamp
-                ).filter(
-                    Message.channel_id == c['id']
-                ).order_by(Message.timestamp.desc()).limit(1).scalar()
-                if ret is not None:
-                    kwargs['oldest'] = _ts_tostring(ret)
-        for n0, n1 in zip(('oldest', 'latest'), ('since', 'until')):
-            if kwargs.get(n0) or getattr(args, n1, None) is None:
-                continue
-            kwargs[n0] = _ts_tostring(getattr(args, n1).timestamp())
-
-        # 会話ログを取得しDBをにUPSERT。
-        # 会話ログは降順で得られるので失敗時はDB登録せずに終える。
-        #
-        # https://api.slack.com/methods/conversations.history
-        # "We recommend no more than 200 results at a time."
-        # よりlimitに200を指定する (デフォルトは100)
-        success, messages = _fetch_all_pages(partial(
-            client.conversations_history, channel=c['id'], limit=200,
-            **kwargs), 'messages')
+        success, n = _collect_channel(client, c, args, elapsed)
+        print(' {} messages '.format(n), end='')
         if not success:
             print('[ERROR]')
             return
+        print('[OK]')
 
-        # スレッドがあればリプライを全部収集する
-        all_replies = []
-        fetched_threads = set()
-        for m in messages:
-            thread_ts = m.get('thread_ts')
-            if not thread_ts or thread_ts in fetched_threads:
+
+def _collect_concurrent(client: Callable[[], WebClient],
+                        channels: List[Dict[str, Any]],
+                        args: Namespace, elapsed: '_Elapsed') -> None:
+    # clientはワーカースレッド毎のWebClientを返す (_client_factory)
+    print('会話ログを取得中 ({} channels, 並列数 {})'.format(
+        len(channels), args.concurrency))
+    failed = False
+    with ThreadPoolExecutor(args.concurrency) as channel_pool, \
+            ThreadPoolExecutor(args.concurrency) as thread_pool:
+        futures = {
+            channel_pool.submit(
+                _collect_channel, client, c, args, elapsed, thread_pool): c
+            for c in channels}
+        for f in as_completed(futures):
+            if f.cancelled():
                 continue
-            fetched_threads.add(thread_ts)
-            #
-            # https://api.slack.com/methods/conversations.replies
-            # "We recommend no more than 200 results at a time."
-            # よりlimitに200を指定する (デフォルトは10)
-            success, replies = _fetch_all_pages(partial(
-                client.conversations_replies, channel=c['id'],
-                ts=thread_ts, limit=200), 'messages')
-            if not success:
-                print('[ERROR]')
-                return
-            all_replies += replies
-
-        # スレッドの関係により重複するメッセージが含まれるので、
-        # 重複を除去する
-        insert_messages: Dict[Tuple[float, str, str, str], Message] = {}
-        for m in messages + all_replies:
-            user_id = m.get('user')
-            if not user_id:
-                # ユーザIDが含まれないメッセージは収集対象外
+            c = futures[f]
+            ok, n = f.result()
+            if not ok:
+                print('id:{} #{} {} messages [ERROR]'.format(
+                    c['id'], c['name'], n))
+                if not failed:
+                    # 未着手のチャンネルは取得を取りやめる
+                    for pending in futures:
+                        pending.cancel()
+                failed = True
                 continue
-            key = (float(m['ts']), c['id'], user_id, m.get('subtype', ''))
-            tmp = Message(
-                timestamp=key[0], channel_id=key[1], user_id=user_id,
-                subtype=key[3], raw=m)
-            insert_messages[key] = tmp
+            print('id:{} #{} {} messages [OK]'.format(c['id'], c['name'], n))
 
-        # DBにUPSERT
-        with transaction() as s:
-            print(' {} messages '.format(len(insert_messages)), end='')
-            for im in insert_messages.values():
-                s.add(im)
-        print('[OK]')
+
+def _changes(counts: Sequence[int]) -> str:
+    return '追加 {} / 更新 {} / 変更なし {}'.format(*counts)
+
+
+def _print_throttling(limiter: RateLimiter) -> None:
+    # レート制限と再試行により待機した時間 (並列実行時は全スレッドの合計)
+    report = [r for r in limiter.report()
+              if r['waited'] or r['ratelimited'] or r['retries']]
+    if not report:
+        return
+    print('待機時間 レート制限 {:.1f}s / 再試行 {:.1f}s'.format(
+        sum(r['waited'] for r in report), sum(r['backoff'] for r in report)))
+    for r in report:
+        print('  {}: {:.1f}s (ratelimited {}回, 再試行 {}回 {:.1f}s, '
+              '{:.1f}/{:.0f}回/分)'.format(
+                  r['method'], r['waited'], r['ratelimited'], r['retries'],
+                  r['backoff'], r['learned_per_minute'], r['per_minute']))
+
+
+def _ts_tostring(ts: float) -> str:
+    return '{:.6f}'.format(ts)
 
 
-def _fetch_all_pages(
-        func: Callable[..., Union['Future', SlackResponse]],
-        key: str
-) -> Tuple[bool, List[Dict[str, Any]]]:
-    """ページネーション対応の全アイテム取得機能.
+def _collect_channel(
+        client: Callable[[], WebClient], c: Dict[str, Any], args: Namespace,
+        elapsed: '_Elapsed', pool: Optional[ThreadPoolExecutor] = None
+) -> Tuple[bool, int]:
+    """チャンネルの会話ログとスレッドのリプライを取得しDBにUPSERTします.
+
+    ページ毎にメッセージと次のページのカーソルをDBに保存するため、
+    中断した場合も次回の実行時に中断したページから再開します。
 
     Args:
-        func: Slack APIのページネーションに対応した関数を指定
-        key: 戻り値のリストに追加するAPIレスポンスの辞書のキー
+        client: 呼び出し元スレッドで利用するWebClientを返す関数
+        c: conversations.listで得られたチャンネル
+        args: collectサブコマンドの引数
+        elapsed: 所要時間の集計先
+        pool: 指定した場合はスレッドのリプライをこのプールで並列に取得する
     Returns:
-        成功フラグと結果配列のタプル。Falseの場合は配列には途中結果が含まれ、
-        標準エラー出力に例外等が出力される。
+        成功フラグとUPSERTしたメッセージ数のタプル
     """
-    ret: List[Dict[str, Any]] = []
-    kwargs: Dict[str, str] = {}
-    while True:
-        try:
-            resp = func(**kwargs)
-            print('.', end='')
-        except Exception as e:
-            if isinstance(e, SlackApiError):
-                if e.response["error"] == "ratelimited":
-                    delay = int(e.response.headers['Retry-After'])
-                    print('\nrate limited. retry-after {}s\n'.format(delay),
-                          end='')
-                    time.sleep(delay)
-                    continue
-
-            print(type(e), e, file=sys.stderr)
-            return False, ret
-
-        assert isinstance(resp, SlackResponse)
-        if not resp['ok']:
-            print(resp, file=sys.stderr)
-            return False, ret
-
-        ret += resp[key]
-        next_cursor = resp.get(
-            'response_metadata', {}).get('next_cursor', None)
+    progress = pool is None
+    with transaction() as s:
+        state = _load_state(s, c['id'], '')
+
+    # since/until引数が指定されていたときや無指定の場合にAPIに渡す引数を設定
+    # 無指定で前回の取得が途中で中断していた場合は同じ範囲の続きから取得する
+    # 無指定の場合は前回取得済みの位置から--refresh-days日前以降を取得し、
+    # 古いメッセージの編集やリアクション、スレッドへの返信を反映する
+    kwargs = {}
+    if not args.since and state['cursor']:
+        for k in ('oldest', 'latest', 'cursor'):
+            if state[k]:
+                kwargs[k] = state[k]
+    else:
+        state['pending'] = None
+        if args.since:
+            kwargs['oldest'] = _ts_tostring(args.since.timestamp())
+        elif state['high_water'] is not None:
+            kwargs['oldest'] = _ts_tostring(
+                state['high_water'] - args.refresh_days * 86400)
+        if args.until:
+            kwargs['latest'] = _ts_tostring(args.until.timestamp())
+    state['oldest'] = kwargs.get('oldest')
+    state['latest'] = kwargs.get('latest')
+    count = 0
+
+    # 会話ログを取得しDBをにUPSERT。
+    #
+    # https://api.slack.com/methods/conversations.history
+    # "We recommend no more than 200 results at a time."
+    # よりlimitに200を指定する (デフォルトは100, ratelimit.page_size)
+    pages = _Pages(client, elapsed.wrap(partial(
+        WebClient.conversations_history, channel=c['id'],
+        limit=page_size('conversations.history'))),
+        'messages', kwargs, progress)
+    for messages, next_cursor in pages:
+        # リプライが増えたスレッドのみリプライを取得する
+        threads = _updated_threads(c['id'], messages)
+        if pool is None:
+            results: Iterable[Tuple[bool, int]] = [
+                _collect_thread(client, c['id'], ts, latest, elapsed, progress)
+                for ts, latest in threads]
+        else:
+            results = [f.result() for f in [
+                pool.submit(_collect_thread, client, c['id'], ts, latest,
+                            elapsed, progress)
+                for ts, latest in threads]]
+        for success, n in results:
+            count += n
+            if not success:
+                return False, count
+
+        # 取得したページのメッセージと次のページのカーソルを同時に保存する
+        if messages:
+            page_latest = max(float(m['ts']) for m in messages)
+            state['pending'] = max(page_latest, state['pending'] or 0.0)
+        state['cursor'] = next_cursor
         if not next_cursor:
-            break
-        kwargs['cursor'] = next_cursor
-    return True, ret
+            state.update(oldest=None, latest=None, high_water=max(
+                state['pending'] or 0.0, state['high_water'] or 0.0) or None)
+            state['pending'] = None
+        with elapsed.measure(), _write_lock, transaction() as s:
+            count += _store_messages(s, c['id'], messages)
+            _save_state(s, state)
+    return not pages.failed, count
+
+
+def _collect_thread(
+        client: Callable[[], WebClient], channel_id: str, thread_ts: str,
+        latest_reply: Optional[str], elapsed: '_Elapsed', progress: bool
+) -> Tuple[bool, int]:
+    """スレッドのリプライを取得しDBにUPSERTします.
+
+    Returns:
+        成功フラグとUPSERTしたメッセージ数のタプル
+    """
+    with transaction() as s:
+        state = _load_state(s, channel_id, thread_ts)
+    kwargs = {}
+    if state['cursor']:
+        kwargs['cursor'] = state['cursor']
+    count = 0
+
+    #
+    # https://api.slack.com/methods/conversations.replies
+    # "We recommend no more than 200 results at a time."
+    # よりlimitに200を指定する (デフォルトは10, ratelimit.page_size)
+    pages = _Pages(client, elapsed.wrap(partial(
+        WebClient.conversations_replies, channel=channel_id, ts=thread_ts,
+        limit=page_size('conversations.replies'))),
+        'messages', kwargs, progress)
+    for messages, next_cursor in pages:
+        state['cursor'] = next_cursor
+        if not next_cursor:
+            state['last_reply'] = latest_reply
+        with elapsed.measure(), _write_lock, transaction() as s:
+            count += _store_messages(s, channel_id, messages)
+            _save_state(s, state)
+    return not pages.failed, count
+
+
+def _updated_threads(
+        channel_id: str, messages: List[Dict[str, Any]]
+) -> List[Tuple[str, Optional[str]]]:
+    """リプライを取得する必要のあるスレッドの(thread_ts, latest_reply)の一覧.
+
+    前回取得したときからlatest_replyが進んでいるスレッドと未取得のスレッドを
+    対象とします。
+    """
+    threads: Dict[str, Optional[str]] = {}
+    for m in messages:
+        thread_ts = m.get('thread_ts')
+        if not thread_ts:
+            continue
+        # 親メッセージ以外(thread_broadcast)はlatest_replyを持たない
+        if m['ts'] == thread_ts or thread_ts not in threads:
+            threads[thread_ts] = m.get('latest_reply')
+    if not threads:
+        return []
+    with transaction() as s:
+        fetched = dict(s.query(
+            CollectState.thread_ts, CollectState.last_reply,
+        ).filter(
+            CollectState.channel_id == channel_id,
+            CollectState.thread_ts.in_(list(threads)),
+            CollectState.cursor.is_(None),
+        ))
+    return [(ts, latest) for ts, latest in threads.items()
+            if ts not in fetched or (
+                latest is not None and fetched[ts] != latest)]
+
+
+def _load_state(s: Session, channel_id: str, thread_ts: str) -> Dict[str, Any]:
+    state = s.query(CollectState).filter(
+        CollectState.channel_id == channel_id,
+        CollectState.thread_ts == thread_ts).one_or_none()
+    return {c.name: getattr(state, c.name, None)
+            for c in CollectState.__table__.columns} if state else dict(
+        channel_id=channel_id, thread_ts=thread_ts, cursor=None, oldest=None,
+        latest=None, pending=None, high_water=None, last_reply=None)
+
+
+def _save_state(s: Session, state: Dict[str, Any]) -> None:
+    upsert(s, CollectState.__table__, [state])
+
+
+def _store_messages(s: Session, channel_id: str,
+                    messages: List[Dict[str, Any]]) -> int:
+    # スレッドの関係により重複するメッセージが含まれるので、
+    # 重複を除去する
+    insert_messages: Dict[Tuple[float, str, str, str], Dict[str, Any]] = {}
+    for m in messages:
+        user_id = m.get('user')
+        if not user_id:
+            # ユーザIDが含まれないメッセージは収集対象外
+            continue
+        key = (float(m['ts']), channel_id, user_id, m.get('subtype', ''))
+        insert_messages[key] = dict(
+            timestamp=key[0], channel_id=key[1], user_id=user_id,
+            subtype=key[3], raw=m)
+    return upsert_messages(s, insert_messages.values())
+
+
+class _Elapsed:
+    """逐次実行した場合の所要時間を見積もるため各処理の所要時間を合算します."""
+
+    def __init__(self) -> None:
+        self.total = 0.0
+        self._lock = threading.Lock()
+
+    def add(self, seconds: float) -> None:
+        with self._lock:
+            self.total += seconds
+
+    @contextmanager
+    def measure(self) -> Iterator[None]:
+        t = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add(time.perf_counter() - t)
+
+    def wrap(self, func: Callable[..., Any]) -> Callable[..., Any]:
+        def _measured(*args: Any, **kwargs: Any) -> Any:
+            with self.measure():
+                return func(*args, **kwargs)
+        return _measured
+
+
+class _Pages:
+    """ページネーション対応のSlack APIのページを順に取得するイテラブル.
+
+    各ページのアイテムの配列と次のページのカーソル(最後のページの場合はNone)の
+    タプルを返します。呼び出し側が受け取ったページを保存している間に次のページを
+    先読みします。ratelimitedと一時的な障害の再試行はRateLimitedWebClientが
+    行います。取得に失敗した場合は標準エラー出力に例外等を出力して終了し、
+    failedをTrueにします。
+
+    Args:
+        client: 呼び出したスレッドで利用するWebClientを返す関数。
+            先読みは先読みを行うスレッドのWebClientで取得する
+        func: Slack APIのページネーションに対応したWebClientのメソッドを指定
+            (WebClient.users_list等、第1引数にWebClientを受け取る)
+        key: 返すAPIレスポンスの辞書のキー
+        kwargs: funcに渡す追加の引数。cursorを含む場合はそのページから取得する
+        progress: ページ取得毎に進捗を標準出力に表示するかどうか
+    """
+
+    def __init__(self, client: Callable[[], WebClient],
+                 func: Callable[..., Union['Future', SlackResponse]],
+                 key: str, kwargs: Optional[Dict[str, str]] = None,
+                 progress: bool = True) -> None:
+        self.failed = False
+        self._client = client
+        self._func = func
+        self._key = key
+        self._kwargs = dict(kwargs or {})
+        self._progress = progress
+
+    def __iter__(self) -> Iterator[
+            Tuple[List[Dict[str, Any]], Optional[str]]]:
+        kwargs = dict(self._kwargs)
+        future: Optional['_Future[Any]'] = None
+        try:
+            while True:
+                try:
+                    # 先読みが他のページの先読みで待たされている場合は
+                    # 取りやめ、呼び出し元のスレッドで取得する
+                    if future is None or future.cancel():
+                        resp = self._fetch(**kwargs)
+                    else:
+                        resp = future.result()
+                    if self._progress:
+                        print('.', end='')
+                except Exception as e:
+                    print(type(e), e, file=sys.stderr)
+                    self.failed = True
+                    return
+
+                assert isinstance(resp, SlackResponse)
+                if not resp['ok']:
+                    print(resp, file=sys.stderr)
+                    self.failed = True
+                    return
+
+                metrics.inc('pages_fetched_total', key=self._key)
+                next_cursor = resp.get(
+                    'response_metadata', {}).get('next_cursor', None) or None
+                future = None
+                if next_cursor:
+                    kwargs['cursor'] = next_cursor
+                    future = _prefetcher.submit(self._fetch, **kwargs)
+                yield resp[self._key], next_cursor
+                if not next_cursor:
+                    return
+        finally:
+            # 途中で取得を取りやめた場合は先読みを取り消す
+            if future is not None:
+                future.cancel()
+
+    def _fetch(self, **kwargs: str) -> Union['Future', SlackResponse]:
+        # 実行中のスレッドのWebClientで取得する
+        return self._func(self._client(), **kwargs)
+
+
+def _upsert_pages(pages: _Pages, table: Table,
+                  to_row: Callable[[Dict[str, Any]], Dict[str, Any]],
+                  counts: List[int]) -> Iterator[Dict[str, Any]]:
+    """ページ毎にupsert_changedで書き込み、書き込んだアイテムを順に返します.
+
+    一覧の全体をメモリに保持しないよう、ページ毎にトランザクションを分けます。
+
+    Args:
+        pages: users.list等のページ
+        table: 書き込み先テーブル
+        to_row: アイテムを行に変換する関数 (user_row等)
+        counts: 追加、更新、変更なしの行数を加算するリスト
+    """
+    for items, _ in pages:
+        with transaction() as s:
+            for i, n in enumerate(upsert_changed(
+                    s, table, (to_row(x) for x in items))):
+                counts[i] += n
+        yield from items
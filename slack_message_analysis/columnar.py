@@ -0,0 +1,407 @@
+from datetime import datetime
+import json
+import os
+import sys
+from typing import (
+    Any, Callable, Dict, Iterable, Iterator, List, Optional, Sequence, Tuple)
+
+from sqlalchemy import func
+from sqlalchemy.orm import Session
+
+from .common import TARGET_SUBTYPES
+from .models import (
+    get_meta, Channel, Message, User, DIRECTORY_VERSION, message_field)
+from .reports import Aggregator, group_by_source
+
+try:
+    import pyarrow as pa  # type: ignore
+    import pyarrow.compute as pc  # type: ignore
+    import pyarrow.dataset as ds  # type: ignore
+    import pyarrow.feather as feather  # type: ignore
+    import pyarrow.parquet as pq  # type: ignore
+except ImportError:  # pragma: no cover
+    pa = None
+
+# exportサブコマンドで書き出す列指向形式のファイルと、それを読み込む集計。
+# 出力先ディレクトリの構成は次の通り。messagesは月(ローカルタイム)と
+# チャンネルでHive形式にパーティション分割する。
+#
+#   users.<ext>, channels.<ext>
+#   messages/month=YYYY-MM/channel=<チャンネルID>/part.<ext>
+#   _manifest.json  (パーティション毎のフィンガープリント)
+#
+# 再実行時はフィンガープリント(件数・最新のメッセージ・最後に書き込んだ
+# revision。users/channelsは件数とDIRECTORY_VERSION)が変わったパーティションのみを
+# 書き直す。
+
+FORMATS = {'parquet': 'parquet', 'feather': 'arrow'}
+MANIFEST = '_manifest.json'
+# マニフェストの形式。列の構成を変えた場合は上げて全て書き直させる
+_MANIFEST_VERSION = 1
+
+
+def available() -> bool:
+    return pa is not None
+
+
+def require() -> None:
+    """pyarrowがインストールされていない場合は終了します."""
+    if pa is None:
+        print('pyarrowが必要です (pip install pyarrow)', file=sys.stderr)
+        sys.exit(1)
+
+
+def message_schema() -> Any:
+    reaction = pa.struct([
+        ('name', pa.string()), ('count', pa.int32()),
+        ('users', pa.list_(pa.string()))])
+    return pa.schema([
+        ('timestamp', pa.float64()),
+        ('datetime', pa.timestamp('us', tz='UTC')),
+        ('channel_id', pa.string()),
+        ('user_id', pa.string()),
+        ('subtype', pa.string()),
+        ('text', pa.string()),
+        ('bot_id', pa.string()),
+        ('thread_ts', pa.string()),
+        ('reply_count', pa.int32()),
+        ('reactions', pa.list_(reaction)),
+    ])
+
+
+def user_schema() -> Any:
+    return pa.schema([
+        ('id', pa.string()), ('name', pa.string()), ('email', pa.string()),
+        ('real_name', pa.string()), ('display_name', pa.string()),
+        ('tz', pa.string()), ('is_bot', pa.bool_()), ('deleted', pa.bool_()),
+    ])
+
+
+def channel_schema() -> Any:
+    return pa.schema([
+        ('id', pa.string()), ('name', pa.string()),
+        ('is_member', pa.bool_()), ('is_private', pa.bool_()),
+        ('is_archived', pa.bool_()),
+        ('created', pa.timestamp('s', tz='UTC')),
+        ('num_members', pa.int32()),
+    ])
+
+
+class ExportStats:
+    """export()で書き出した/削除した/変更がなかったパーティションの数."""
+
+    def __init__(self) -> None:
+        self.written = 0
+        self.removed = 0
+        self.unchanged = 0
+        self.rows = 0
+
+
+def export(s: Session, path: str, fmt: str = 'parquet',
+           full: bool = False) -> ExportStats:
+    """データベースのusers/channels/messagesを列指向形式で書き出します.
+
+    Args:
+        s: transaction()で得たセッション
+        path: 出力先ディレクトリ
+        fmt: 出力形式 (FORMATSのキー)。featherはArrow IPC形式(非圧縮)で
+            メモリマップして読み込めます
+        full: Trueの場合は変更の有無に関わらず全て書き直します
+    Returns:
+        書き出しの統計
+    """
+    require()
+    stats = ExportStats()
+    manifest = _load_manifest(path)
+    if (full or manifest.get('version') != _MANIFEST_VERSION or
+            manifest.get('format') != fmt):
+        # 形式が変わった場合は以前のファイルを全て削除して書き直す
+        stats.removed += _remove(path, manifest.get('partitions', {}))
+        manifest = {}
+    written = manifest.get('partitions', {})
+    current: Dict[str, str] = {}
+
+    def _write(name: str, fingerprint: str,
+               make: Callable[[], Any]) -> None:
+        current[name] = fingerprint
+        if written.get(name) == fingerprint:
+            stats.unchanged += 1
+            return
+        table = make()
+        _write_table(table, os.path.join(path, name), fmt)
+        stats.written += 1
+        stats.rows += table.num_rows
+
+    ext = FORMATS[fmt]
+    _write('users.' + ext, _table_fingerprint(s, User),
+           lambda: _users_table(s))
+    _write('channels.' + ext, _table_fingerprint(s, Channel),
+           lambda: _channels_table(s))
+    for (month, channel_id), fingerprint in _message_fingerprints(s):
+        _write(_partition(month, channel_id, ext), fingerprint,
+               lambda: _messages_table(s, month, channel_id))
+
+    stats.removed += _remove(path, set(written) - set(current))
+    _save_manifest(path, fmt, current)
+    return stats
+
+
+def run_reports(path: str, since: datetime, until: datetime,
+                aggregators: Iterable[Aggregator]) -> None:
+    """export()で書き出したファイルからreports.run_reports()と同じ集計を行います.
+
+    期間とsubtypeで絞り込んだメッセージをpyarrowのgroup_byでまとめて集計します。
+
+    Args:
+        path: export()の出力先ディレクトリ
+        since: 集計開始日時
+        until: 集計終了日時
+        aggregators: 集計器
+    """
+    require()
+    by_source = group_by_source(aggregators)
+    if not by_source:
+        return
+    table = _read_messages(path, since, until, by_source)
+    for source, counts in _source_counts(table, by_source):
+        for key, count in counts:
+            for a in by_source[source]:
+                a.feed(key, count)
+
+
+def run_series_reports(path: str, ranges: Sequence[Tuple[datetime, datetime]],
+                       buckets: Sequence[Iterable[Aggregator]]) -> None:
+    """export()で書き出したファイルからreports.run_series_reports()と同じ集計を
+    行います.
+
+    全期間のメッセージを1回だけ読み込み、期間の番号の列を加えて
+    (期間, キー)毎にgroup_byで集計します。
+
+    Args:
+        path: export()の出力先ディレクトリ
+        ranges: reports.bucket_ranges()で分割した期間
+        buckets: 期間毎の集計器
+    """
+    require()
+    # 期間の番号はnumpyのsearchsortedで求める
+    from .vectorized import np, require as require_numpy
+    require_numpy()
+    by_source = [group_by_source(b) for b in buckets]
+    sources = set().union(*by_source)
+    if not sources:
+        return
+    table = _read_messages(path, ranges[0][0], ranges[-1][1], sources,
+                           ['timestamp'])
+    index = np.searchsorted(
+        [a.timestamp() for a, _ in ranges],
+        table['timestamp'].to_numpy(), side='right') - 1
+    table = table.append_column('bucket', pa.array(index, pa.int32()))
+    for source, counts in _source_counts(table, sources, 'bucket'):
+        for i, key, count in counts:
+            for a in by_source[i].get(source, []):
+                a.feed(key, count)
+
+
+def _read_messages(path: str, since: datetime, until: datetime,
+                   sources: Iterable[str], columns: Sequence[str] = ()
+                   ) -> Any:
+    # 期間内の集計対象のメッセージのうち、sourcesの集計に必要な列を読み込む
+    fmt = _manifest_format(path)
+    dataset = ds.dataset(
+        os.path.join(path, 'messages'), format=fmt.replace('feather', 'ipc'),
+        partitioning='hive')
+    # 月のパーティションで読み込むファイルを絞り込んだ上で期間で絞り込む
+    expr = ((ds.field('month') >= since.strftime('%Y-%m')) &
+            (ds.field('month') <= until.strftime('%Y-%m')) &
+            (ds.field('timestamp') >= since.timestamp()) &
+            (ds.field('timestamp') < until.timestamp()) &
+            ds.field('subtype').isin(list(TARGET_SUBTYPES)))
+    names = set(columns)
+    sources = set(sources)
+    if 'user_posts' in sources:
+        names.add('user_id')
+    if 'channel_posts' in sources:
+        names.add('channel_id')
+    if sources & {'reactions', 'reaction_users'}:
+        names.add('reactions')
+    return dataset.to_table(columns=sorted(names), filter=expr)
+
+
+def _source_counts(table: Any, sources: Iterable[str],
+                   by: Optional[str] = None
+                   ) -> Iterator[Tuple[str, Iterable[Tuple[Any, ...]]]]:
+    # byを指定した場合は (byの値, キー, 件数) を、それ以外は (キー, 件数) を返す
+    for source in sorted(sources):
+        if source == 'user_posts':
+            yield source, _group(table, 'user_id', by=by)
+        elif source == 'channel_posts':
+            yield source, _group(table, 'channel_id', by=by)
+        else:
+            column = table['reactions'].combine_chunks()
+            reactions = pc.list_flatten(column)
+            parents = {}
+            if by:
+                # リアクションを付けたメッセージの行のbyの値
+                parents[by] = pc.take(
+                    table[by], pc.list_parent_indices(column))
+            if source == 'reactions':
+                # 利用者が省略された分を含めた利用数
+                yield source, _group(pa.table(dict(parents, **{
+                    'reaction': pc.struct_field(reactions, 'name'),
+                    'count': pc.struct_field(reactions, 'count'),
+                })), 'reaction', 'count', by)
+            else:
+                users = pc.struct_field(reactions, 'users')
+                if by:
+                    parents[by] = pc.take(
+                        parents[by], pc.list_parent_indices(users))
+                yield source, _group(pa.table(dict(parents, **{
+                    'user_id': pc.list_flatten(users)})), 'user_id', by=by)
+
+
+def _group(table: Any, key: str, value: str = '', by: Optional[str] = None
+           ) -> Iterable[Tuple[Any, ...]]:
+    # valueを指定した場合はその合計、それ以外は件数を(byと)キー毎に集計する
+    keys = [by, key] if by else [key]
+    if value:
+        t = table.group_by(keys).aggregate([(value, 'sum')])
+        values = t[value + '_sum']
+    else:
+        t = table.group_by(keys).aggregate([(key, 'count')])
+        values = t[key + '_count']
+    return zip(*[t[k].to_pylist() for k in keys], values.to_pylist())
+
+
+def _users_table(s: Session) -> Any:
+    rows = []
+    for u in s.query(User):
+        profile = u.raw.get('profile', {})
+        rows.append(dict(
+            id=u.id, name=u.name, email=u.email,
+            real_name=profile.get('real_name'),
+            display_name=profile.get('display_name'), tz=u.raw.get('tz'),
+            is_bot=bool(u.raw.get('is_bot')),
+            deleted=bool(u.raw.get('deleted'))))
+    return pa.Table.from_pylist(rows, schema=user_schema())
+
+
+def _channels_table(s: Session) -> Any:
+    rows = []
+    for c in s.query(Channel):
+        rows.append(dict(
+            id=c.id, name=c.name, is_member=c.is_member,
+            is_private=bool(c.raw.get('is_private')),
+            is_archived=bool(c.raw.get('is_archived')),
+            created=c.raw.get('created'),
+            num_members=c.raw.get('num_members')))
+    return pa.Table.from_pylist(rows, schema=channel_schema())
+
+
+def _messages_table(s: Session, month: str, channel_id: str) -> Any:
+    since = datetime.strptime(month, '%Y-%m')
+    until = since.replace(year=since.year + since.month // 12,
+                          month=since.month % 12 + 1)
+    q = s.query(
+        Message.timestamp, Message.user_id, Message.subtype,
+        message_field('text'), message_field('bot_id'),
+        message_field('thread_ts'), message_field('reply_count'),
+        message_field('reactions'),
+    ).filter(
+        Message.channel_id == channel_id,
+        Message.timestamp >= since.timestamp(),
+        Message.timestamp < until.timestamp(),
+    ).order_by(Message.timestamp)
+    columns: Dict[str, List[Any]] = {
+        name: [] for name in message_schema().names}
+    for ts, user_id, subtype, text, bot_id, thread_ts, reply_count, \
+            reactions in q:
+        columns['timestamp'].append(ts)
+        columns['datetime'].append(int(ts * 1000000))
+        columns['channel_id'].append(channel_id)
+        columns['user_id'].append(user_id)
+        columns['subtype'].append(subtype)
+        columns['text'].append(text)
+        columns['bot_id'].append(bot_id)
+        columns['thread_ts'].append(thread_ts)
+        columns['reply_count'].append(reply_count)
+        columns['reactions'].append([
+            dict(name=r['name'], count=r['count'], users=r.get('users', []))
+            for r in reactions or []])
+    return pa.Table.from_pydict(columns, schema=message_schema())
+
+
+def _message_fingerprints(s: Session) -> List[Tuple[Tuple[str, str], str]]:
+    # 本文等を読み出さずに、パーティション毎の件数・最新のメッセージ・
+    # 最後に書き込んだ行のrevisionから変更の有無を判定する。
+    # 書き込んだ行は新しいrevisionを持ち、削除した場合は件数が減る
+    m = Message
+    if s.get_bind().dialect.name == 'postgresql':
+        # セッションのタイムゾーンはinit_dbでローカルタイムに設定済み
+        month = func.to_char(func.to_timestamp(m.timestamp), 'YYYY-MM')
+    else:
+        month = func.strftime('%Y-%m', m.timestamp, 'unixepoch', 'localtime')
+    q = s.query(
+        month, m.channel_id, func.count(), func.max(m.timestamp),
+        func.max(m.revision),
+    ).group_by(month, m.channel_id).order_by(month, m.channel_id)
+    return [((month, channel_id), '{}:{!r}:{}'.format(n, last, revision))
+            for month, channel_id, n, last, revision in q]
+
+
+def _table_fingerprint(s: Session, table: Any) -> str:
+    # users/channelsはupsert_changed()で書き込む毎にDIRECTORY_VERSIONが変わる
+    return '{}:{}'.format(s.query(func.count()).select_from(table).scalar(),
+                          get_meta(s, DIRECTORY_VERSION))
+
+
+def _partition(month: str, channel_id: str, ext: str) -> str:
+    return 'messages/month={}/channel={}/part.{}'.format(
+        month, channel_id, ext)
+
+
+def _write_table(table: Any, file: str, fmt: str) -> None:
+    directory, name = os.path.split(file)
+    os.makedirs(directory, exist_ok=True)
+    # 読み込み中のプロセスが書き込み途中のファイルを読まないよう置き換える。
+    # 書き込み中のファイルは "." で始まる名前としてpyarrow.datasetから除く
+    tmp = os.path.join(directory, '.{}.tmp'.format(name))
+    if fmt == 'parquet':
+        pq.write_table(table, tmp, compression='zstd')
+    else:
+        feather.write_feather(table, tmp, compression='uncompressed')
+    os.replace(tmp, file)
+
+
+def _remove(path: str, names: Iterable[str]) -> int:
+    n = 0
+    for name in names:
+        file = os.path.join(path, name)
+        if os.path.exists(file):
+            os.remove(file)
+            n += 1
+    return n
+
+
+def _load_manifest(path: str) -> Dict[str, Any]:
+    try:
+        with open(os.path.join(path, MANIFEST), encoding='utf8') as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return {}
+
+
+def _save_manifest(path: str, fmt: str, partitions: Dict[str, str]) -> None:
+    os.makedirs(path, exist_ok=True)
+    file = os.path.join(path, MANIFEST)
+    with open(file + '.tmp', 'w', encoding='utf8') as f:
+        json.dump({'version': _MANIFEST_VERSION, 'format': fmt,
+                   'partitions': partitions}, f, indent=2)
+    os.replace(file + '.tmp', file)
+
+
+def _manifest_format(path: str) -> str:
+    manifest = _load_manifest(path)
+    if 'format' not in manifest:
+        print('{} にexportの結果がありません'.format(path), file=sys.stderr)
+        sys.exit(1)
+    return manifest['format']
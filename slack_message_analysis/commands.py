@@ -0,0 +1,309 @@
+from argparse import ArgumentParser, ArgumentTypeError, Namespace
+from importlib import import_module
+import os
+from typing import Callable, List
+
+from .arguments import (
+    setup_common_args, setup_token_args, setup_date_range_args,
+    setup_post_args, datetime_parser)
+
+# サブコマンドの一覧と引数の定義。
+# 起動を速くするため、ここではサブコマンドを実装するモジュールやその依存
+# ライブラリ(slack, sqlalchemy, fugashi, wordcloud等)をimportせず、
+# 実行するサブコマンドのモジュールのみを実行時にimportする。
+
+CreateParser = Callable[..., ArgumentParser]
+
+# reportサブコマンドで作成できるレポート (report.REPORTSのキー)
+REPORT_NAMES = ['leaderboard', 'team']
+
+# --bucketで指定できる期間の区切り (reports.BUCKETS)
+BUCKETS = ['day', 'week', 'month']
+
+
+def _lazy(module: str, name: str = 'run') -> Callable[[Namespace], None]:
+    """サブコマンドの実行時にモジュールをimportして関数を呼び出す関数を返します.
+
+    Args:
+        module: サブコマンドを実装するモジュール名 (パッケージからの相対名)
+        name: 呼び出す関数名
+    """
+    def _run(args: Namespace) -> None:
+        getattr(import_module('.' + module, __package__), name)(args)
+    return _run
+
+
+def _collect(create_parser: CreateParser) -> None:
+    parser = setup_token_args(setup_common_args(create_parser(
+        'collect', help='メッセージを収集しデータベースに格納します')))
+    parser.add_argument(
+        '--since', help='メッセージ取得開始日時(ISO8601)を指定します。'
+        '省略した場合はDBに保存されている最新のメッセージ以降を取得対象とします。',
+        type=datetime_parser)
+    parser.add_argument(
+        '--until', help='メッセージ取得終了日時(ISO8601)を指定します。'
+        '省略した場合はコマンド実行日の週の月曜日午前0時になります。',
+        type=datetime_parser)
+    parser.add_argument(
+        '--refresh-days', type=float, default=7,
+        help='--since省略時に前回取得済みの位置から何日前まで遡って再取得するかを指定します。'
+        '古いメッセージの編集やリアクション、スレッドへの返信を反映するために利用します。'
+        '(デフォルト: 7日)')
+    parser.add_argument(
+        '--concurrency', type=int, default=1,
+        help='会話ログを並列に取得するチャンネル/スレッドの数を指定します。'
+        'API呼び出しはメソッド毎のレート制限(Tier)内に抑えられます。(デフォルト: 1)')
+    parser.add_argument(
+        '--retries', type=int, default=5,
+        help='タイムアウトや5xx等の一時的な障害でAPI呼び出しが失敗した場合に、'
+        '待機時間を指数的に延ばしながら再試行する回数を指定します。(デフォルト: 5)')
+    _setup_workspaces_args(parser)
+    parser.set_defaults(func=_lazy('collect'))
+
+
+def _ingest(create_parser: CreateParser) -> None:
+    parser = setup_common_args(create_parser(
+        'ingest', help='Events APIのイベント(message, reaction_added/removed, '
+        'channel_created, user_change等)を受け取りデータベースに反映します。'
+        '停止中等に受け取れなかったイベントはcollectを定期的に実行して補完します。'))
+    source = parser.add_mutually_exclusive_group(required=True)
+    source.add_argument(
+        '--listen', metavar='[HOST:]PORT',
+        help='Events APIのRequest URLとしてイベントを受け付けるHTTPサーバを起動します。'
+        'ホストを省略した場合は127.0.0.1で待ち受けます')
+    source.add_argument(
+        '--replay', metavar='PATH',
+        help='イベントログ(1行に1つのイベントのJSON)を読み込んで反映し終了します')
+    parser.add_argument(
+        '--log', metavar='PATH',
+        help='--listenで受け取ったイベントを反映前にイベントログとして追記します。'
+        '--replayで再度反映できます')
+    parser.add_argument(
+        '--signing-secret',
+        help='リクエストの署名の検証に利用するSigning Secretを指定します。'
+        '省略した場合はSLACK_SIGNING_SECRET環境変数の値が利用されます。'
+        '--listenではいずれかの指定が必要です')
+    parser.add_argument(
+        '--insecure', action='store_true',
+        help='Signing Secretを指定せずに--listenを起動し、署名の無いリクエストも'
+        '受け付けます。信頼できるネットワークでの検証用です')
+    parser.add_argument(
+        '--batch-size', type=int, default=500,
+        help='1回のトランザクションでまとめて反映する最大のイベント数 (デフォルト: 500)')
+    parser.add_argument(
+        '--flush-interval', type=float, default=5.0,
+        help='イベントを受け取ってから反映するまでの最大の秒数 (デフォルト: 5秒)')
+    parser.set_defaults(func=_lazy('ingest'))
+
+
+def _leaderboard(create_parser: CreateParser) -> None:
+    parser = setup_common_args(setup_token_args(setup_date_range_args(
+        setup_post_args(create_parser(
+            'leaderboard', help='ユーザごとの発言/リアクション数、チャンネルごとの発言数、'
+            'リアクションの利用数、チーム単位の発言数を集計し順位表を作成します。\n'
+            '--sinceと--until または --day または --week または --month を指定する必要があります。'
+        )))))
+    _setup_leaderboard_args(parser)
+    _setup_backend_args(parser)
+    _setup_bucket_args(parser)
+    _setup_workspaces_args(parser)
+    parser.add_argument(
+        '--merge', action='store_true',
+        help='--workspacesの全てのワークスペースの集計結果を合算した順位表を作成します。'
+        'ユーザ/チャンネルは名前にワークスペース名を付けて区別し、'
+        'リアクションは名前毎に合計します。投稿には--token/--postの値を利用します')
+    parser.set_defaults(func=_lazy('leaderboard'))
+
+
+def _team(create_parser: CreateParser) -> None:
+    parser = setup_common_args(setup_token_args(setup_date_range_args(
+        setup_post_args(create_parser(
+            'team', help='チームごとの発言数を集計します。\n'
+            '--sinceと--until または --day または --week または --month を指定する必要があります。'
+        )))))
+    _setup_team_args(parser)
+    _setup_backend_args(parser)
+    _setup_bucket_args(parser)
+    _setup_workspaces_args(parser)
+    parser.set_defaults(func=_lazy('team'))
+
+
+def _report(create_parser: CreateParser) -> None:
+    parser = setup_common_args(setup_token_args(setup_date_range_args(
+        setup_post_args(create_parser(
+            'report', help='leaderboardとteamの集計を1回のデータベースの走査でまとめて行います。\n'
+            '--sinceと--until または --day または --week または --month を指定する必要があります。'
+        )))))
+    parser.add_argument(
+        '--reports', type=_comma_list(REPORT_NAMES), default=REPORT_NAMES,
+        help='作成するレポートをカンマ区切りで指定します。'
+        '(デフォルト: {})'.format(','.join(REPORT_NAMES)))
+    _setup_leaderboard_args(parser)
+    _setup_team_args(parser)
+    _setup_backend_args(parser)
+    _setup_workspaces_args(parser)
+    parser.set_defaults(func=_lazy('report'))
+
+
+def _setup_backend_args(parser: ArgumentParser) -> None:
+    parser.add_argument(
+        '--backend', choices=['sql', 'numpy'], default='sql',
+        help='集計方法を指定します。sqlは日毎の集計テーブルを利用してSQLで、'
+        'numpyは期間内のメッセージを配列に読み込んでNumPyで集計します。(デフォルト: sql)')
+    parser.add_argument(
+        '--from-export', metavar='DIR',
+        help='exportで書き出したディレクトリを指定すると、データベースの代わりに'
+        'そのファイルから発言数/リアクション数を集計します。pyarrowが必要です。')
+
+
+def _setup_bucket_args(parser: ArgumentParser) -> None:
+    parser.add_argument(
+        '--bucket', choices=BUCKETS,
+        help='集計期間を日/週(月曜日から)/月毎に区切り、期間毎の集計結果をCSV形式で'
+        '標準出力に出力します。投稿は行いません')
+
+
+def _setup_workspaces_args(parser: ArgumentParser) -> None:
+    parser.add_argument(
+        '--workspaces', metavar='PATH',
+        help='ワークスペース毎のdb、token(またはtoken_env)、base_url、postを'
+        'セクション毎に記載したINI形式の設定ファイルを指定すると、'
+        '全てのワークスペースで並列にサブコマンドを実行します')
+
+
+def _setup_leaderboard_args(parser: ArgumentParser) -> None:
+    parser.add_argument(
+        '-n',
+        default=10,
+        help='上位何位まで表示するかを指定します。(デフォルト: 10位)',
+        type=int)
+
+
+def _setup_team_args(parser: ArgumentParser) -> None:
+    parser.add_argument(
+        '--sort',
+        choices=['total', 'average'],
+        default='average',
+        help='順位の付け方を指定します。デフォルトは平均投稿数(合計投稿数÷所属メンバ数)です。')
+    parser.add_argument(
+        '--team',
+        default='team_master.csv',
+        help='メンバとチームを定義づけたCSVファイル')
+    parser.add_argument(
+        '--json', help='JSON形式で結果を出力します')
+
+
+def _comma_list(choices: List[str]) -> Callable[[str], List[str]]:
+    def _parse(s: str) -> List[str]:
+        values = [v for v in s.split(',') if v]
+        for v in values:
+            if v not in choices:
+                raise ArgumentTypeError('invalid choice: {} (choose from {})'
+                                        .format(v, ', '.join(choices)))
+        return values
+    return _parse
+
+
+def _wordcloud(create_parser: CreateParser) -> None:
+    parser = create_parser(
+        'wordcloud', help='MeCabで形態素解析した結果を用いてWordCloudを作成します\n'
+        '--sinceと--until または --day または --week または --month を指定する必要があります。'
+    )
+    parser.add_argument(
+        '-r', '--mecab-rcfile',
+        help='MeCabのリソースファイルパス',
+        required=True)
+    parser.add_argument(
+        '-d', '--mecab-dicdir',
+        help='MeCabの辞書パス',
+        required=True)
+    setup_common_args(setup_token_args(setup_date_range_args(setup_post_args(
+        parser))))
+    parser.add_argument(
+        '--font',
+        default='meiryo.ttc',
+        help='フォントファイル名 (デフォルト: meiryo.ttc)')
+    parser.add_argument(
+        '-u', '--mecab-userdic',
+        help='MeCabのユーザ辞書のパス')
+    parser.add_argument(
+        '--exclude',
+        default='助詞,助動詞',
+        help='除去する品詞をカンマ区切りで指定 (デフォルト: 助詞,助動詞)')
+    parser.add_argument(
+        '--width', type=int, default=1280,
+        help='画像の幅 (デフォルト: 1280px)')
+    parser.add_argument(
+        '--height', type=int, default=720,
+        help='画像の高さ (デフォルト: 720px)')
+    parser.add_argument(
+        '--background', default='white',
+        help='背景色。transparentを指定すると透明。(デフォルト: white)')
+    parser.add_argument(
+        '--max-words', default=200, type=int,
+        help='最大表示単語数 (デフォルト: 200)')
+    parser.add_argument(
+        '--stop-word-file',
+        help='ストップワードを記載したテキストファイルパス (改行や空白区切り)')
+    parser.add_argument(
+        '-j', '--jobs', type=int, default=os.cpu_count() or 1,
+        help='形態素解析を並列に行うプロセス数 (デフォルト: CPU数)')
+    parser.set_defaults(func=_lazy('wordcloud'))
+
+
+def _export(create_parser: CreateParser) -> None:
+    parser = setup_common_args(create_parser(
+        'export', help='users/channels/messagesをParquet等の列指向形式で書き出します。'
+        'messagesは月とチャンネル毎に分割し、再実行時は変更があった分のみ書き出します。'
+        'pyarrowが必要です。'))
+    parser.add_argument(
+        'output', nargs='?', default='export',
+        help='出力先ディレクトリ (デフォルト: export)')
+    parser.add_argument(
+        '--format', choices=['parquet', 'feather'], default='parquet',
+        help='出力形式を指定します。featherはメモリマップして読み込める'
+        '非圧縮のArrow IPC形式です。(デフォルト: parquet)')
+    parser.add_argument(
+        '--full', action='store_true', help='変更の有無に関わらず全て書き出します')
+    parser.set_defaults(func=_lazy('export'))
+
+
+def _migrate(create_parser: CreateParser) -> None:
+    parser = setup_common_args(create_parser(
+        'migrate', help='既存のデータベースを最新の形式に更新します。'
+        '他のサブコマンドも実行時に未適用の更新を自動で適用します。'))
+    parser.add_argument(
+        '--compact', action='store_true',
+        help='メッセージ全体をJSONで保存している行を、頻繁に参照する項目の列と'
+        'それ以外の項目を圧縮した列に変換し、変換前後のサイズと走査時間を表示します')
+    parser.add_argument(
+        '--codec', choices=['zlib', 'zstd'], default='zlib',
+        help='--compactで利用する圧縮方式を指定します。'
+        'zstdにはzstandardパッケージが必要です。(デフォルト: zlib)')
+    parser.add_argument(
+        '--dict-size', type=int, default=32 * 1024,
+        help='--compactで保存済みのメッセージから作成する共有辞書のサイズ(bytes)を'
+        '指定します。zlibでは4096bytesが上限です。0の場合は辞書を利用しません。'
+        '(デフォルト: 32768)')
+    parser.set_defaults(func=_lazy('migrate'))
+
+
+def _serve(create_parser: CreateParser) -> None:
+    parser = create_parser(
+        'serve', help='crontab形式のジョブ表に従い、常駐してサブコマンドを定期的に実行します。'
+        'データベースの接続、Slack APIへの接続、MeCabの辞書を読み込んだプロセスを'
+        'ジョブ間で使い回すため、個別に起動するより速く実行できます。')
+    parser.add_argument(
+        'table',
+        help='ジョブ表のパス。各行に「分 時 日 月 曜日 サブコマンド 引数...」を記載します。'
+        '実行中に更新すると読み込み直します')
+    parser.add_argument(
+        '--once', action='store_true',
+        help='日時の指定に関わらず全てのジョブを記載順に1回ずつ実行して終了します')
+    parser.set_defaults(func=_lazy('serve'))
+
+
+COMMANDS: List[Callable[[CreateParser], None]] = [
+    _collect, _ingest, _leaderboard, _team, _report, _wordcloud, _export,
+    _migrate, _serve,
+]
@@ -1,80 +1,43 @@
-from argparse import ArgumentParser, Namespace
+from argparse import Namespace
 from datetime import datetime, timedelta
 import os
 import sys
-from typing import Tuple, Union, List, Any
+from typing import Dict, Tuple, Union, List, Any, Optional
 
 from slack import WebClient
 
+from .ratelimit import RateLimiter, RateLimitedWebClient
+
 TARGET_SUBTYPES = ('', 'thread_broadcast')
 
+# shared_slack_client()で作成した(トークン, base_url)毎のWebClient
+_clients: Dict[Tuple[str, str], WebClient] = {}
+
 
-def setup_common_args(p: ArgumentParser) -> ArgumentParser:
-    # 共通の引数を設定します.
-    # 親parser.add_argumentではサブパーサのhelpに表示されないため
-    # サブパーサ毎に設定します
-    p.add_argument(
-        '--db', default='slack.sqlite',
-        help='SQLiteのパスを指定します。デフォルトはカレントディレクトリの"slack.sqlite"です')
-    p.add_argument(
-        '--base-url', default='https://api.slack.com/api/',
-        help='Slack APIのURLを指定します (デフォルト: https://api.slack.com/api/)')
-    return p
-
-
-def setup_token_args(p: ArgumentParser) -> ArgumentParser:
-    p.add_argument(
-        '--token',
-        help='APIトークンを指定します。省略した場合はTOKEN環境変数の値が利用されます。')
-    return p
-
-
-def setup_date_range_args(p: ArgumentParser) -> ArgumentParser:
-    p.add_argument(
-        '--since',
-        help='集計開始日時(ISO8601)を指定します',
-        type=datetime_parser)
-    p.add_argument(
-        '--until',
-        help='集計終了日時(ISO8601)を指定します',
-        type=datetime_parser)
-    p.add_argument(
-        '--day', action='store_true',
-        help='昨日の投稿を集計対象とします')
-    p.add_argument(
-        '--week', action='store_true',
-        help='先週の投稿を集計対象とします')
-    p.add_argument(
-        '--month', action='store_true',
-        help='先月の投稿を集計対象とします')
-    p.add_argument(
-        '--this-month', action='store_true',
-        help='今月の投稿を集計対象とします')
-    return p
-
-
-def setup_post_args(p: ArgumentParser) -> ArgumentParser:
-    p.add_argument(
-        '--post',
-        help='ポスト先チャンネルIDを指定します。--dry-run未指定時は必須オプションです')
-    p.add_argument(
-        '--dry-run', action='store_true',
-        help='API投稿を行わず集計のみを行います')
-    return p
-
-
-def datetime_parser(s: str) -> datetime:
-    return datetime.fromisoformat(s)
-
-
-def create_slack_client(args: Namespace) -> WebClient:
+def create_slack_client(
+        args: Namespace, limiter: Optional[RateLimiter] = None
+) -> WebClient:
     # 引数または環境変数よりTokenを取得してSlack WebClientを初期化
     token = args.token or os.environ.get('TOKEN', None)
     if not token:
         print('--token or TOKEN environment variable required',
               file=sys.stderr)
         sys.exit(1)
-    return WebClient(token=token, base_url=args.base_url)
+    return RateLimitedWebClient(
+        limiter=limiter, token=token, base_url=args.base_url)
+
+
+def shared_slack_client(args: Namespace) -> WebClient:
+    """投稿等に利用するWebClientを返します.
+
+    serveで繰り返し実行するジョブが同じWebClientを使い回すよう、
+    (トークン, base_url)毎に作成したものを返します。
+    """
+    key = (args.token or os.environ.get('TOKEN', None) or '', args.base_url)
+    client = _clients.get(key)
+    if client is None:
+        client = _clients[key] = create_slack_client(args)
+    return client
 
 
 def get_date_range(args: Namespace) -> Tuple[datetime, datetime]:
@@ -121,8 +84,14 @@ def get_date_range_str(
         (until - timedelta(days=1)).date().isoformat())
 
 
+def get_time_str(t: datetime) -> str:
+    """日時をISO8601形式で返します. 0時の場合は日付のみを返します."""
+    if t == t.replace(hour=0, minute=0, second=0, microsecond=0):
+        return t.date().isoformat()
+    return t.isoformat()
+
+
 def post(args: Namespace, text_or_blocks: Union[str, List[Any]]) -> None:
-    client = create_slack_client(args)
     if args.post is None:
         print('ポスト先のチャンネルIDを指定してください',
               file=sys.stderr)
@@ -140,4 +109,5 @@ def post(args: Namespace, text_or_blocks: Union[str, List[Any]]) -> None:
         }]
     else:
         blocks = text_or_blocks
-    client.chat_postMessage(channel=args.post, blocks=blocks)
+    shared_slack_client(args).chat_postMessage(
+        channel=args.post, blocks=blocks)
@@ -0,0 +1,88 @@
+import threading
+from typing import Any, Dict, Iterable, Optional, Tuple
+
+from sqlalchemy.orm import Session
+
+from .metrics import metrics
+from .models import db_path, get_meta, Channel, User, DIRECTORY_VERSION
+
+# ユーザ/チャンネルのIDから名前とe-mailを引くプロセス内のキャッシュ。
+# 一度検索したIDはプロセスの終了まで保持し(存在しないIDも含む)、serveのように
+# 同じプロセスでレポートを繰り返し作成する場合もデータベースを検索し直さない。
+# collect/ingestがusers/channelsを書き換えるとmetaのDIRECTORY_VERSIONが
+# 更新されるため、次の検索時にキャッシュを破棄する。
+
+# IN句に1度に指定するIDの数
+_IN_CHUNK = 500
+
+# キャッシュの種類毎の (IDの列, 値の列)
+_COLUMNS: Dict[str, Tuple[Any, Tuple[Any, ...]]] = {
+    'users': (User.id, (User.name, User.email)),
+    'channels': (Channel.id, (Channel.name,)),
+}
+
+
+class Directory:
+    """ユーザ名、ユーザのe-mail、チャンネル名のキャッシュ. スレッドセーフです."""
+
+    def __init__(self) -> None:
+        self._lock = threading.Lock()
+        # キャッシュを作成したデータベースとDIRECTORY_VERSION
+        self._stamp: Optional[Tuple[str, Optional[str]]] = None
+        # 種類毎のIDと値のタプル (存在しないIDはNone)
+        self._entries: Dict[str, Dict[str, Optional[Tuple[Any, ...]]]] = {
+            kind: {} for kind in _COLUMNS}
+
+    def user_names(self, s: Session, ids: Iterable[str]) -> Dict[str, str]:
+        """ユーザIDと名前の辞書を返します. DBに存在しないユーザは含みません."""
+        return {k: v[0] for k, v in self._lookup(s, 'users', ids).items()}
+
+    def user_emails(self, s: Session, ids: Iterable[str]
+                    ) -> Dict[str, Optional[str]]:
+        """ユーザIDとe-mailの辞書を返します. DBに存在しないユーザは含みません."""
+        return {k: v[1] for k, v in self._lookup(s, 'users', ids).items()}
+
+    def channel_names(self, s: Session, ids: Iterable[str]
+                      ) -> Dict[str, str]:
+        """チャンネルIDと名前の辞書を返します. DBに存在しないチャンネルは含みません."""
+        return {k: v[0] for k, v in self._lookup(s, 'channels', ids).items()}
+
+    def clear(self) -> None:
+        """キャッシュを破棄します."""
+        with self._lock:
+            self._stamp = None
+            for entries in self._entries.values():
+                entries.clear()
+
+    def _lookup(self, s: Session, kind: str, ids: Iterable[str]
+                ) -> Dict[str, Tuple[Any, ...]]:
+        ids = set(ids)
+        with self._lock:
+            # SQLiteのエンジンはURLがファイルに依らず同じため、init_dbで
+            # 接続したファイルの絶対パス(またはURL)で区別する
+            stamp = (db_path() or str(s.get_bind().url),
+                     get_meta(s, DIRECTORY_VERSION))
+            if stamp != self._stamp:
+                for entries in self._entries.values():
+                    entries.clear()
+                self._stamp = stamp
+            entries = self._entries[kind]
+            missing = sorted(ids - entries.keys())
+            metrics.inc('directory_lookups_total', len(ids) - len(missing),
+                        kind=kind, result='hit')
+            metrics.inc('directory_lookups_total', len(missing),
+                        kind=kind, result='miss')
+            # SQLiteのバインド変数の上限を超えないよう分割して検索する
+            key, columns = _COLUMNS[kind]
+            for i in range(0, len(missing), _IN_CHUNK):
+                chunk = missing[i:i + _IN_CHUNK]
+                found = {row[0]: tuple(row[1:]) for row in s.query(
+                    key, *columns).filter(key.in_(chunk))}
+                for k in chunk:
+                    entries[k] = found.get(k)
+            return {k: v for k, v in ((k, entries[k]) for k in ids)
+                    if v is not None}
+
+
+# 全サブコマンドで共有するキャッシュ
+directory = Directory()
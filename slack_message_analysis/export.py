@@ -0,0 +1,18 @@
+from argparse import Namespace
+import time
+
+from .columnar import export, require
+from .metrics import metrics
+from .models import init_db, read_transaction
+
+
+def run(args: Namespace) -> None:
+    require()
+    init_db(args.db, args.explain, args.sqlite_profile)
+    started = time.perf_counter()
+    with read_transaction() as s:
+        with metrics.phase('export'):
+            stats = export(s, args.output, args.format, args.full)
+    print('書き出し {}件 ({}行), 変更なし {}件, 削除 {}件 ({:.2f}s)'.format(
+        stats.written, stats.rows, stats.unchanged, stats.removed,
+        time.perf_counter() - started))
@@ -0,0 +1,440 @@
+from argparse import Namespace
+from collections import OrderedDict
+from datetime import datetime
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import json
+import os
+import queue
+import signal
+import sys
+import threading
+import time
+import traceback
+from typing import (
+    Any, Counter, Dict, IO, Iterable, Iterator, List, Optional, Set, Tuple)
+
+from slack.signature import SignatureVerifier
+from sqlalchemy.orm import Session
+
+from .metrics import metrics
+from .models import (
+    channel_row, delete_messages, init_db, message_payload, transaction,
+    upsert_changed, upsert_messages, user_row, Channel, Message, User)
+
+# ingestサブコマンド。Events APIのイベントを受け取りmessages/users/channelsに
+# 反映する。イベントはローカルのHTTPエンドポイント(Events APIのRequest URL)
+# またはイベントログ(JSON Lines)から読み込み、一定の件数または時間毎に
+# 1つのトランザクションでまとめて書き込む。
+# 受け取れなかったイベント(停止中の投稿等)はcollectの定期実行で補完する。
+
+# メッセージイベントのうちconversations.historyのメッセージには無い項目
+_EVENT_ONLY_FIELDS = ('channel', 'event_ts', 'channel_type')
+
+# Slackから再送されたイベントを除くために保持するevent_idの数
+_SEEN_EVENTS = 10000
+
+# IN句に1度に指定するタイムスタンプの数
+_IN_CHUNK = 500
+
+# (channel_id, timestamp)
+SlotKey = Tuple[str, float]
+# 同じ(channel_id, timestamp)のメッセージの(user_id, subtype)毎のメッセージ
+Slot = Dict[Tuple[str, str], Dict[str, Any]]
+
+
+class EventApplier:
+    """イベントをメモリ上のメッセージ/ユーザ/チャンネルに適用し、まとめて書き込みます.
+
+    同じメッセージに対する複数のイベントは受け取った順に適用し、
+    flush()でメッセージ毎に1回だけ書き込みます。
+    """
+
+    def __init__(self) -> None:
+        self.counts = Counter[str]()
+        self._slots: Dict[SlotKey, Slot] = {}
+        # 読み込んだ時点でデータベースに存在した(user_id, subtype)
+        self._stored: Dict[SlotKey, Set[Tuple[str, str]]] = {}
+        self._users: Dict[str, Dict[str, Any]] = {}
+        self._channels: Dict[str, Dict[str, Any]] = {}
+        self._seen: 'OrderedDict[str, None]' = OrderedDict()
+
+    def apply(self, s: Session, envelope: Dict[str, Any]) -> None:
+        """イベントを適用します.
+
+        Args:
+            s: transaction()で得たセッション
+            envelope: Events APIのevent_callback、またはそのeventの値
+        """
+        event_id = envelope.get('event_id')
+        if event_id:
+            if event_id in self._seen:
+                self.counts['duplicate'] += 1
+                return
+            self._seen[event_id] = None
+            if len(self._seen) > _SEEN_EVENTS:
+                self._seen.popitem(last=False)
+        event = envelope.get('event', envelope)
+        kind = event.get('type', '')
+        if kind == 'message':
+            kind = event.get('subtype') or kind
+            self._message(s, event)
+        elif kind in ('reaction_added', 'reaction_removed'):
+            if not self._reaction(s, event, kind == 'reaction_added'):
+                kind = 'unmatched'
+        elif kind in ('channel_created', 'channel_rename'):
+            self._channel(s, event['channel'])
+        elif kind in ('user_change', 'team_join'):
+            self._users[event['user']['id']] = user_row(event['user'])
+        else:
+            kind = 'ignored'
+        self.counts[kind] += 1
+
+    def prefetch(self, s: Session, envelopes: Iterable[Dict[str, Any]]
+                 ) -> None:
+        """イベントが参照するメッセージをまとめて読み込みます.
+
+        メッセージ毎にクエリを発行しないよう、apply()の前に呼び出します。
+        """
+        keys: Dict[str, Set[float]] = {}
+        for e in envelopes:
+            for channel_id, ts in _message_keys(e.get('event', e)):
+                if (channel_id, float(ts)) not in self._slots:
+                    keys.setdefault(channel_id, set()).add(float(ts))
+        for channel_id, timestamps in keys.items():
+            for ts in timestamps:
+                self._slots[channel_id, ts] = {}
+            ordered = sorted(timestamps)
+            for i in range(0, len(ordered), _IN_CHUNK):
+                for m in s.query(*Message.__table__.columns).filter(
+                        Message.channel_id == channel_id,
+                        Message.timestamp.in_(ordered[i:i + _IN_CHUNK])):
+                    self._slots[channel_id, m.timestamp][
+                        m.user_id, m.subtype] = message_payload(m)
+            for ts in timestamps:
+                self._stored[channel_id, ts] = set(self._slots[channel_id, ts])
+
+    def flush(self, s: Session) -> None:
+        """適用済みの変更を書き込みます."""
+        rows, deleted = [], []
+        for (channel_id, ts), slot in self._slots.items():
+            for user_id, subtype in self._stored[channel_id, ts] - set(slot):
+                deleted.append((ts, channel_id, user_id, subtype))
+            for (user_id, subtype), payload in slot.items():
+                rows.append(dict(timestamp=ts, channel_id=channel_id,
+                                 user_id=user_id, subtype=subtype,
+                                 raw=payload))
+        delete_messages(s, deleted)
+        upsert_messages(s, rows)
+        upsert_changed(s, User.__table__, self._users.values())
+        upsert_changed(s, Channel.__table__, self._channels.values())
+        self._clear()
+
+    def discard(self, envelopes: Iterable[Dict[str, Any]]) -> None:
+        """反映に失敗したイベントの適用結果を破棄します.
+
+        書き込んでいない変更を次のflush()に持ち越さないよう破棄し、
+        Slackが再送した同じイベントを重複として無視しないようevent_idを忘れます。
+        """
+        self._clear()
+        for e in envelopes:
+            self._seen.pop(e.get('event_id'), None)  # type: ignore
+
+    def _clear(self) -> None:
+        self._slots.clear()
+        self._stored.clear()
+        self._users.clear()
+        self._channels.clear()
+
+    def _slot(self, s: Session, channel_id: str, ts: str) -> Slot:
+        key = (channel_id, float(ts))
+        if key not in self._slots:
+            slot = {
+                (m.user_id, m.subtype): message_payload(m)
+                for m in s.query(*Message.__table__.columns).filter(
+                    Message.channel_id == channel_id,
+                    Message.timestamp == key[1])}
+            self._slots[key] = slot
+            self._stored[key] = set(slot)
+        return self._slots[key]
+
+    def _message(self, s: Session, event: Dict[str, Any]) -> None:
+        subtype = event.get('subtype', '')
+        channel_id = event['channel']
+        if subtype == 'message_deleted':
+            self._slot(s, channel_id, event['deleted_ts']).clear()
+            prev = event.get('previous_message') or {}
+            if _is_reply(prev):
+                self._reply(s, channel_id, prev, -1)
+            return
+        edited = subtype in ('message_changed', 'message_replied')
+        m = {k: v for k, v in (event['message'] if edited else event).items()
+             if k not in _EVENT_ONLY_FIELDS}
+        if not m.get('user'):
+            # collectと同様にユーザIDが含まれないメッセージは収集対象外
+            return
+        slot = self._slot(s, channel_id, m['ts'])
+        key = (m['user'], m.get('subtype', ''))
+        is_new = key not in slot
+        # 編集イベント等に含まれない項目(reactions等)は保存済みの値を残す
+        slot[key] = dict(slot.get(key, {}), **m)
+        if is_new and not edited and _is_reply(m):
+            self._reply(s, channel_id, m, 1)
+
+    def _reply(self, s: Session, channel_id: str, m: Dict[str, Any],
+               delta: int) -> None:
+        # スレッドの親メッセージの返信数と最新の返信を更新する
+        for parent in self._slot(s, channel_id, m['thread_ts']).values():
+            parent['thread_ts'] = m['thread_ts']
+            parent['reply_count'] = max(
+                0, (parent.get('reply_count') or 0) + delta)
+            if delta > 0:
+                parent['latest_reply'] = max(
+                    parent.get('latest_reply') or m['ts'], m['ts'], key=float)
+                users = parent.setdefault('reply_users', [])
+                if m['user'] not in users:
+                    users.append(m['user'])
+                    parent['reply_users_count'] = len(users)
+
+    def _reaction(self, s: Session, event: Dict[str, Any], added: bool
+                  ) -> bool:
+        item = event.get('item') or {}
+        if item.get('type') != 'message':
+            return False
+        slot = self._slot(s, item['channel'], item['ts'])
+        for payload in slot.values():
+            _update_reactions(payload, event['reaction'], event['user'], added)
+        return bool(slot)
+
+    def _channel(self, s: Session, c: Dict[str, Any]) -> None:
+        # channel_rename等のイベントのチャンネルは一部の項目のみを持つため
+        # 保存済みの項目に上書きする
+        if c['id'] in self._channels:
+            raw = self._channels[c['id']]['raw']
+        else:
+            raw = s.query(Channel.raw).filter(
+                Channel.id == c['id']).scalar() or {}
+        self._channels[c['id']] = channel_row(dict(raw, **c))
+
+
+def run(args: Namespace) -> None:
+    secret = args.signing_secret or os.environ.get('SLACK_SIGNING_SECRET')
+    if args.listen and not secret:
+        # 署名を検証しない場合、誰でもメッセージを削除・書き換えできてしまう
+        if not args.insecure:
+            print('--signing-secretまたはSLACK_SIGNING_SECRET環境変数を'
+                  '指定してください (署名を検証しない場合は--insecure)',
+                  file=sys.stderr)
+            sys.exit(1)
+        print('--insecureが指定されたためリクエストの署名を検証しません',
+              file=sys.stderr)
+    init_db(args.db, args.explain, args.sqlite_profile)
+    applier = EventApplier()
+    if args.replay:
+        with open(args.replay, encoding='utf8') as f:
+            ingest(applier, read_log(f), args.batch_size, args.flush_interval)
+        print(_summary(applier.counts))
+        return
+
+    host, _, port = args.listen.rpartition(':')
+    events: 'queue.Queue[Dict[str, Any]]' = queue.Queue()
+    server = ThreadingHTTPServer(
+        (host or '127.0.0.1', int(port)),
+        _handler(events, SignatureVerifier(secret) if secret else None))
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    print('Listening on http://{}:{}/'.format(*server.server_address),
+          file=sys.stderr, flush=True)
+
+    stop = threading.Event()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        signal.signal(sig, lambda *_: stop.set())
+    log = open(args.log, 'a', encoding='utf8') if args.log else None
+    try:
+        ingest(applier, _receive(events, stop, args.flush_interval),
+               args.batch_size, args.flush_interval, log, keep_going=True)
+    finally:
+        server.shutdown()
+        server.server_close()
+        if log is not None:
+            log.close()
+    print(_summary(applier.counts), file=sys.stderr)
+
+
+def ingest(applier: EventApplier,
+           events: Iterable[Optional[Dict[str, Any]]], batch_size: int,
+           flush_interval: float, log: Optional[IO[str]] = None,
+           keep_going: bool = False) -> None:
+    """イベントをbatch_size件またはflush_interval秒毎にまとめて反映します.
+
+    Args:
+        applier: イベントを適用するEventApplier
+        events: イベントのイテラブル。Noneは経過時間の確認のみを行います
+        batch_size: 1回のトランザクションで反映する最大のイベント数
+        flush_interval: 最初のイベントを受け取ってから反映するまでの最大の秒数
+        log: 指定した場合は反映する前にイベントをJSON Lines形式で追記します
+        keep_going: Trueの場合は反映に失敗しても標準エラー出力に表示して続けます
+    """
+    batch: List[Dict[str, Any]] = []
+    started = time.monotonic()
+    for e in events:
+        if e is not None:
+            if not batch:
+                started = time.monotonic()
+            batch.append(e)
+        if batch and (len(batch) >= batch_size or
+                      time.monotonic() - started >= flush_interval):
+            _apply(applier, batch, log, keep_going)
+            batch = []
+    if batch:
+        _apply(applier, batch, log, keep_going)
+
+
+def read_log(f: IO[str]) -> Iterator[Dict[str, Any]]:
+    """イベントログ(1行に1つのイベントのJSON)を読み込みます. 空行は無視します."""
+    for line in f:
+        if line.strip():
+            yield json.loads(line)
+
+
+def _apply(applier: EventApplier, batch: List[Dict[str, Any]],
+           log: Optional[IO[str]], keep_going: bool) -> None:
+    # 反映に失敗してもイベントログから再実行できるよう先に書き出す
+    if log is not None:
+        for e in batch:
+            log.write(json.dumps(e, ensure_ascii=False) + '\n')
+        log.flush()
+    counts = applier.counts.copy()
+    try:
+        with metrics.phase('apply'), transaction() as s:
+            applier.prefetch(s, batch)
+            for e in batch:
+                applier.apply(s, e)
+            applier.flush(s)
+    except Exception:
+        applier.discard(batch)
+        applier.counts = counts
+        if not keep_going:
+            raise
+        traceback.print_exc()
+        metrics.inc('event_batches_failed_total')
+        return
+    metrics.inc('events_applied_total', len(batch))
+    print('[{}] {}'.format(
+        datetime.now().isoformat(sep=' ', timespec='seconds'),
+        _summary(applier.counts - counts)), file=sys.stderr, flush=True)
+
+
+def _receive(events: 'queue.Queue[Dict[str, Any]]', stop: threading.Event,
+             flush_interval: float) -> Iterator[Optional[Dict[str, Any]]]:
+    while not stop.is_set():
+        try:
+            yield events.get(timeout=min(1.0, flush_interval))
+        except queue.Empty:
+            yield None
+    # 停止までに受け取ったイベントを反映する
+    while True:
+        try:
+            yield events.get_nowait()
+        except queue.Empty:
+            return
+
+
+def _handler(events: 'queue.Queue[Dict[str, Any]]',
+             verifier: Optional[SignatureVerifier]) -> Any:
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = 'HTTP/1.1'
+
+        def log_message(self, *args: Any) -> None:
+            pass
+
+        def do_POST(self) -> None:
+            n = int(self.headers.get('Content-Length') or 0)
+            body = self.rfile.read(n)
+            if verifier is not None and not verifier.is_valid_request(
+                    body, dict(self.headers)):
+                metrics.inc('events_rejected_total')
+                self._send(401, {'ok': False})
+                return
+            try:
+                envelope = json.loads(body)
+            except ValueError:
+                self._send(400, {'ok': False})
+                return
+            # Request URLの登録時の確認
+            if envelope.get('type') == 'url_verification':
+                self._send(200, {'challenge': envelope.get('challenge')})
+                return
+            # Slackは3秒以内に応答しないと再送するため、反映を待たずに応答する
+            events.put(envelope)
+            self._send(200, {'ok': True})
+
+        def _send(self, status: int, body: Dict[str, Any]) -> None:
+            b = json.dumps(body).encode('utf8')
+            self.send_response(status)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(b)))
+            self.end_headers()
+            self.wfile.write(b)
+    return Handler
+
+
+def _message_keys(event: Dict[str, Any]) -> Iterator[Tuple[str, str]]:
+    # イベントが参照するメッセージの(channel_id, ts)
+    kind = event.get('type')
+    if kind in ('reaction_added', 'reaction_removed'):
+        item = event.get('item') or {}
+        if item.get('type') == 'message':
+            yield item['channel'], item['ts']
+    if kind != 'message':
+        return
+    subtype = event.get('subtype', '')
+    if subtype == 'message_deleted':
+        yield event['channel'], event['deleted_ts']
+        m = event.get('previous_message') or {}
+    elif subtype in ('message_changed', 'message_replied'):
+        yield event['channel'], event['message']['ts']
+        return
+    else:
+        yield event['channel'], event['ts']
+        m = event
+    if _is_reply(m):
+        yield event['channel'], m['thread_ts']
+
+
+def _is_reply(m: Dict[str, Any]) -> bool:
+    return bool(m.get('thread_ts')) and m.get('thread_ts') != m.get('ts')
+
+
+def _update_reactions(payload: Dict[str, Any], name: str, user_id: str,
+                      added: bool) -> None:
+    reactions = payload.get('reactions') or []
+    r = next((r for r in reactions if r['name'] == name), None)
+    if added:
+        if r is None:
+            r = dict(name=name, users=[], count=0)
+            reactions.append(r)
+        if user_id in r['users']:
+            return
+        r['users'].append(user_id)
+        r['count'] += 1
+    else:
+        if r is None:
+            return
+        if user_id in r['users']:
+            r['users'].remove(user_id)
+        elif r['count'] <= len(r['users']):
+            return
+        # usersが省略されている場合は省略された分から減らす
+        r['count'] -= 1
+        if r['count'] <= 0:
+            reactions.remove(r)
+    if reactions:
+        payload['reactions'] = reactions
+    else:
+        payload.pop('reactions', None)
+
+
+def _summary(counts: Counter[str]) -> str:
+    return '{}件のイベントを反映しました ({})'.format(
+        sum(counts.values()), ', '.join(
+            '{} {}'.format(k, v) for k, v in sorted(counts.items())))
@@ -0,0 +1,115 @@
+import http.client
+import ssl
+import threading
+import time
+from typing import Any, Dict, Optional, Tuple
+from urllib.parse import urlsplit
+
+from .metrics import metrics
+
+# Slack APIへのHTTP接続をプロセス内で使い回すコネクションプール。
+# slackclientの同期WebClientはリクエスト毎にurllibで接続(TCP/TLSハンドシェイク)
+# し直すため、RateLimitedWebClientはこのプールのKeep-Alive接続で送信する。
+# http.clientの接続はスレッドセーフではないため、接続はスレッド毎に保持する。
+
+# この秒数以上使われていない接続はサーバ側で切断されている可能性が高いため
+# 再利用せずに接続し直す
+IDLE_TIMEOUT = 60.0
+
+# 再利用した接続がサーバ側で切断されていた場合に発生する例外
+_STALE_ERRORS = (http.client.RemoteDisconnected, ConnectionResetError,
+                 BrokenPipeError)
+
+
+class ConnectionPool:
+    """スレッド毎・接続先毎にKeep-Alive接続を保持します."""
+
+    def __init__(self) -> None:
+        self._local = threading.local()
+        self._ssl_context: Optional[ssl.SSLContext] = None
+        self._lock = threading.Lock()
+
+    def request(self, url: str, body: Optional[bytes],
+                headers: Dict[str, Any], timeout: float,
+                context: Optional[ssl.SSLContext] = None,
+                idempotent: bool = True) -> Tuple[int, Any, bytes]:
+        """POSTリクエストを送信し、(ステータス, ヘッダ, 本文)を返します.
+
+        再利用した接続が切断されていた場合は接続し直して再送します。
+        サーバが既に処理した可能性があるリクエストを二重に送らないよう、
+        idempotentがFalseの場合は接続を再利用せずに新しい接続で送信します。
+
+        Args:
+            url: http(s)のURL
+            body: リクエストの本文
+            headers: リクエストヘッダ
+            timeout: 接続と受信のタイムアウト(秒)
+            context: HTTPSで利用するSSLContext。Noneの場合は既定の設定
+            idempotent: 再送してよい(副作用の無い)リクエストか
+        """
+        u = urlsplit(url)
+        path = u.path + ('?' + u.query if u.query else '')
+        key = (u.scheme, u.hostname or '', u.port, id(context))
+        while True:
+            conn, reused = self._connection(key, timeout, context, idempotent)
+            try:
+                conn.request('POST', path, body=body, headers=headers)
+                resp = conn.getresponse()
+                data = resp.read()
+            except _STALE_ERRORS:
+                conn.close()
+                if not reused:
+                    raise
+                metrics.inc('http_reconnects_total')
+                continue
+            except Exception:
+                conn.close()
+                raise
+            if resp.will_close:
+                conn.close()
+            else:
+                self._connections()[key] = (conn, time.monotonic())
+            return resp.status, resp.headers, data
+
+    def close(self) -> None:
+        """呼び出し元のスレッドの接続を全て閉じます."""
+        for conn, _ in self._connections().values():
+            conn.close()
+        self._connections().clear()
+
+    def _connections(self) -> Dict[Any, Tuple[Any, float]]:
+        if not hasattr(self._local, 'connections'):
+            self._local.connections = {}
+        return self._local.connections
+
+    def _connection(self, key: Tuple[str, str, Optional[int], int],
+                    timeout: float, context: Optional[ssl.SSLContext],
+                    reuse: bool) -> Tuple[Any, bool]:
+        entry = self._connections().pop(key, None)
+        if entry is not None:
+            conn, used = entry
+            if reuse and time.monotonic() - used < IDLE_TIMEOUT:
+                conn.timeout = timeout
+                if conn.sock is not None:
+                    conn.sock.settimeout(timeout)
+                metrics.inc('http_connections_reused_total')
+                return conn, True
+            conn.close()
+        scheme, host, port, _ = key
+        metrics.inc('http_connections_opened_total')
+        if scheme == 'https':
+            return http.client.HTTPSConnection(
+                host, port, timeout=timeout,
+                context=context or self._default_context()), False
+        return http.client.HTTPConnection(host, port, timeout=timeout), False
+
+    def _default_context(self) -> ssl.SSLContext:
+        # 証明書ストアの読み込みは数msかかるため1度だけ行う
+        with self._lock:
+            if self._ssl_context is None:
+                self._ssl_context = ssl.create_default_context()
+            return self._ssl_context
+
+
+# プロセス全体で共有するコネクションプール
+pool = ConnectionPool()
@@ -1,137 +1,231 @@
-from argparse import ArgumentParser, Namespace
+from argparse import Namespace
+import csv
 from datetime import datetime
-from typing import Callable, Counter
+import heapq
+import sys
+from typing import Any, Counter, Dict, List, Tuple
 
-from sqlalchemy import func
+from sqlalchemy.orm import Session
 
-from .common import (
-    setup_common_args, setup_token_args, setup_date_range_args, post,
-    setup_post_args, get_date_range, get_date_range_str, TARGET_SUBTYPES)
-from .models import init_db, transaction, Channel, User, Message
+from .common import post, get_date_range, get_date_range_str, get_time_str
+from .directory import directory
+from .metrics import metrics
+from .models import init_db, read_transaction
+from .reports import aggregate, aggregate_series, Ranking, Totals
 
-
-def init_argparser(create_parser: Callable[..., ArgumentParser]) -> None:
-    parser = setup_common_args(setup_token_args(setup_date_range_args(
-        setup_post_args(create_parser(
-            'leaderboard', help='ユーザごとの発言/リアクション数、チャンネルごとの発言数、'
-            'リアクションの利用数、チーム単位の発言数を集計し順位表を作成します。\n'
-            '--sinceと--until または --day または --week または --month を指定する必要があります。'
-        )))))
-    parser.add_argument(
-        '-n',
-        default=10,
-        help='上位何位まで表示するかを指定します。(デフォルト: 10位)',
-        type=int)
-    parser.set_defaults(func=run)
+# 順位表の種類 (集計器のsource) と、キーを名前に変換するか
+_RANKINGS = (('user_posts', 'users'), ('channel_posts', 'channels'),
+             ('reaction_users', 'users'), ('reactions', None))
 
 
 def run(args: Namespace) -> None:
-    init_db(args.db)
+    if args.merge:
+        print('--mergeには--workspacesの指定が必要です', file=sys.stderr)
+        sys.exit(1)
+    init_db(args.db, args.explain, args.sqlite_profile)
     since, until = get_date_range(args)
 
-    _user_posts(since, until, args)
-    _channel_posts(since, until, args)
-    _reactions(since, until, args)
-
-
-def _user_posts(since: datetime, until: datetime, args: Namespace) -> None:
-    with transaction() as s:
-        sq = s.query(
-            Message.user_id.label('user_id'),
-            func.count(Message.user_id).label('count'),
-        ).filter(
-            Message.timestamp >= since.timestamp(),
-            Message.timestamp < until.timestamp(),
-            Message.subtype.in_(TARGET_SUBTYPES),
-        ).group_by(
-            Message.user_id,
-        ).order_by(
-            func.count(Message.user_id).desc(),
-        ).limit(args.n).subquery()
-        q = s.query(sq.c.count, User.name).join(User, sq.c.user_id == User.id)
-
-        output = [
-            '{} の発言数ランキング'.format(get_date_range_str(since, until, args))]
-        for i, (count, name) in enumerate(q):
-            output.append('{}. {} ({} posts)'.format(i + 1, name, count))
-
-    print('\n'.join(output))
-    print()
-    if not args.dry_run and len(output) > 1:
-        post(args, '\n'.join(output))
-
-
-def _channel_posts(since: datetime, until: datetime, args: Namespace) -> None:
-    with transaction() as s:
-        sq = s.query(
-            Message.channel_id.label('channel_id'),
-            func.count(Message.channel_id).label('count'),
-        ).filter(
-            Message.timestamp >= since.timestamp(),
-            Message.timestamp < until.timestamp(),
-            Message.subtype.in_(TARGET_SUBTYPES),
-        ).group_by(
-            Message.channel_id,
-        ).order_by(
-            func.count(Message.channel_id).desc(),
-        ).limit(args.n).subquery()
-        q = s.query(
-            sq.c.count, Channel.name,
-        ).join(Channel, sq.c.channel_id == Channel.id)
-
-        output = [
-            '{} の人気チャンネルランキング'.format(get_date_range_str(since, until, args))]
-        for i, (count, name) in enumerate(q):
-            output.append('{}. #{} ({} posts)'.format(i + 1, name, count))
-
-    print('\n'.join(output))
-    print()
-    if not args.dry_run and len(output) > 1:
-        post(args, '\n'.join(output))
-
-
-def _reactions(since: datetime, until: datetime, args: Namespace) -> None:
-    user_counts = Counter[str]()
-    reaction_counts = Counter[str]()
-
-    with transaction() as s:
-        q = s.query(Message).filter(
-            Message.timestamp >= since.timestamp(),
-            Message.timestamp < until.timestamp(),
-            Message.subtype.in_(TARGET_SUBTYPES))
-
-        for m in q:
-            reactions = m.raw.get('reactions', [])
-            for r in reactions:
-                user_counts.update({
-                    user_id: 1 for user_id in r.get('users', [])})
-                reaction_counts[r['name']] += r['count']
-
-        user_leaderboard = []
-        for user_id, count in user_counts.most_common(args.n):
-            name = s.query(User.name).filter(User.id == user_id).scalar()
-            if name is None:
-                continue
-            user_leaderboard.append((name, count))
-
-    output_user = [
-        '{} のリアクション数ランキング'.format(
-            get_date_range_str(since, until, args))]
-    for i, (name, count) in enumerate(user_leaderboard):
+    if args.bucket:
+        with read_transaction() as s:
+            with metrics.phase('aggregate'):
+                series = aggregate_series(
+                    s, since, until, args.bucket, lambda: aggregators(args),
+                    args.backend, args.from_export)
+            with metrics.phase('render'):
+                rows = render_series(s, series)
+        csv.writer(sys.stdout, lineterminator='\n').writerows(rows)
+        return
+
+    rankings = aggregators(args)
+    with read_transaction() as s:
+        with metrics.phase('aggregate'):
+            aggregate(s, since, until, rankings.values(), args.backend,
+                      args.from_export)
+        with metrics.phase('render'):
+            outputs = render(s, rankings, since, until, args)
+    with metrics.phase('post'):
+        publish(outputs, args)
+
+
+def aggregators(args: Namespace) -> Dict[str, Ranking]:
+    """順位表の作成に必要な集計器を返します."""
+    return {source: Ranking(source, args.n) for source in (
+        'user_posts', 'channel_posts', 'reaction_users', 'reactions')}
+
+
+def render(s: Session, rankings: Dict[str, Ranking], since: datetime,
+           until: datetime, args: Namespace) -> List[List[str]]:
+    """集計結果から順位表(行の配列)を作成します.
+
+    Args:
+        s: transaction()で得たセッション (ユーザ名/チャンネル名の取得に利用)
+        rankings: run_reports()で集計済みのaggregators()の戻り値
+        since: 集計開始日時
+        until: 集計終了日時
+        args: コマンドライン引数
+    Returns:
+        発言数、人気チャンネル、リアクション数、人気リアクションの順位表
+    """
+    period = get_date_range_str(since, until, args)
+    user_posts = rankings['user_posts'].result()
+    channel_posts = rankings['channel_posts'].result()
+    reaction_users = rankings['reaction_users'].result()
+    users = directory.user_names(
+        s, [k for k, _ in user_posts + reaction_users])
+    channels = directory.channel_names(s, [k for k, _ in channel_posts])
+
+    return _lines(period, _named(user_posts, users),
+                  _named(channel_posts, channels),
+                  _named(reaction_users, users),
+                  rankings['reactions'].result())
+
+
+def partial_results(args: Namespace) -> Dict[str, List[Tuple[str, str, int]]]:
+    """ワークスペースを横断する順位表のために1つのワークスペースを集計します.
+
+    ユーザ/チャンネルはワークスペース毎に異なるため上位-n件のみを、
+    リアクションは名前毎に合算するため全件を返します。
+
+    Args:
+        args: ワークスペースのdbを指定したコマンドライン引数
+    Returns:
+        順位表の種類毎の (ID, 名前, 件数) の配列
+    """
+    init_db(args.db, args.explain, args.sqlite_profile)
+    since, until = get_date_range(args)
+    aggregators: Dict[str, Totals] = {
+        source: Ranking(source, args.n) if kind else Totals(source)
+        for source, kind in _RANKINGS}
+    with read_transaction() as s:
+        with metrics.phase('aggregate'):
+            aggregate(s, since, until, aggregators.values(), args.backend,
+                      args.from_export)
+        with metrics.phase('render'):
+            ranked = {source: a.result() if isinstance(a, Ranking)
+                      else list(a.counts.items())
+                      for source, a in aggregators.items()}
+            names = {
+                'users': directory.user_names(s, [
+                    k for source in ('user_posts', 'reaction_users')
+                    for k, _ in ranked[source]]),
+                'channels': directory.channel_names(
+                    s, [k for k, _ in ranked['channel_posts']])}
+    results = {}
+    for source, kind in _RANKINGS:
+        if kind:
+            results[source] = [(k, names[kind][k], count)
+                               for k, count in ranked[source]
+                               if k in names[kind]]
+        else:
+            results[source] = [(k, k, count) for k, count in ranked[source]]
+    return results
+
+
+def publish_merged(
+        results: List[Tuple[str, Dict[str, List[Tuple[str, str, int]]]]],
+        args: Namespace) -> None:
+    """ワークスペース毎のpartial_results()を合算した順位表を表示/投稿します.
+
+    ユーザ/チャンネルは「名前 (ワークスペース名)」として区別し、
+    リアクションは名前毎に件数を合計します。
+
+    Args:
+        results: ワークスペース名とpartial_results()の戻り値の配列
+        args: コマンドライン引数 (投稿には--token/--postを利用します)
+    """
+    since, until = get_date_range(args)
+    merged: Dict[str, Counter[Tuple[str, str]]] = {
+        source: Counter() for source, _ in _RANKINGS}
+    for workspace, ranked in results:
+        for source, kind in _RANKINGS:
+            for key, name, count in ranked[source]:
+                if kind:
+                    key = '{}/{}'.format(workspace, key)
+                    name = '{} ({})'.format(name, workspace)
+                merged[source][(key, name)] += count
+    top = {source: [(name, count) for (_, name), count in heapq.nsmallest(
+        args.n, counts.items(), key=lambda x: (-x[1], x[0][0]))]
+        for source, counts in merged.items()}
+    publish(_lines(get_date_range_str(since, until, args), top['user_posts'],
+                   top['channel_posts'], top['reaction_users'],
+                   top['reactions']), args)
+
+
+def render_series(s: Session,
+                  series: List[Tuple[datetime, datetime, Dict[str, Ranking]]]
+                  ) -> List[List[Any]]:
+    """期間毎の集計結果から順位表の時系列(CSVの行の配列)を作成します.
+
+    Args:
+        s: transaction()で得たセッション (ユーザ名/チャンネル名の取得に利用)
+        series: aggregate_series()で集計済みの期間毎のaggregators()の戻り値
+    Returns:
+        見出しと、期間(開始/終了日時)、順位表の種類、順位、ID、名前、件数の行
+    """
+    results = [(since, until, {source: r.result()
+                               for source, r in rankings.items()})
+               for since, until, rankings in series]
+    ids: Dict[str, List[str]] = {'users': [], 'channels': []}
+    for _, _, ranked in results:
+        for source, kind in _RANKINGS:
+            if kind:
+                ids[kind] += [k for k, _ in ranked[source]]
+    names = {'users': directory.user_names(s, ids['users']),
+             'channels': directory.channel_names(s, ids['channels'])}
+
+    rows: List[List[Any]] = [
+        ['since', 'until', 'ranking', 'rank', 'id', 'name', 'count']]
+    for since, until, ranked in results:
+        for source, kind in _RANKINGS:
+            if kind:
+                # DBに存在しないユーザ/チャンネルは順位表から除く
+                named = [(k, names[kind][k], count)
+                         for k, count in ranked[source] if k in names[kind]]
+            else:
+                named = [(k, k, count) for k, count in ranked[source]]
+            for i, (key, name, count) in enumerate(named):
+                rows.append([get_time_str(since), get_time_str(until),
+                             source, i + 1, key, name, count])
+    return rows
+
+
+def publish(outputs: List[List[str]], args: Namespace) -> None:
+    """順位表を表示し、--dry-run未指定時は投稿します. 空の順位表は投稿しません."""
+    for output in outputs:
+        print('\n'.join(output))
+        print()
+    if args.dry_run:
+        return
+    for output in outputs:
+        if len(output) > 1:
+            post(args, '\n'.join(output))
+
+
+def _named(ranking: List[Tuple[str, int]], names: Dict[str, str]
+           ) -> List[Tuple[str, int]]:
+    # DBに存在しないユーザ/チャンネルは順位表から除く
+    return [(names[k], count) for k, count in ranking if k in names]
+
+
+def _lines(period: str, user_posts: List[Tuple[str, int]],
+           channel_posts: List[Tuple[str, int]],
+           reaction_users: List[Tuple[str, int]],
+           reactions: List[Tuple[str, int]]) -> List[List[str]]:
+    # 名前と件数の組の配列から4種類の順位表を作成する
+    output_posts = ['{} の発言数ランキング'.format(period)]
+    for i, (name, count) in enumerate(user_posts):
+        output_posts.append('{}. {} ({} posts)'.format(i + 1, name, count))
+
+    output_channels = ['{} の人気チャンネルランキング'.format(period)]
+    for i, (name, count) in enumerate(channel_posts):
+        output_channels.append('{}. #{} ({} posts)'.format(i + 1, name, count))
+
+    output_user = ['{} のリアクション数ランキング'.format(period)]
+    for i, (name, count) in enumerate(reaction_users):
         output_user.append('{}. {} ({} reactions)'.format(i + 1, name, count))
-    print('\n'.join(output_user))
-    print()
 
-    output_reaction = [
-        '{} の人気リアクションランキング'.format(
-            get_date_range_str(since, until, args))]
-    for i, (name, count) in enumerate(reaction_counts.most_common(args.n)):
+    output_reaction = ['{} の人気リアクションランキング'.format(period)]
+    for i, (name, count) in enumerate(reactions):
         output_reaction.append('{}. :{}: ({} 回)'.format(i + 1, name, count))
-    print('\n'.join(output_reaction))
-    print()
-
-    if not args.dry_run:
-        if len(output_user) > 1:
-            post(args, '\n'.join(output_user))
-        if len(output_reaction) > 1:
-            post(args, '\n'.join(output_reaction))
+
+    return [output_posts, output_channels, output_user, output_reaction]
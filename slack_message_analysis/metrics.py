@@ -0,0 +1,182 @@
+from contextlib import contextmanager
+import json
+import os
+import sys
+import threading
+import time
+from typing import Any, Dict, Iterator, List, Optional, Tuple
+
+# 実行時の計測値(フェーズ毎の所要時間とカウンタ)の収集。
+# cli.mainで--metrics指定時に実行終了後にJSONまたはPrometheusのtextfile形式で
+# 書き出す。計測はフラグの有無に関わらず常に行う(いずれも軽量な加算のみ)。
+
+PREFIX = 'slack_message_analysis_'
+
+Labels = Tuple[Tuple[str, str], ...]
+
+
+class Metrics:
+    """フェーズ毎の所要時間とラベル付きカウンタを保持します. スレッドセーフです."""
+
+    def __init__(self) -> None:
+        self.command = ''
+        self.started = time.time()
+        self._phases: Dict[str, List[float]] = {}
+        self._counters: Dict[Tuple[str, Labels], float] = {}
+        self._lock = threading.Lock()
+
+    def reset(self, command: str) -> None:
+        """計測値を消去し、commandの計測を開始します."""
+        with self._lock:
+            self.command = command
+            self.started = time.time()
+            self._phases.clear()
+            self._counters.clear()
+
+    @contextmanager
+    def phase(self, name: str) -> Iterator[None]:
+        """ブロックの経過時間とCPU時間(プロセス全体)をフェーズとして記録します.
+
+        同じ名前のフェーズは合算されます。
+        """
+        wall, cpu = time.perf_counter(), time.process_time()
+        try:
+            yield
+        finally:
+            wall = time.perf_counter() - wall
+            cpu = time.process_time() - cpu
+            with self._lock:
+                p = self._phases.setdefault(name, [0.0, 0.0, 0])
+                p[0] += wall
+                p[1] += cpu
+                p[2] += 1
+
+    def inc(self, name: str, value: float = 1, **labels: str) -> None:
+        """カウンタに値を加算します.
+
+        Args:
+            name: カウンタ名 (回数は ``_total``、秒数は ``_seconds`` で終える)
+            value: 加算する値
+            labels: カウンタのラベル
+        """
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            self._counters[key] = self._counters.get(key, 0) + value
+
+    def get(self, name: str, **labels: str) -> float:
+        return self._counters.get((name, tuple(sorted(labels.items()))), 0)
+
+    def to_dict(self) -> Dict[str, Any]:
+        with self._lock:
+            return {
+                'command': self.command,
+                'started': self.started,
+                'phases': {
+                    name: {'wall_seconds': p[0], 'cpu_seconds': p[1],
+                           'count': int(p[2])}
+                    for name, p in self._phases.items()},
+                'counters': [
+                    {'name': name, 'labels': dict(labels), 'value': value}
+                    for (name, labels), value in sorted(
+                        self._counters.items())],
+            }
+
+    def to_prometheus(self) -> str:
+        """Prometheusのnode_exporterのtextfile形式で返します."""
+        d = self.to_dict()
+        base = {'command': d['command']}
+        samples: Dict[str, List[Tuple[Dict[str, str], float]]] = {}
+        for name, p in d['phases'].items():
+            for k in ('wall_seconds', 'cpu_seconds'):
+                samples.setdefault('phase_' + k, []).append(
+                    (dict(base, phase=name), p[k]))
+        for c in d['counters']:
+            samples.setdefault(c['name'], []).append(
+                (dict(base, **c['labels']), c['value']))
+        samples['last_run_timestamp_seconds'] = [(base, d['started'])]
+
+        lines = []
+        for name, values in samples.items():
+            kind = 'counter' if name.endswith('_total') else 'gauge'
+            lines.append('# TYPE {}{} {}'.format(PREFIX, name, kind))
+            for labels, value in values:
+                lines.append('{}{}{{{}}} {}'.format(
+                    PREFIX, name, ','.join(
+                        '{}="{}"'.format(k, _escape(v))
+                        for k, v in sorted(labels.items())), repr(value)))
+        return '\n'.join(lines) + '\n'
+
+    def write(self, path: str) -> None:
+        """計測値を書き出します.
+
+        Args:
+            path: 出力先。拡張子が ``.prom`` の場合はPrometheusのtextfile形式、
+                それ以外はJSON形式。``-`` の場合は標準エラー出力にJSONを出力します
+        """
+        if path == '-':
+            json.dump(self.to_dict(), sys.stderr, ensure_ascii=False,
+                      indent=2)
+            print(file=sys.stderr)
+            return
+        if path.endswith('.prom'):
+            body = self.to_prometheus()
+        else:
+            body = json.dumps(self.to_dict(), ensure_ascii=False, indent=2)
+        # node_exporterが書き込み途中のファイルを読まないよう置き換える
+        tmp = path + '.tmp'
+        with open(tmp, 'w', encoding='utf8') as f:
+            f.write(body)
+        os.replace(tmp, path)
+
+
+def _escape(v: Any) -> str:
+    return str(v).replace('\\', '\\\\').replace('"', '\\"').replace(
+        '\n', '\\n')
+
+
+# プロセス全体で共有する計測値
+metrics = Metrics()
+
+
+class Profiler:
+    """--profile/--tracemallocの指定に応じてcProfile/tracemallocを実行します.
+
+    Args:
+        profile: cProfileの結果(pstats形式)の出力先。Noneの場合は実行しない
+        tracemalloc_top: tracemallocでメモリ確保の多い箇所を何件表示するか。
+            0の場合は実行しない
+    """
+
+    def __init__(self, profile: Optional[str] = None,
+                 tracemalloc_top: int = 0) -> None:
+        self.profile = profile
+        self.tracemalloc_top = tracemalloc_top
+        self._profiler: Any = None
+
+    def start(self) -> None:
+        if self.tracemalloc_top:
+            import tracemalloc
+            tracemalloc.start()
+        if self.profile:
+            import cProfile
+            self._profiler = cProfile.Profile()
+            self._profiler.enable()
+
+    def stop(self) -> None:
+        if self._profiler is not None:
+            import pstats
+            self._profiler.disable()
+            self._profiler.dump_stats(self.profile)
+            print('cProfile: {} (累積時間の上位20件)'.format(self.profile),
+                  file=sys.stderr)
+            pstats.Stats(self._profiler, stream=sys.stderr).sort_stats(
+                'cumulative').print_stats(20)
+        if self.tracemalloc_top:
+            import tracemalloc
+            snapshot = tracemalloc.take_snapshot()
+            _, peak = tracemalloc.get_traced_memory()
+            tracemalloc.stop()
+            print('tracemalloc: peak {:.1f}MB (確保量の上位{}件)'.format(
+                peak / 1024 / 1024, self.tracemalloc_top), file=sys.stderr)
+            for stat in snapshot.statistics('lineno')[:self.tracemalloc_top]:
+                print('  {}'.format(stat), file=sys.stderr)
@@ -0,0 +1,58 @@
+from argparse import Namespace
+import sys
+import time
+from typing import Tuple
+
+from .blob import available
+from .models import (
+    compact_messages, database_size, init_db, message_field, set_codec,
+    transaction, vacuum, get_meta, Message, BATCH_SIZE)
+
+
+def run(args: Namespace) -> None:
+    init_db(args.db, args.explain, args.sqlite_profile)
+    with transaction() as s:
+        print('スキーマバージョン: {}'.format(get_meta(s, 'schema_version')))
+    if args.compact:
+        compact(args)
+
+
+def compact(args: Namespace) -> None:
+    """メッセージを分割/圧縮した形式に変換し、変換前後の計測値を表示します."""
+    if not available(args.codec):
+        print('圧縮方式 {} は利用できません (zstandardをインストールしてください)'
+              .format(args.codec), file=sys.stderr)
+        sys.exit(1)
+    before = measure()
+    with transaction() as s:
+        dict_size = set_codec(s, args.codec, args.dict_size)
+    n = compact_messages()
+    vacuum()
+    after = measure()
+    print('変換したメッセージ: {}件 ({}, 共有辞書 {}bytes)'.format(
+        n, args.codec, dict_size))
+    for label, i, unit in (('ファイルサイズ', 0, 'MB'),
+                           ('走査時間(本文等の列)', 1, 's'),
+                           ('走査時間(全項目の復元)', 2, 's')):
+        print('{}: {:.2f}{unit} -> {:.2f}{unit} ({:+.1f}%)'.format(
+            label, before[i], after[i],
+            (after[i] / before[i] - 1) * 100 if before[i] else 0.0,
+            unit=unit))
+
+
+def measure() -> Tuple[float, float, float]:
+    """データベースのサイズ(MB)と全メッセージの走査時間(秒)を返します."""
+    size = database_size() / 1024 / 1024
+    with transaction() as s:
+        # wordcloud/リアクションの集計と同じ列の走査
+        started = time.perf_counter()
+        for _ in s.query(
+                message_field('text'), message_field('bot_id'),
+                message_field('reactions')).yield_per(BATCH_SIZE):
+            pass
+        hot = time.perf_counter() - started
+        started = time.perf_counter()
+        for m in s.query(Message).yield_per(BATCH_SIZE):
+            m.payload()
+        full = time.perf_counter() - started
+    return size, hot, full
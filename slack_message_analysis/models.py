@@ -1,15 +1,74 @@
 from contextlib import contextmanager
+from datetime import datetime, timedelta
+import hashlib
+from itertools import islice
 import json
 import os
-from typing import Optional
+import sqlite3
+import sys
+import time
+import uuid
+from typing import (
+    Any, Callable, Dict, Iterable, List, Optional, Set, Tuple)
+from urllib.parse import quote
 
+from sqlalchemy.dialects.postgresql import JSONB
+from sqlalchemy.engine.url import make_url
+from sqlalchemy.ext.compiler import compiles
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy import (
-    Column, Boolean, String, Float, JSON, create_engine, PrimaryKeyConstraint)
+    Column, Boolean, String, Float, Integer, JSON, LargeBinary, create_engine,
+    PrimaryKeyConstraint, Index, Table, and_, bindparam, cast, event, func,
+    inspect, literal, select, text, tuple_)
 from sqlalchemy.orm import Session, sessionmaker
+from sqlalchemy.pool import QueuePool
+from sqlalchemy.sql.elements import ColumnElement, TextClause
+from sqlalchemy.types import TypeDecorator
+
+from .blob import BlobCodec, train_dictionary
+from .common import TARGET_SUBTYPES
+from .metrics import metrics
 
 Base = declarative_base()
 _session: Optional[Session] = None
+# messages.coldの圧縮/展開に利用する設定 (init_dbでmetaから読み込む)
+_codec: Optional[BlobCodec] = None
+# init_dbで接続したSQLiteの絶対パス(またはデータベースのURL)と
+# 接続設定(ENGINE_PROFILESのキー)
+_db_path: Optional[str] = None
+_profile: Optional[str] = None
+# read_transaction()で利用する読み取り専用の接続 (初回の呼び出し時に作成する)
+_read_session: Optional[Session] = None
+
+# SQLiteの接続設定毎に、接続時に実行するPRAGMAの値
+ENGINE_PROFILES: Dict[str, Dict[str, Any]] = {
+    # WALモードでは書き込み中も読み取り専用の接続から読み出せるため、
+    # collectの実行中にleaderboard等を並行して実行できる。
+    # synchronous=NORMALはコミット毎のfsyncを省略する(電源断時に直前の
+    # コミットが失われ得るが、データベースは破損しない)
+    'wal': dict(journal_mode='WAL', synchronous='NORMAL',
+                cache_size=-64 * 1024, mmap_size=256 * 1024 * 1024,
+                busy_timeout=30000),
+    # 従来のロールバックジャーナル。WALを利用できないネットワーク
+    # ファイルシステム上のデータベース向け
+    'rollback': dict(journal_mode='DELETE', synchronous='FULL',
+                     busy_timeout=30000),
+}
+DEFAULT_PROFILE = 'wal'
+
+# upsertで1回のexecutemanyに渡す行数
+BATCH_SIZE = 5000
+
+# users/channelsを書き換える毎に更新するmetaのキー (directory.pyのキャッシュの破棄に利用)
+DIRECTORY_VERSION = 'directory_version'
+# messagesを書き込む毎に1つずつ増やすmetaのキー (messages.revisionに記録する)
+MESSAGE_REVISION = 'message_revision'
+
+
+def _json(none_as_null: bool = False) -> Any:
+    # PostgreSQLではJSONBとして保存する
+    return JSON(none_as_null=none_as_null).with_variant(
+        JSONB(none_as_null=none_as_null), 'postgresql')
 
 
 class User(Base):
@@ -17,7 +76,9 @@ class User(Base):
     id = Column(String)
     name = Column(String, nullable=False)
     email = Column(String)
-    raw = Column(JSON, nullable=False)
+    raw = Column(_json(), nullable=False)
+    # rawのハッシュ。変更されていない行を書き込まないために比較する
+    fingerprint = Column(String)
     __table_args__ = (
         PrimaryKeyConstraint('id', sqlite_on_conflict='REPLACE'),
     )
@@ -28,35 +89,357 @@ class Channel(Base):
     id = Column(String)
     name = Column(String, nullable=False)
     is_member = Column(Boolean, nullable=False)
-    raw = Column(JSON, nullable=False)
+    raw = Column(_json(), nullable=False)
+    # rawのハッシュ。変更されていない行を書き込まないために比較する
+    fingerprint = Column(String)
     __table_args__ = (
         PrimaryKeyConstraint('id', sqlite_on_conflict='REPLACE'),
     )
 
 
 class Message(Base):
+    """メッセージ.
+
+    Slack APIから取得したメッセージのうち頻繁に参照する項目(HOT_FIELDS)は
+    個別の列に、それ以外の項目はJSONを圧縮してcoldに格納します。
+    v5より前に保存した行(migrate --compactで変換していない行)は
+    全ての項目をrawに保持し、HOT_FIELDSの列とcoldはNULLです。
+    payload()またはmessage_payload()で形式に依らず全体を復元できます。
+    revisionはupsert_messages()で書き込んだ時点のmetaのMESSAGE_REVISIONで、
+    exportが変更のあったパーティションの判定に利用します。
+    """
     __tablename__ = 'messages'
     timestamp = Column(Float)
     channel_id = Column(String)
     user_id = Column(String)
     subtype = Column(String)
-    raw = Column(JSON)
+    raw = Column(_json(none_as_null=True))
+    text = Column(String)
+    reactions = Column(_json(none_as_null=True))
+    bot_id = Column(String)
+    thread_ts = Column(String)
+    reply_count = Column(Integer)
+    cold = Column(LargeBinary)
+    revision = Column(Integer)
     __table_args__ = (
         PrimaryKeyConstraint('timestamp', 'channel_id', 'user_id', 'subtype',
                              sqlite_on_conflict='REPLACE'),
+        # collectでのチャンネル毎の最新メッセージの検索用
+        Index('ix_messages_channel_id_timestamp', 'channel_id', 'timestamp'),
+        # 期間とsubtypeで絞り込みユーザ/チャンネル毎に集計するクエリ用
+        Index('ix_messages_subtype_timestamp', 'subtype', 'timestamp',
+              'user_id', 'channel_id'),
+        # PostgreSQLでは月毎のパーティションに分割する (_create_partitions)
+        {'postgresql_partition_by': 'RANGE (timestamp)'},
+    )
+
+    def payload(self) -> Dict[str, Any]:
+        """Slack APIから取得したメッセージ全体を返します."""
+        return message_payload(self)
+
+
+# messagesでrawから個別の列に分割する項目
+HOT_FIELDS = ('text', 'reactions', 'bot_id', 'thread_ts', 'reply_count')
+
+
+class Reaction(Base):
+    """メッセージに付与されたリアクションをユーザ単位に展開したテーブル.
+
+    メッセージの ``reactions[*].users`` 1ユーザにつき1行を格納します。
+    Slackがusersを省略して返した場合は、省略された数を ``user_id=''`` の行の
+    countに格納するため、リアクション毎の利用数は ``SUM(count)`` で得られます。
+    """
+    __tablename__ = 'message_reactions'
+    timestamp = Column(Float)
+    channel_id = Column(String)
+    subtype = Column(String)
+    reaction = Column(String)
+    user_id = Column(String)
+    count = Column(Integer, nullable=False)
+    __table_args__ = (
+        PrimaryKeyConstraint('timestamp', 'channel_id', 'subtype', 'reaction',
+                             'user_id', sqlite_on_conflict='REPLACE'),
+        Index('ix_message_reactions_timestamp', 'timestamp', 'subtype',
+              'reaction', 'user_id', 'count'),
     )
 
 
-def init_db(path: str) -> None:
-    global _session
+class DailyUserCount(Base):
+    """日毎・ユーザ毎の発言数 (集計対象のsubtypeのみ).
+
+    dayはローカルタイムの0時のUNIX時間です。
+    """
+    __tablename__ = 'daily_user_counts'
+    day = Column(Float)
+    user_id = Column(String)
+    count = Column(Integer, nullable=False)
+    __table_args__ = (
+        PrimaryKeyConstraint('day', 'user_id', sqlite_on_conflict='REPLACE'),
+    )
+
+
+class DailyChannelCount(Base):
+    """日毎・チャンネル毎の発言数 (集計対象のsubtypeのみ)."""
+    __tablename__ = 'daily_channel_counts'
+    day = Column(Float)
+    channel_id = Column(String)
+    count = Column(Integer, nullable=False)
+    __table_args__ = (
+        PrimaryKeyConstraint('day', 'channel_id',
+                             sqlite_on_conflict='REPLACE'),
+    )
+
+
+class DailyReactionCount(Base):
+    """日毎・リアクション毎・ユーザ毎のリアクション数 (集計対象のsubtypeのみ).
+
+    message_reactionsと同様に ``user_id=''`` の行は利用者が省略された数です。
+    """
+    __tablename__ = 'daily_reaction_counts'
+    day = Column(Float)
+    reaction = Column(String)
+    user_id = Column(String)
+    count = Column(Integer, nullable=False)
+    __table_args__ = (
+        PrimaryKeyConstraint('day', 'reaction', 'user_id',
+                             sqlite_on_conflict='REPLACE'),
+    )
+
+
+class TokenCacheEntry(Base):
+    """wordcloudの形態素解析結果のキャッシュの管理テーブル.
+
+    メッセージ毎・形態素解析の設定(config)毎に解析したテキストのハッシュを
+    保持し、テキストが変わったメッセージのみ再解析します。
+    """
+    __tablename__ = 'token_cache'
+    timestamp = Column(Float)
+    channel_id = Column(String)
+    user_id = Column(String)
+    subtype = Column(String)
+    config = Column(String)
+    text_hash = Column(String, nullable=False)
+    __table_args__ = (
+        PrimaryKeyConstraint('timestamp', 'channel_id', 'user_id', 'subtype',
+                             'config', sqlite_on_conflict='REPLACE'),
+    )
+
+
+class TokenCount(Base):
+    """wordcloudの形態素解析結果 (メッセージ毎の単語の出現回数)."""
+    __tablename__ = 'token_counts'
+    timestamp = Column(Float)
+    channel_id = Column(String)
+    user_id = Column(String)
+    subtype = Column(String)
+    config = Column(String)
+    token = Column(String)
+    count = Column(Integer, nullable=False)
+    __table_args__ = (
+        PrimaryKeyConstraint('timestamp', 'channel_id', 'user_id', 'subtype',
+                             'config', 'token', sqlite_on_conflict='REPLACE'),
+        Index('ix_token_counts_config_timestamp', 'config', 'timestamp',
+              'subtype', 'token', 'count'),
+    )
+
+
+class CollectState(Base):
+    """collectの取得状況をチャンネル/スレッド毎に保持するテーブル.
+
+    チャンネルの会話ログは ``thread_ts=''`` の行、スレッドのリプライは
+    親メッセージのtsを ``thread_ts`` とする行に保持します。
+    ページネーションの途中で中断した場合は次回に ``cursor`` から再開します。
+    """
+    __tablename__ = 'collect_state'
+    channel_id = Column(String)
+    thread_ts = Column(String)
+    # 取得途中のカーソルと取得範囲 (取得完了時はNULL)
+    cursor = Column(String)
+    oldest = Column(String)
+    latest = Column(String)
+    # 取得途中のページで得られた最新のメッセージのts
+    pending = Column(Float)
+    # 取得が完了した最新のメッセージのts
+    high_water = Column(Float)
+    # 取得済みのスレッドのlatest_reply
+    last_reply = Column(String)
+    __table_args__ = (
+        PrimaryKeyConstraint('channel_id', 'thread_ts',
+                             sqlite_on_conflict='REPLACE'),
+    )
+
+
+class BlobDict(Base):
+    """messages.coldの圧縮に利用する共有辞書 (blob.BlobCodec)."""
+    __tablename__ = 'blob_dicts'
+    id = Column(Integer)
+    codec = Column(String, nullable=False)
+    data = Column(LargeBinary, nullable=False)
+    __table_args__ = (
+        PrimaryKeyConstraint('id', sqlite_on_conflict='REPLACE'),
+    )
+
+
+class Meta(Base):
+    """スキーマのバージョン等、データベース全体に関する値を保持するテーブル."""
+    __tablename__ = 'meta'
+    key = Column(String)
+    value = Column(String, nullable=False)
+    __table_args__ = (
+        PrimaryKeyConstraint('key', sqlite_on_conflict='REPLACE'),
+    )
+
+
+def init_db(path: str, explain: bool = False,
+            profile: str = DEFAULT_PROFILE) -> None:
+    """データベースに接続し、必要であればスキーマを最新の状態に更新します.
+
+    同じパスと接続設定で再度呼び出した場合は作成済みのエンジンをそのまま利用し、
+    スキーマの確認等も行いません(serveで複数のジョブを実行する場合)。
+    異なる場合は接続し直します。
+
+    Args:
+        path: SQLiteのパス、またはPostgreSQLのURL
+            (例: ``postgresql://user@host/slack``)
+        explain: Trueの場合は実行するSELECT文のクエリプランを標準エラー出力に
+            表示します
+        profile: SQLiteの接続設定 (ENGINE_PROFILESのキー)
+    """
+    global _session, _read_session, _db_path, _profile
+    if not _is_url(path):
+        path = os.path.abspath(path)
     if _session is not None:
-        return
-    engine = create_engine(
-        'sqlite:///{}'.format(os.path.abspath(path)),
-        json_serializer=lambda o: json.dumps(
-            o, ensure_ascii=False, separators=(',', ':')))
+        engine = _session.kw['bind']  # type: ignore
+        if path == _db_path and profile == _profile:
+            _set_explain(engine, explain)
+            if _read_session is not None:
+                _set_explain(_read_session.kw['bind'], explain)  # type: ignore
+            return
+        engine.dispose()
+        if _read_session is not None:
+            _read_session.kw['bind'].dispose()  # type: ignore
+    _read_session = None
+    engine = _create_engine(path, profile, readonly=False)
+    is_new = Message.__tablename__ not in inspect(engine).get_table_names()
     Base.metadata.create_all(engine)
     _session = sessionmaker(bind=engine)  # type: ignore
+    _db_path = path
+    _profile = profile
+    _migrate(is_new)
+    with transaction() as s:
+        _load_codec(s)
+    _set_explain(engine, explain)
+
+
+def _is_url(path: str) -> bool:
+    return '://' in path
+
+
+def _create_engine(path: str, profile: str, readonly: bool) -> Any:
+    if _is_url(path):
+        return _create_server_engine(path)
+    pragmas = ENGINE_PROFILES[profile]
+    if readonly:
+        # journal_modeはデータベースファイルに記録される設定のため
+        # 書き込み用の接続でのみ変更する
+        pragmas = {k: v for k, v in pragmas.items() if k != 'journal_mode'}
+        uri = 'file:{}?mode=ro'.format(quote(path))
+    else:
+        uri = 'file:{}'.format(quote(path))
+
+    def _connect() -> sqlite3.Connection:
+        # プールした接続はcollectのワーカースレッド間で受け渡される
+        conn = sqlite3.connect(uri, uri=True, check_same_thread=False)
+        for name, value in pragmas.items():
+            conn.execute('PRAGMA {} = {}'.format(name, value))
+        return conn
+
+    # 接続毎のページキャッシュとmmapを使い回すため接続をプールする
+    # (SQLAlchemy 1.3はファイルのSQLiteに対して既定で接続をプールしない)
+    return create_engine(
+        'sqlite://', creator=_connect, poolclass=QueuePool, max_overflow=-1,
+        json_serializer=_json_serializer,
+        json_deserializer=_json_deserializer)
+
+
+def _create_server_engine(url: str) -> Any:
+    if make_url(url).get_backend_name() != 'postgresql':
+        print('データベースのURLはPostgreSQL(postgresql://...)のみ指定できます',
+              file=sys.stderr)
+        sys.exit(1)
+    # executemanyを1行毎に送信せずまとめて送信する (upsert)
+    try:
+        engine = create_engine(
+            url, pool_size=5, max_overflow=-1, pool_pre_ping=True,
+            executemany_mode='batch', client_encoding='utf8',
+            json_serializer=_json_serializer,
+            json_deserializer=_json_deserializer)
+    except ImportError:
+        print('psycopg2が必要です (pip install psycopg2-binary)',
+              file=sys.stderr)
+        sys.exit(1)
+    tz = _local_timezone()
+
+    @event.listens_for(engine, 'connect')
+    def _connect(conn: Any, record: Any) -> None:
+        # 月の判定(columnar)等をSQLiteのlocaltimeと同じくローカルタイムで行う
+        # SETはロールバックで取り消されるため確定させる
+        with conn.cursor() as c:
+            c.execute('SET TIME ZONE ' + tz)
+        conn.commit()
+    return engine
+
+
+def _local_timezone() -> str:
+    # PostgreSQLのSET TIME ZONEに指定するローカルタイムのタイムゾーン。
+    # TZにはIANAのタイムゾーン名(Asia/Tokyo等)の場合のみそのまま指定する。
+    # POSIX形式(JST-9等)はPostgreSQLでは符号が逆に解釈されるため、
+    # 現在のUTCとの差を指定する
+    name = os.environ.get('TZ', '').lstrip(':')
+    if not name:
+        name = os.path.realpath('/etc/localtime')
+    if '/zoneinfo/' in name:
+        name = name.split('/zoneinfo/', 1)[1]
+    if name and _is_zoneinfo(name):
+        return "'{}'".format(name.replace("'", "''"))
+    offset = datetime.now().astimezone().utcoffset() or timedelta()
+    return "INTERVAL '{:+.0f} minutes'".format(offset.total_seconds() / 60)
+
+
+def _is_zoneinfo(name: str) -> bool:
+    # タイムゾーンデータベースにあるIANAのタイムゾーン名かどうか
+    if name.startswith('/') or '..' in name.split('/'):
+        return False
+    for d in ('/usr/share/zoneinfo', '/usr/lib/zoneinfo',
+              '/usr/share/lib/zoneinfo', '/etc/zoneinfo'):
+        path = os.path.join(d, name)
+        if os.path.isfile(path):
+            with open(path, 'rb') as f:
+                return f.read(4) == b'TZif'
+    return False
+
+
+def _set_explain(engine: Any, explain: bool) -> None:
+    listening = event.contains(
+        engine, 'before_cursor_execute', _explain_query_plan)
+    if explain and not listening:
+        event.listen(engine, 'before_cursor_execute', _explain_query_plan)
+    elif not explain and listening:
+        event.remove(engine, 'before_cursor_execute', _explain_query_plan)
+
+
+def _json_serializer(o: Any) -> str:
+    started = time.perf_counter()
+    ret = json.dumps(o, ensure_ascii=False, separators=(',', ':'))
+    metrics.inc('json_serialize_seconds', time.perf_counter() - started)
+    return ret
+
+
+def _json_deserializer(s: str) -> Any:
+    started = time.perf_counter()
+    ret = json.loads(s)
+    metrics.inc('json_deserialize_seconds', time.perf_counter() - started)
+    return ret
 
 
 @contextmanager
@@ -65,7 +448,776 @@ def transaction():
     s = _session()
     try:
         yield s
+        started = time.perf_counter()
         s.commit()
+        metrics.inc('db_commits_total')
+        metrics.inc('db_commit_seconds', time.perf_counter() - started)
     except Exception as e:
         s.rollback()
         raise e
+
+
+@contextmanager
+def read_transaction():
+    """読み取り専用の接続のセッションを返します.
+
+    集計のみを行うサブコマンドが利用します。WALモード(ENGINE_PROFILESの
+    ``wal``)では、他のプロセスが書き込み中でも待たずに読み出せます。
+    PostgreSQLでは同じ接続プールの読み取り専用トランザクションを利用します。
+    書き込みを行った場合はエラーになります。
+    """
+    global _read_session
+    assert _session and _db_path and _profile
+    if _read_session is None:
+        if _is_url(_db_path):
+            _read_session = _session
+        else:
+            engine = _create_engine(_db_path, _profile, readonly=True)
+            _set_explain(engine, event.contains(
+                _session.kw['bind'], 'before_cursor_execute',  # type: ignore
+                _explain_query_plan))
+            _read_session = sessionmaker(bind=engine)  # type: ignore
+    s = _read_session()
+    try:
+        if _is_url(_db_path):
+            s.execute('SET TRANSACTION READ ONLY')
+        yield s
+    finally:
+        s.rollback()
+        s.close()
+
+
+def upsert(s: Session, table: Table, rows: Iterable[Dict[str, Any]],
+           batch_size: int = BATCH_SIZE) -> int:
+    """ORMを介さずに行をUPSERTします.
+
+    rowsをbatch_size行ずつ ``INSERT ... ON CONFLICT DO UPDATE`` の
+    executemanyで書き込みます。トランザクションは呼び出し側で管理します。
+
+    Args:
+        s: transaction()で得たセッション
+        table: 書き込み先テーブル (例: ``Message.__table__``)
+        rows: 列名をキーとする辞書のイテラブル
+        batch_size: 1回のexecutemanyで書き込む行数
+    Returns:
+        書き込んだ行数
+    """
+    stmt = _upsert_statement(s, table)
+    it = iter(rows)
+    n = 0
+    while True:
+        batch: List[Dict[str, Any]] = list(islice(it, batch_size))
+        if not batch:
+            return n
+        if table is Message.__table__:
+            _create_partitions(s, set(r['timestamp'] for r in batch))
+        s.execute(stmt, batch)
+        n += len(batch)
+        metrics.inc('rows_written_total', len(batch), table=table.name)
+
+
+def _create_partitions(s: Session, timestamps: Iterable[float]) -> None:
+    """PostgreSQLのmessagesにtimestampsを含む月(ローカルタイム)のパーティションを作成します.
+
+    パーティションの作成はmessagesをロックするため、作成済みの月は
+    トランザクション毎に確認して作成しません。SQLiteでは何もしません。
+    """
+    if s.get_bind().dialect.name != 'postgresql':
+        return
+    months = set(datetime.fromtimestamp(ts).replace(
+        day=1, hour=0, minute=0, second=0, microsecond=0)
+        for ts in timestamps)
+    exists = set(name for name, in s.execute(
+        "SELECT c.relname FROM pg_inherits i JOIN pg_class c "
+        "ON c.oid = i.inhrelid WHERE i.inhparent = 'messages'::regclass"))
+    for month in sorted(months):
+        name = 'messages_{:%Y%m}'.format(month)
+        if name in exists:
+            continue
+        end = (month + timedelta(days=32)).replace(day=1)
+        s.execute(
+            'CREATE TABLE IF NOT EXISTS {} PARTITION OF messages '
+            'FOR VALUES FROM ({!r}) TO ({!r})'.format(
+                name, month.timestamp(), end.timestamp()))
+
+
+def _upsert_statement(s: Session, table: Table,
+                      add: Tuple[str, ...] = ()) -> TextClause:
+    # addの列は置き換えずに既存の行の値に加算する
+    q = s.get_bind().dialect.identifier_preparer.quote
+    columns = [c.name for c in table.columns]
+    keys = [c.name for c in table.primary_key]
+    return text(
+        'INSERT INTO {} ({}) VALUES ({}) ON CONFLICT ({}) DO UPDATE SET {}'
+        .format(
+            q(table.name),
+            ', '.join(q(c) for c in columns),
+            ', '.join(':' + c for c in columns),
+            ', '.join(q(c) for c in keys),
+            ', '.join(('{0} = {1}.{0} + excluded.{0}' if c in add else
+                       '{0} = excluded.{0}').format(q(c), q(table.name))
+                      for c in columns if c not in keys))
+    ).bindparams(*[bindparam(c.name, type_=c.type) for c in table.columns])
+
+
+def get_meta(s: Session, key: str) -> Optional[str]:
+    return s.query(Meta.value).filter(Meta.key == key).scalar()
+
+
+def set_meta(s: Session, key: str, value: str) -> None:
+    upsert(s, Meta.__table__, [dict(key=key, value=value)])
+
+
+def message_field(name: str) -> Any:
+    """messagesのHOT_FIELDSの列を、分割前の行ではrawから取得するSQL式を返します.
+
+    Args:
+        name: HOT_FIELDSの項目名
+    """
+    column = getattr(Message, name)
+    return func.coalesce(
+        column, _RawField(name, column.type),
+        type_=column.type).label(name)
+
+
+class _RawField(ColumnElement):
+    # messages.rawの項目 (SQLiteはjson_extract、PostgreSQLは->/->>演算子)
+
+    def __init__(self, field: str, type_: Any) -> None:
+        self.field = field
+        self.type = type_
+
+    @property
+    def _from_objects(self) -> List[Any]:
+        return Message.__table__.c.raw._from_objects
+
+
+@compiles(_RawField)
+def _compile_raw_field(element: _RawField, compiler: Any, **kw: Any) -> str:
+    return 'json_extract({}, {})'.format(
+        compiler.process(Message.__table__.c.raw, **kw),
+        compiler.process(literal('$.' + element.field), **kw))
+
+
+@compiles(_RawField, 'postgresql')
+def _compile_raw_field_pg(element: _RawField, compiler: Any,
+                          **kw: Any) -> str:
+    raw = compiler.process(Message.__table__.c.raw, **kw)
+    field = compiler.process(literal(element.field), **kw)
+    type_ = element.type
+    if isinstance(type_, TypeDecorator):
+        # _json()の型はPostgreSQLではJSONB
+        type_ = type_.load_dialect_impl(compiler.dialect)
+    if isinstance(type_, JSON):
+        return '({} -> {})'.format(raw, field)
+    if isinstance(type_, Integer):
+        return 'CAST(({} ->> {}) AS INTEGER)'.format(raw, field)
+    return '({} ->> {})'.format(raw, field)
+
+
+def pack_message(row: Dict[str, Any]) -> Dict[str, Any]:
+    """messagesの行のrawをHOT_FIELDSの列と圧縮したcoldに分割します.
+
+    Args:
+        row: rawにSlack APIから取得したメッセージを持つmessagesの行
+    Returns:
+        rawがNULLでHOT_FIELDSの列とcoldを持つmessagesの行
+    """
+    assert _codec
+    cold = dict(row['raw'])
+    ret = dict(row, raw=None)
+    for name in HOT_FIELDS:
+        ret[name] = cold.pop(name, None)
+    started = time.perf_counter()
+    ret['cold'] = _codec.compress(json.dumps(
+        cold, ensure_ascii=False, separators=(',', ':')).encode('utf8'))
+    metrics.inc('blob_compress_seconds', time.perf_counter() - started)
+    return ret
+
+
+def message_payload(m: Any) -> Dict[str, Any]:
+    """messagesの行からSlack APIから取得したメッセージ全体を復元します.
+
+    Args:
+        m: Messageまたはraw, cold, HOT_FIELDSの列を属性に持つ行
+    """
+    if m.raw is not None:
+        return m.raw
+    assert _codec
+    ret: Dict[str, Any] = {}
+    if m.cold is not None:
+        started = time.perf_counter()
+        ret = json.loads(_codec.decompress(m.cold))
+        metrics.inc('blob_decompress_seconds', time.perf_counter() - started)
+    for name in HOT_FIELDS:
+        value = getattr(m, name)
+        if value is not None:
+            ret[name] = value
+    return ret
+
+
+def set_codec(s: Session, codec: str, dict_size: int = 0,
+              samples: int = 1000) -> int:
+    """以降に書き込むメッセージのcoldの圧縮方式を設定します.
+
+    dict_sizeが正の場合は保存済みのメッセージから共有辞書を作成します。
+    既存のcoldはヘッダに記録した方式と辞書で展開するため書き換えは不要です。
+
+    Args:
+        s: transaction()で得たセッション
+        codec: 圧縮方式 (blob.CODECSのキー)
+        dict_size: 共有辞書の最大サイズ(bytes)。0の場合は辞書を利用しない
+        samples: 共有辞書の作成に利用するメッセージ数 (新しいものから)
+    Returns:
+        作成した共有辞書のサイズ(bytes)
+    """
+    dict_id = 0
+    zdict = b''
+    if dict_size > 0:
+        q = s.query(Message).order_by(Message.timestamp.desc()).limit(samples)
+        data = [_cold_json(message_payload(m)) for m in q][::-1]
+        zdict = train_dictionary(codec, data, dict_size) if data else b''
+        if zdict:
+            dict_id = (s.query(func.max(BlobDict.id)).scalar() or 0) + 1
+            upsert(s, BlobDict.__table__, [
+                dict(id=dict_id, codec=codec, data=zdict)])
+    set_meta(s, 'blob_codec', codec)
+    set_meta(s, 'blob_dict', str(dict_id))
+    _load_codec(s)
+    return len(zdict)
+
+
+def _cold_json(payload: Dict[str, Any]) -> bytes:
+    return json.dumps(
+        {k: v for k, v in payload.items() if k not in HOT_FIELDS},
+        ensure_ascii=False, separators=(',', ':')).encode('utf8')
+
+
+def _load_codec(s: Session) -> None:
+    global _codec
+    _codec = BlobCodec(
+        get_meta(s, 'blob_codec') or 'zlib',
+        int(get_meta(s, 'blob_dict') or 0),
+        {d.id: d.data for d in s.query(BlobDict)})
+
+
+def compact_messages(batch_size: int = BATCH_SIZE) -> int:
+    """rawに全ての項目を保持している行をHOT_FIELDSの列とcoldに分割します.
+
+    batch_size行毎にコミットするため、中断しても再実行で続きから変換します。
+
+    Returns:
+        変換した行数
+    """
+    t = Message.__table__
+    keys = [t.c.timestamp, t.c.channel_id, t.c.user_id, t.c.subtype]
+    stmt = t.update().where(and_(*[
+        c == bindparam('_' + c.name) for c in keys]))
+    last: Optional[Tuple[Any, ...]] = None
+    n = 0
+    while True:
+        with transaction() as s:
+            q = s.query(*keys, t.c.raw).filter(t.c.raw.isnot(None))
+            if last is not None:
+                q = q.filter(tuple_(*keys) > tuple_(*last))
+            batch = q.order_by(*keys).limit(batch_size).all()
+            if not batch:
+                return n
+            rows = []
+            for m in batch:
+                row = pack_message(m._asdict())
+                for c in keys:
+                    row['_' + c.name] = row.pop(c.name)
+                rows.append(row)
+            s.execute(stmt, rows)
+        last = tuple(batch[-1])[:len(keys)]
+        n += len(batch)
+
+
+def vacuum() -> None:
+    """未使用の領域を解放してデータベースファイルを縮小します.
+
+    WALモードの場合はWALの内容をデータベースファイルに反映して空にします。
+    """
+    assert _session
+    with _session.kw['bind'].connect() as conn:  # type: ignore
+        conn = conn.execution_options(isolation_level='AUTOCOMMIT')
+        conn.execute('VACUUM')
+        if conn.dialect.name == 'sqlite':
+            conn.execute('PRAGMA wal_checkpoint(TRUNCATE)')
+
+
+def db_path() -> Optional[str]:
+    """init_dbで接続したSQLiteの絶対パス(またはデータベースのURL)を返します."""
+    return _db_path
+
+
+def database_size() -> int:
+    """データベースのサイズ(バイト)を返します."""
+    assert _session and _db_path
+    if _is_url(_db_path):
+        with transaction() as s:
+            return s.execute(
+                'SELECT pg_database_size(current_database())').scalar()
+    return os.path.getsize(_db_path)
+
+
+def user_row(u: Dict[str, Any]) -> Dict[str, Any]:
+    """users.list等で得たユーザからusersの行を生成します."""
+    name = (
+        u['profile'].get('display_name') or
+        u.get('real_name') or
+        u['profile'].get('real_name') or
+        u['name'])
+    return dict(id=u['id'], name=name, email=u['profile'].get('email'),
+                raw=u, fingerprint=fingerprint(u))
+
+
+def channel_row(c: Dict[str, Any]) -> Dict[str, Any]:
+    """conversations.list等で得たチャンネルからchannelsの行を生成します."""
+    return dict(id=c['id'], name=c['name'],
+                is_member=c.get('is_member', False), raw=c,
+                fingerprint=fingerprint(c))
+
+
+def fingerprint(raw: Dict[str, Any]) -> str:
+    """APIの応答のハッシュを返します. キーの順序には依存しません."""
+    return hashlib.sha1(json.dumps(
+        raw, ensure_ascii=False, sort_keys=True, separators=(',', ':'),
+    ).encode('utf8')).hexdigest()
+
+
+def upsert_changed(s: Session, table: Table, rows: Iterable[Dict[str, Any]],
+                   batch_size: int = BATCH_SIZE) -> Tuple[int, int, int]:
+    """fingerprintが保存済みの行と異なる行のみをUPSERTします.
+
+    users/channelsのようにidを主キーとし、user_row()/channel_row()等で
+    fingerprintを設定した行を対象とします。行を書き込んだ場合はmetaの
+    DIRECTORY_VERSIONを更新します。
+
+    Args:
+        s: transaction()で得たセッション
+        table: 書き込み先テーブル (``User.__table__`` または
+            ``Channel.__table__``)
+        rows: 列名をキーとする辞書のイテラブル
+        batch_size: 1回に比較・書き込みする行数
+    Returns:
+        追加、更新、変更なしの行数のタプル
+    """
+    # IN句の値毎のバインドパラメータの生成を避けるため、実行時に展開する
+    stmt = select([table.c.id, table.c.fingerprint]).where(
+        table.c.id.in_(bindparam('ids', expanding=True)))
+    it = iter(rows)
+    inserted = updated = unchanged = 0
+    while True:
+        batch: List[Dict[str, Any]] = list(islice(it, batch_size))
+        if not batch:
+            break
+        stored: Dict[str, Optional[str]] = {}
+        ids = [r['id'] for r in batch]
+        for i in range(0, len(ids), 500):
+            stored.update(s.execute(
+                stmt, dict(ids=ids[i:i + 500])).fetchall())
+        changed = [r for r in batch if r['id'] not in stored or
+                   stored[r['id']] != r['fingerprint']]
+        upsert(s, table, changed)
+        if changed:
+            set_meta(s, DIRECTORY_VERSION, uuid.uuid4().hex)
+        n = sum(1 for r in changed if r['id'] in stored)
+        inserted += len(changed) - n
+        updated += n
+        unchanged += len(batch) - len(changed)
+    metrics.inc('rows_unchanged_total', unchanged, table=table.name)
+    return inserted, updated, unchanged
+
+
+def reaction_rows(message: Dict[str, Any]) -> List[Dict[str, Any]]:
+    """messagesの行からmessage_reactionsの行を生成します.
+
+    Args:
+        message: rawまたはreactionsの列を持つmessagesの行
+    """
+    rows = []
+    key = dict(timestamp=message['timestamp'],
+               channel_id=message['channel_id'], subtype=message['subtype'])
+    if message.get('raw') is not None:
+        reactions = message['raw'].get('reactions')
+    else:
+        reactions = message.get('reactions')
+    for r in reactions or []:
+        users = r.get('users', [])
+        for user_id in users:
+            rows.append(
+                dict(key, reaction=r['name'], user_id=user_id, count=1))
+        if r['count'] > len(users):
+            rows.append(dict(key, reaction=r['name'], user_id='',
+                             count=r['count'] - len(users)))
+    return rows
+
+
+def upsert_messages(s: Session, rows: Iterable[Dict[str, Any]],
+                    batch_size: int = BATCH_SIZE) -> int:
+    """メッセージをUPSERTし、message_reactionsと日毎の集計テーブルを同期します.
+
+    日毎の集計テーブルには、新たに追加したメッセージと置き換えたリアクションの
+    増減のみを加算します。
+
+    Args:
+        s: transaction()で得たセッション
+        rows: messagesテーブルの列名をキーとする辞書のイテラブル
+        batch_size: 1回のexecutemanyで書き込む行数
+    Returns:
+        書き込んだメッセージ数
+    """
+    it = iter(rows)
+    n = 0
+    revision: Optional[int] = None
+    while True:
+        batch: List[Dict[str, Any]] = list(islice(it, batch_size))
+        if not batch:
+            return n
+        if revision is None:
+            revision = _next_revision(s)
+        keys = [_message_key(m) for m in batch]
+        stored, replaced = _stored_messages(s, keys)
+        deltas = _RollupDeltas()
+        for key in keys:
+            if key not in stored:
+                stored.add(key)
+                deltas.add_message(key, 1)
+        deltas.add_reactions(replaced, -1)
+        upsert(s, Message.__table__, [
+            dict(pack_message(m), revision=revision) for m in batch])
+        # 主キーが重複するリアクションは後の行で置き換えられる
+        reactions = list({_reaction_key(r): r for m in batch
+                          for r in reaction_rows(m)}.values())
+        _replace_reactions(s, batch, reactions)
+        deltas.add_reactions(reactions, 1)
+        deltas.apply(s)
+        n += len(batch)
+
+
+def _next_revision(s: Session) -> int:
+    # metaの行を更新してから読み出すため、PostgreSQLで並行して書き込む
+    # トランザクションはコミットの順に大きい値を得る
+    t = Meta.__table__
+    r = s.execute(t.update().where(t.c.key == MESSAGE_REVISION).values(
+        value=cast(cast(t.c.value, Integer) + 1, String)))
+    if r.rowcount == 0:
+        set_meta(s, MESSAGE_REVISION, '1')
+    return int(get_meta(s, MESSAGE_REVISION))  # type: ignore
+
+
+def delete_messages(s: Session, keys: Iterable[Tuple[float, str, str, str]]
+                    ) -> int:
+    """メッセージを削除し、message_reactionsと日毎の集計テーブルを同期します.
+
+    Args:
+        s: transaction()で得たセッション
+        keys: 削除するメッセージの(timestamp, channel_id, user_id, subtype)
+    Returns:
+        削除を指示したメッセージ数
+    """
+    keys = list(keys)
+    if not keys:
+        return 0
+    params = [dict(timestamp=ts, channel_id=channel_id, user_id=user_id,
+                   subtype=subtype)
+              for ts, channel_id, user_id, subtype in keys]
+    deltas = _RollupDeltas()
+    stored, reactions = _stored_messages(s, keys)
+    for key in stored:
+        deltas.add_message(key, -1)
+    deltas.add_reactions(reactions, -1)
+    t = Message.__table__
+    s.execute(t.delete().where(and_(
+        *[t.c[c] == bindparam(c) for c in (
+            'timestamp', 'channel_id', 'user_id', 'subtype')])), params)
+    r = Reaction.__table__
+    s.execute(r.delete().where(and_(
+        *[r.c[c] == bindparam(c) for c in (
+            'timestamp', 'channel_id', 'subtype')])), params)
+    deltas.apply(s)
+    return len(params)
+
+
+def _message_key(m: Dict[str, Any]) -> Tuple[float, str, str, str]:
+    return m['timestamp'], m['channel_id'], m['user_id'], m['subtype']
+
+
+def _reaction_key(r: Dict[str, Any]) -> Tuple[float, str, str, str, str]:
+    return (r['timestamp'], r['channel_id'], r['subtype'], r['reaction'],
+            r['user_id'])
+
+
+def _stored_messages(s: Session, keys: List[Tuple[float, str, str, str]]
+                     ) -> Tuple[Set[Tuple[float, str, str, str]],
+                                List[Dict[str, Any]]]:
+    """保存済みのメッセージのキーと、そのメッセージのリアクションの行を返します.
+
+    Args:
+        s: transaction()で得たセッション
+        keys: メッセージの(timestamp, channel_id, user_id, subtype)
+    Returns:
+        keysのうち保存済みのもの、keysのメッセージのmessage_reactionsの行
+    """
+    m, r = Message.__table__, Reaction.__table__
+    message_stmt = select(
+        [m.c.timestamp, m.c.channel_id, m.c.user_id, m.c.subtype]).where(
+        m.c.timestamp.in_(bindparam('ts', expanding=True)))
+    reaction_stmt = select([r]).where(
+        r.c.timestamp.in_(bindparam('ts', expanding=True)))
+    wanted = set(keys)
+    reaction_keys = set((k[0], k[1], k[3]) for k in keys)
+    timestamps = sorted(set(k[0] for k in keys))
+    stored: Set[Tuple[float, str, str, str]] = set()
+    reactions: List[Dict[str, Any]] = []
+    for i in range(0, len(timestamps), 500):
+        ts = dict(ts=timestamps[i:i + 500])
+        stored.update(k for k in map(tuple, s.execute(message_stmt, ts))
+                      if k in wanted)
+        reactions += [
+            dict(row) for row in s.execute(reaction_stmt, ts)
+            if (row.timestamp, row.channel_id, row.subtype) in reaction_keys]
+    return stored, reactions
+
+
+class _RollupDeltas:
+    """日毎の集計テーブルの行毎の増減."""
+
+    def __init__(self) -> None:
+        self.users: Dict[Tuple[float, str], int] = {}
+        self.channels: Dict[Tuple[float, str], int] = {}
+        self.reactions: Dict[Tuple[float, str, str], int] = {}
+
+    def add_message(self, key: Tuple[float, str, str, str], sign: int
+                    ) -> None:
+        ts, channel_id, user_id, subtype = key
+        if subtype not in TARGET_SUBTYPES:
+            return
+        day = day_start(ts)
+        _add(self.users, (day, user_id), sign)
+        _add(self.channels, (day, channel_id), sign)
+
+    def add_reactions(self, rows: Iterable[Dict[str, Any]], sign: int
+                      ) -> None:
+        for r in rows:
+            if r['subtype'] in TARGET_SUBTYPES:
+                _add(self.reactions,
+                     (day_start(r['timestamp']), r['reaction'], r['user_id']),
+                     sign * r['count'])
+
+    def apply(self, s: Session) -> None:
+        """増減を加算し、0件になった行を削除します."""
+        for table, columns, deltas in (
+                (DailyUserCount.__table__, ('day', 'user_id'), self.users),
+                (DailyChannelCount.__table__, ('day', 'channel_id'),
+                 self.channels),
+                (DailyReactionCount.__table__, ('day', 'reaction', 'user_id'),
+                 self.reactions)):
+            rows = [dict(zip(columns, k), count=v)
+                    for k, v in deltas.items() if v]
+            if not rows:
+                continue
+            s.execute(_upsert_statement(s, table, add=('count',)), rows)
+            removed = [r for r in rows if r['count'] < 0]
+            if removed:
+                s.execute(table.delete().where(and_(
+                    *[table.c[c] == bindparam(c) for c in columns],
+                    table.c.count <= 0)), removed)
+
+
+def _add(deltas: Dict[Any, int], key: Any, n: int) -> None:
+    deltas[key] = deltas.get(key, 0) + n
+
+
+def day_start(ts: float) -> float:
+    """UNIX時間を含む日(ローカルタイム)の0時のUNIX時間を返します."""
+    return datetime.fromtimestamp(ts).replace(
+        hour=0, minute=0, second=0, microsecond=0).timestamp()
+
+
+def next_day(day: float) -> float:
+    """day_start()で得た日の翌日の0時のUNIX時間を返します."""
+    return (datetime.fromtimestamp(day) + timedelta(days=1)).timestamp()
+
+
+def refresh_rollups(s: Session, days: Iterable[float]) -> None:
+    """指定した日の日毎の集計テーブルをmessages/message_reactionsから再作成します.
+
+    Args:
+        s: transaction()で得たセッション
+        days: day_start()で得た日の0時のUNIX時間
+    """
+    m, r = Message, Reaction
+    for day in sorted(days):
+        end = next_day(day)
+        for t in (DailyUserCount, DailyChannelCount, DailyReactionCount):
+            s.query(t).filter(t.day == day).delete(synchronize_session=False)
+        message_filter = and_(
+            m.timestamp >= day, m.timestamp < end,
+            m.subtype.in_(TARGET_SUBTYPES))
+        s.execute(DailyUserCount.__table__.insert().from_select(
+            ['day', 'user_id', 'count'],
+            select([literal(day), m.user_id, func.count()]).where(
+                message_filter).group_by(m.user_id)))
+        s.execute(DailyChannelCount.__table__.insert().from_select(
+            ['day', 'channel_id', 'count'],
+            select([literal(day), m.channel_id, func.count()]).where(
+                message_filter).group_by(m.channel_id)))
+        s.execute(DailyReactionCount.__table__.insert().from_select(
+            ['day', 'reaction', 'user_id', 'count'],
+            select([literal(day), r.reaction, r.user_id, func.sum(r.count)])
+            .where(and_(r.timestamp >= day, r.timestamp < end,
+                        r.subtype.in_(TARGET_SUBTYPES)))
+            .group_by(r.reaction, r.user_id)))
+
+
+def backfill_rollups(s: Session) -> None:
+    """保存済みの全メッセージから日毎の集計テーブルを再作成します."""
+    first, last = s.query(
+        func.min(Message.timestamp), func.max(Message.timestamp)).one()
+    if first is None:
+        return
+    days = []
+    day = day_start(first)
+    while day <= last:
+        days.append(day)
+        day = next_day(day)
+    refresh_rollups(s, days)
+
+
+def backfill_reactions(s: Session, batch_size: int = BATCH_SIZE) -> int:
+    """保存済みの全メッセージからmessage_reactionsを再作成します.
+
+    Returns:
+        書き込んだmessage_reactionsの行数
+    """
+    s.query(Reaction).delete()
+    q = s.query(
+        Message.timestamp, Message.channel_id, Message.subtype,
+        message_field('reactions'),
+    ).yield_per(batch_size)
+    return upsert(s, Reaction.__table__, (
+        r for m in q for r in reaction_rows(m._asdict())), batch_size)
+
+
+def _replace_reactions(s: Session, messages: List[Dict[str, Any]],
+                       rows: List[Dict[str, Any]]) -> None:
+    # messagesのリアクションを全て削除してからrowsを書き込む
+    t = Reaction.__table__
+    s.execute(t.delete().where(and_(
+        t.c.timestamp == bindparam('timestamp'),
+        t.c.channel_id == bindparam('channel_id'),
+        t.c.subtype == bindparam('subtype'),
+    )), [dict(timestamp=m['timestamp'], channel_id=m['channel_id'],
+              subtype=m['subtype']) for m in messages])
+    upsert(s, t, rows)
+
+
+def _migration_reactions(s: Session) -> None:
+    # backfill_reactionsが参照するv5の列を先に追加する
+    _migration_message_columns(s)
+    backfill_reactions(s)
+
+
+def _migration_message_indexes(s: Session) -> None:
+    _create_indexes(s, Message.__table__)
+
+
+def _migration_collect_state(s: Session) -> None:
+    # これまでのチャンネル毎の最新メッセージを取得済みの位置とする
+    q = s.query(Message.channel_id, func.max(Message.timestamp)).group_by(
+        Message.channel_id)
+    upsert(s, CollectState.__table__, (
+        dict(channel_id=channel_id, thread_ts='', cursor=None, oldest=None,
+             latest=None, pending=None, high_water=ts, last_reply=None)
+        for channel_id, ts in q))
+
+
+def _migration_rollups(s: Session) -> None:
+    backfill_rollups(s)
+
+
+def _migration_message_columns(s: Session) -> None:
+    # 既存の行はrawのまま残し、migrate --compactで変換する
+    for name in HOT_FIELDS + ('cold',):
+        _add_column(s, Message.__table__, name)
+
+
+def _migration_fingerprints(s: Session) -> None:
+    # 既存の行はNULLのままとし、次回のcollectで更新された行として書き込む
+    _add_column(s, User.__table__, 'fingerprint')
+    _add_column(s, Channel.__table__, 'fingerprint')
+
+
+def _migration_message_revision(s: Session) -> None:
+    # 既存の行はNULLのままとし、書き込まれた行から記録する
+    _add_column(s, Message.__table__, 'revision')
+
+
+# スキーマのマイグレーション (説明, 関数) の一覧。
+# 既存のデータベースに対してschema_version以降のものを順に適用する。
+# 新しいテーブル/インデックス/列はモデルに定義を追加した上で、
+# 既存のデータベースを更新するための関数をここに追記する。
+MIGRATIONS: List[Tuple[str, Callable[[Session], None]]] = [
+    ('message_reactionsの作成', _migration_reactions),
+    ('messagesのインデックス作成', _migration_message_indexes),
+    ('collect_stateの作成', _migration_collect_state),
+    ('日毎の集計テーブルの作成', _migration_rollups),
+    ('messagesのrawを分割する列の追加', _migration_message_columns),
+    ('users/channelsのfingerprintの追加', _migration_fingerprints),
+    ('messagesのrevisionの追加', _migration_message_revision),
+]
+
+
+def _migrate(is_new: bool) -> None:
+    with transaction() as s:
+        if is_new:
+            # create_allで最新のスキーマが作成されている
+            set_meta(s, 'schema_version', str(len(MIGRATIONS)))
+            return
+        version = int(get_meta(s, 'schema_version') or 0)
+    for i, (description, migration) in enumerate(
+            MIGRATIONS[version:], version + 1):
+        print('データベースを更新中 v{} {} '.format(i, description), end='')
+        sys.stdout.flush()
+        with transaction() as s:
+            migration(s)
+            set_meta(s, 'schema_version', str(i))
+        print('[OK]')
+
+
+def _create_indexes(s: Session, table: Table) -> None:
+    conn = s.connection()
+    exists = set(i['name'] for i in inspect(conn).get_indexes(table.name))
+    for index in table.indexes:
+        if index.name not in exists:
+            index.create(conn)
+
+
+def _add_column(s: Session, table: Table, name: str) -> None:
+    """既存のテーブルにモデルで定義された列を追加します."""
+    conn = s.connection()
+    if name in set(c['name'] for c in inspect(conn).get_columns(table.name)):
+        return
+    column = table.columns[name]
+    conn.execute('ALTER TABLE {} ADD COLUMN {} {}'.format(
+        table.name, column.name, column.type.compile(conn.dialect)))
+
+
+def _explain_query_plan(conn: Any, cursor: Any, statement: str,
+                        parameters: Any, context: Any,
+                        executemany: bool) -> None:
+    if executemany or not statement.lstrip().upper().startswith('SELECT'):
+        return
+    prefix = 'EXPLAIN QUERY PLAN' if conn.dialect.name == 'sqlite' else (
+        'EXPLAIN')
+    c = conn.connection.cursor()
+    try:
+        c.execute(prefix + ' ' + statement, parameters)
+        plan = [row[-1] for row in c.fetchall()]
+    finally:
+        c.close()
+    print(prefix, statement, *plan, sep='\n', file=sys.stderr)
+    print(file=sys.stderr)
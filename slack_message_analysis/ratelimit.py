@@ -0,0 +1,408 @@
+from collections import deque
+import http.client
+import json
+import random
+import sys
+import threading
+import time
+from typing import Any, Deque, Dict, List, Optional
+from urllib.parse import urlencode
+
+from slack import WebClient
+from slack.errors import SlackApiError
+
+from .keepalive import pool
+from .metrics import metrics
+
+# https://api.slack.com/docs/rate-limits
+# Tierごとの1分あたりの呼び出し可能回数
+TIER_LIMITS = {1: 1, 2: 20, 3: 50, 4: 100}
+
+# 本ツールで利用するAPIメソッドのTier
+METHOD_TIERS = {
+    'conversations.list': 2,
+    'users.list': 2,
+    'conversations.history': 3,
+    'conversations.replies': 3,
+    'chat.postMessage': 4,
+    'files.upload': 2,
+}
+DEFAULT_TIER = 3
+
+# ページングするAPIメソッドの1ページあたりの取得件数(limit)
+#
+# https://api.slack.com/docs/pagination
+# "We recommend no more than 200 results at a time." とあるが、
+# 呼び出し回数の少ないTier 1/2のメソッドは上限(1000未満)まで取得し
+# 呼び出し回数を減らす
+TIER_PAGE_SIZES = {1: 999, 2: 999}
+DEFAULT_PAGE_SIZE = 200
+
+# 一時的な障害で失敗した場合に再送してよい(副作用の無い)APIメソッド
+IDEMPOTENT_METHODS = frozenset([
+    'conversations.list',
+    'users.list',
+    'conversations.history',
+    'conversations.replies',
+])
+
+# 一時的な障害を示すSlack APIのエラー
+TRANSIENT_ERRORS = frozenset([
+    'internal_error', 'fatal_error', 'request_timeout', 'service_unavailable'])
+
+# ratelimitedを受け取った場合に、見積もった呼び出し頻度に掛ける係数
+THROTTLE_MARGIN = 0.9
+# ratelimitedを受け取らない間、1分毎に戻す呼び出し頻度 (Tierの頻度に対する割合)
+RECOVERY_PER_MINUTE = 0.1
+# 呼び出し頻度の下限 (1秒あたり)
+MIN_RATE = 1 / 60
+
+
+class TokenBucket:
+    """スレッドセーフなトークンバケット.
+
+    ratelimitedを受け取った場合(throttle)はRetry-Afterの間払い出しを停止し、
+    直近1分間の払い出し回数とRetry-Afterから実際の上限を見積もって補充の頻度を
+    下げます。下げた頻度はratelimitedを受け取らない間、徐々にrateまで戻します。
+
+    Args:
+        rate: 1秒あたりに補充されるトークン数 (上限)
+        capacity: バケットの容量 (バースト可能な呼び出し回数)
+    """
+
+    def __init__(self, rate: float, capacity: float) -> None:
+        self.rate = rate
+        self.capacity = capacity
+        # acquireで待機した秒数の合計とratelimitedを受け取った回数
+        self.waited = 0.0
+        self.throttled = 0
+        self._tokens = capacity
+        self._updated = time.monotonic()
+        self._paused_until = 0.0
+        # 直近1分間にトークンを払い出した時刻
+        self._issued: Deque[float] = deque()
+        # ratelimitedにより見積もった補充の頻度と、そこから戻し始める時刻
+        self._learned_rate = rate
+        self._learned_at: Optional[float] = None
+        self._lock = threading.Lock()
+
+    def current_rate(self, now: Optional[float] = None) -> float:
+        """現在の補充の頻度(1秒あたり)を返します."""
+        if self._learned_at is None:
+            return self.rate
+        now = time.monotonic() if now is None else now
+        recovered = self.rate * RECOVERY_PER_MINUTE * max(
+            0.0, now - self._learned_at) / 60
+        return min(self.rate, self._learned_rate + recovered)
+
+    def acquire(self) -> float:
+        """トークンを1つ取得します. 取得できるまでブロックします.
+
+        Returns:
+            待機した秒数
+        """
+        waited = 0.0
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                if now >= self._paused_until:
+                    rate = self.current_rate(now)
+                    # 頻度を下げている間はバーストも同じ割合で抑える
+                    capacity = max(1.0, self.capacity * rate / self.rate)
+                    self._tokens = min(
+                        capacity,
+                        self._tokens + (now - self._updated) * rate)
+                    self._updated = now
+                    if self._tokens >= 1:
+                        self._tokens -= 1
+                        self._issued.append(now)
+                        self._expire(now)
+                        self.waited += waited
+                        return waited
+                    delay = (1 - self._tokens) / rate
+                else:
+                    delay = self._paused_until - now
+            time.sleep(delay)
+            waited += delay
+
+    def throttle(self, seconds: float, issued: float = 0.0) -> None:
+        """ratelimitedを受け取った場合に払い出しを停止し補充の頻度を下げます.
+
+        Args:
+            seconds: Retry-Afterの秒数
+            issued: ratelimitedとなった呼び出しのトークンを取得した時刻
+                (time.monotonic)。前回のthrottle以前に取得したトークンによる
+                呼び出しの場合は、既に頻度を下げているため停止のみ行います
+        """
+        with self._lock:
+            now = time.monotonic()
+            until = now + seconds
+            self.throttled += 1
+            if self._learned_at is None or issued >= self._learned_at:
+                # 直近1分間の呼び出しで上限に達し、さらにRetry-After秒の
+                # 待機が必要だったことから1秒あたりの上限を見積もる
+                self._expire(now)
+                observed = len(self._issued) / (60 + seconds)
+                self._learned_rate = max(min(self.rate, MIN_RATE), min(
+                    self.current_rate(now), observed) * THROTTLE_MARGIN)
+                self._learned_at = max(until, self._paused_until)
+            if until > self._paused_until:
+                self._paused_until = until
+                self._tokens = 0
+                self._updated = until
+
+    def _expire(self, now: float) -> None:
+        while self._issued and self._issued[0] <= now - 60:
+            self._issued.popleft()
+
+
+class RetryPolicy:
+    """一時的な障害(タイムアウト、接続の切断、5xx等)の再試行の方針.
+
+    n回目の再試行までの待機時間は ``min(cap, base * 2 ** (n - 1))`` 秒を上限とする
+    一様乱数(Full Jitter)とし、並列に失敗した呼び出しの再試行が集中しないようにします。
+
+    Args:
+        retries: 1回の呼び出しあたりの再試行の最大回数
+        base: 1回目の再試行までの待機時間の上限(秒)
+        cap: 待機時間の上限(秒)
+        ratelimited: 1回の呼び出しあたりのratelimitedによる再送の最大回数。
+            Retry-Afterの間待機してから再送します
+    """
+
+    def __init__(self, retries: int = 5, base: float = 1.0,
+                 cap: float = 60.0, ratelimited: int = 10) -> None:
+        self.retries = retries
+        self.base = base
+        self.cap = cap
+        self.ratelimited = ratelimited
+
+    def delay(self, attempt: int) -> float:
+        """attempt回目(1以上)の再試行までの待機時間を返します."""
+        return random.uniform(
+            0, min(self.cap, self.base * 2 ** (attempt - 1)))
+
+
+class RateLimiter:
+    """Slack APIメソッド毎のトークンバケットと再試行の方針を管理します.
+
+    複数のスレッドから共有することで並列実行時でもTierの制限内に
+    呼び出し頻度を抑えます。
+
+    Args:
+        tiers: メソッド毎のTier。省略時はMETHOD_TIERS
+        retry: 一時的な障害の再試行の方針。省略時は既定のRetryPolicy
+    """
+
+    def __init__(self, tiers: Optional[Dict[str, int]] = None,
+                 retry: Optional[RetryPolicy] = None) -> None:
+        self._tiers = dict(METHOD_TIERS if tiers is None else tiers)
+        self.retry = retry or RetryPolicy()
+        self._buckets: Dict[str, TokenBucket] = {}
+        # メソッド毎の再試行の回数と待機した秒数
+        self._retries: Dict[str, List[float]] = {}
+        self._lock = threading.Lock()
+
+    def bucket(self, method: str) -> TokenBucket:
+        with self._lock:
+            b = self._buckets.get(method)
+            if b is None:
+                per_minute = TIER_LIMITS[
+                    self._tiers.get(method, DEFAULT_TIER)]
+                b = TokenBucket(per_minute / 60, max(1, per_minute / 10))
+                self._buckets[method] = b
+            return b
+
+    def acquire(self, method: str) -> float:
+        return self.bucket(method).acquire()
+
+    def throttle(self, method: str, seconds: float,
+                 issued: float = 0.0) -> None:
+        self.bucket(method).throttle(seconds, issued)
+
+    def backoff(self, method: str, attempt: int) -> float:
+        """attempt回目の再試行まで待機し、待機した秒数を返します."""
+        delay = self.retry.delay(attempt)
+        with self._lock:
+            r = self._retries.setdefault(method, [0, 0.0])
+            r[0] += 1
+            r[1] += delay
+        time.sleep(delay)
+        return delay
+
+    def report(self) -> List[Dict[str, Any]]:
+        """メソッド毎の呼び出し頻度(1分あたり)の上限と現在値、待機時間等を返します.
+
+        待機時間は全スレッドの合計です。
+        """
+        with self._lock:
+            buckets = dict(self._buckets)
+            retries = {k: list(v) for k, v in self._retries.items()}
+        return [{
+            'method': method,
+            'per_minute': b.rate * 60,
+            'learned_per_minute': b.current_rate() * 60,
+            'waited': b.waited,
+            'ratelimited': b.throttled,
+            'retries': int(retries.get(method, [0])[0]),
+            'backoff': retries.get(method, [0, 0.0])[1],
+        } for method, b in sorted(buckets.items())]
+
+
+# limiterを指定しないRateLimitedWebClientの再送の方針
+_DEFAULT_RETRY = RetryPolicy()
+
+
+class RateLimitedWebClient(WebClient):
+    """API呼び出し前にRateLimiterからトークンを取得するWebClient.
+
+    ratelimitedエラーを受け取った場合はRetry-Afterの間、同じメソッドの
+    呼び出しを全スレッドで停止させてから再送します。limiterがNoneの場合は
+    呼び出し頻度を制限せず、Retry-Afterの間呼び出し元のスレッドで待機してから
+    再送します。再送の回数はRetryPolicyのratelimited(limiterがNoneの場合は
+    既定値)までです。
+    limiterを指定した場合、IDEMPOTENT_METHODSのメソッドは一時的な障害で
+    失敗してもlimiter.retryに従い待機して再送します。
+    いずれの場合もメソッド毎の呼び出し回数、所要時間、受信バイト数を
+    metricsに記録します。
+    ファイルのアップロードとプロキシの利用時以外はkeepalive.poolの
+    Keep-Alive接続で送信します。このためslackclientの非公開メソッド
+    (_perform_urllib_http_request)を上書きしており、pyproject.tomlで
+    slackclientのバージョンを固定しています。
+    """
+
+    def __init__(self, *, limiter: Optional[RateLimiter] = None,
+                 **kwargs: Any) -> None:
+        super().__init__(**kwargs)
+        self.limiter = limiter
+
+    def api_call(self, api_method: str, **kwargs: Any) -> Any:
+        attempt = 0
+        ratelimited = 0
+        policy = self.limiter.retry if self.limiter else _DEFAULT_RETRY
+        while True:
+            issued = 0.0
+            if self.limiter is not None:
+                waited = self.limiter.acquire(api_method)
+                issued = time.monotonic()
+                if waited:
+                    metrics.inc('ratelimit_wait_seconds', waited,
+                                method=api_method)
+            metrics.inc('api_calls_total', method=api_method)
+            started = time.perf_counter()
+            try:
+                resp = super().api_call(api_method, **kwargs)
+            except Exception as e:
+                if error_code(e) == 'ratelimited':
+                    metrics.inc('api_ratelimited_total', method=api_method)
+                    if ratelimited >= policy.ratelimited:
+                        raise
+                    ratelimited += 1
+                    delay = retry_after(e)
+                    if self.limiter is not None:
+                        self.limiter.throttle(api_method, delay, issued)
+                    else:
+                        metrics.inc('retry_sleep_seconds', delay,
+                                    method=api_method)
+                        time.sleep(delay)
+                    continue
+                if (self.limiter is None or
+                        api_method not in IDEMPOTENT_METHODS or
+                        not is_transient(e) or
+                        attempt >= self.limiter.retry.retries):
+                    raise
+                attempt += 1
+                metrics.inc('api_retries_total', method=api_method)
+                delay = self.limiter.backoff(api_method, attempt)
+                metrics.inc('retry_backoff_seconds', delay, method=api_method)
+                print('{}: {}: {} ({:.1f}秒待機して再試行 {}/{})'.format(
+                    api_method, type(e).__name__, _describe(e), delay,
+                    attempt, self.limiter.retry.retries), file=sys.stderr)
+                continue
+            finally:
+                metrics.inc('api_latency_seconds',
+                            time.perf_counter() - started, method=api_method)
+            metrics.inc('api_received_bytes_total', _response_size(resp),
+                        method=api_method)
+            return resp
+
+    def _perform_urllib_http_request(
+            self, *, url: str, args: Dict[str, Any]) -> Dict[str, Any]:
+        if (args['data'] or self.proxy is not None or
+                not url.lower().startswith('http')):
+            return super()._perform_urllib_http_request(url=url, args=args)
+        headers = args['headers']
+        body: Optional[bytes] = None
+        if args['json']:
+            body = json.dumps(args['json']).encode('utf8')
+            headers['Content-Type'] = 'application/json;charset=utf-8'
+        elif args['params']:
+            body = urlencode(args['params']).encode('utf8')
+            headers['Content-Type'] = 'application/x-www-form-urlencoded'
+        # 副作用のあるメソッド(chat.postMessage等)は再送しない
+        status, resp_headers, data = pool.request(
+            url, body, headers, self.timeout, self.ssl,
+            idempotent=url.rsplit('/', 1)[-1] in IDEMPOTENT_METHODS)
+        charset = resp_headers.get_content_charset() or 'utf-8'
+        return {'status': status, 'headers': resp_headers,
+                'body': data.decode(charset)}
+
+
+def _response_size(resp: Any) -> int:
+    length = (getattr(resp, 'headers', None) or {}).get('Content-Length')
+    if length:
+        return int(length)
+    # Content-Lengthが無い場合(chunked等)はデコード後のJSONから見積もる
+    return len(json.dumps(getattr(resp, 'data', {})).encode('utf8'))
+
+
+def page_size(method: str) -> int:
+    """ページングするAPIメソッドに指定する1ページあたりの取得件数を返します."""
+    return TIER_PAGE_SIZES.get(
+        METHOD_TIERS.get(method, DEFAULT_TIER), DEFAULT_PAGE_SIZE)
+
+
+def error_code(e: Exception) -> str:
+    """SlackApiErrorのerror ("ratelimited"等)を返します. それ以外の場合は空文字列."""
+    if not isinstance(e, SlackApiError):
+        return ''
+    # JSON以外の応答(5xxのHTML等)の場合、responseはslackclientの内部の辞書
+    data = getattr(e.response, 'data', None)
+    return (data.get('error') or '') if isinstance(data, dict) else ''
+
+
+def retry_after(e: SlackApiError) -> float:
+    """ratelimitedの応答のRetry-Afterの秒数を返します."""
+    headers = getattr(e.response, 'headers', None) or {}
+    # 応答のヘッダはHTTPMessageをdictに変換したもので、ヘッダ名の大文字小文字は
+    # サーバが送信したままとなる。Retry-Afterが無い場合は1秒とする
+    value = next((v for k, v in headers.items()
+                  if k.lower() == 'retry-after'), 1)
+    try:
+        return max(0.0, float(value))
+    except (TypeError, ValueError):
+        return 1.0
+
+
+def is_transient(e: Exception) -> bool:
+    """再送すれば成功し得る一時的な障害による例外かどうかを返します.
+
+    タイムアウト、接続の失敗や切断、HTTPの5xx応答、Slack APIの
+    TRANSIENT_ERRORSのエラーが該当します。
+    """
+    if isinstance(e, SlackApiError):
+        return _status(e) >= 500 or error_code(e) in TRANSIENT_ERRORS
+    return isinstance(e, (OSError, http.client.HTTPException))
+
+
+def _status(e: SlackApiError) -> int:
+    resp = e.response
+    if isinstance(resp, dict):
+        return int(resp.get('status') or 0)
+    return int(getattr(resp, 'status_code', 0) or 0)
+
+
+def _describe(e: Exception) -> str:
+    if isinstance(e, SlackApiError):
+        return 'HTTP {} {}'.format(_status(e), error_code(e)).rstrip()
+    return str(e)
@@ -0,0 +1,35 @@
+from argparse import Namespace
+from typing import Any, Dict, List
+
+from . import leaderboard, team
+from .common import get_date_range
+from .metrics import metrics
+from .models import init_db, read_transaction
+from .reports import aggregate, Aggregator
+
+# --reportsで指定できるレポートと、それを実装するモジュール
+REPORTS: Dict[str, Any] = {
+    'leaderboard': leaderboard,
+    'team': team,
+}
+
+
+def run(args: Namespace) -> None:
+    init_db(args.db, args.explain, args.sqlite_profile)
+    since, until = get_date_range(args)
+
+    # 各レポートの集計器をまとめて1回の走査で集計する
+    modules = [REPORTS[name] for name in args.reports]
+    aggregators = [m.aggregators(args) for m in modules]
+    everything: List[Aggregator] = [
+        a for aggs in aggregators for a in aggs.values()]
+    with read_transaction() as s:
+        with metrics.phase('aggregate'):
+            aggregate(s, since, until, everything, args.backend,
+                      args.from_export)
+        with metrics.phase('render'):
+            outputs = [m.render(s, aggs, since, until, args)
+                       for m, aggs in zip(modules, aggregators)]
+    with metrics.phase('post'):
+        for m, output in zip(modules, outputs):
+            m.publish(output, args)
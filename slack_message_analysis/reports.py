@@ -0,0 +1,261 @@
+from bisect import bisect_right
+from datetime import datetime, timedelta
+import heapq
+from typing import (
+    Any, Callable, Counter, Dict, Iterable, List, Optional, Sequence, Tuple,
+    TypeVar)
+
+from sqlalchemy import case, literal, select, union_all
+from sqlalchemy.orm import Session
+from sqlalchemy.sql import Alias
+
+from .rollup import (
+    user_post_counts, channel_post_counts, reaction_user_counts,
+    reaction_counts, DayKey)
+
+# 複数の集計(レポート)を1回の走査で行う集計エンジン。
+# 要求された集計の元データ(SOURCES)を (source, key, count) のタプル行として
+# UNION ALLした1つのクエリで読み出し、各集計器(Aggregator)に振り分ける。
+
+SOURCES: Dict[str, Callable[[datetime, datetime, Optional[DayKey]], Alias]] = {
+    'user_posts': user_post_counts,          # ユーザ毎の発言数
+    'channel_posts': channel_post_counts,    # チャンネル毎の発言数
+    'reaction_users': reaction_user_counts,  # ユーザ毎のリアクションした数
+    'reactions': reaction_counts,            # リアクション毎の利用数
+}
+
+# --bucketで指定できる時系列の区切り
+BUCKETS = ('day', 'week', 'month')
+
+
+class Aggregator:
+    """run_reports()から集計行を受け取る集計器の基底クラス.
+
+    Args:
+        source: 受け取る集計行の種類 (SOURCESのキー)
+    """
+
+    def __init__(self, source: str) -> None:
+        if source not in SOURCES:
+            raise ValueError('unknown source: {}'.format(source))
+        self.source = source
+
+    def feed(self, key: str, count: int) -> None:
+        raise NotImplementedError
+
+    def feed_array(self, keys: List[str], counts: Any) -> None:
+        """キーの一覧とキー毎の件数の配列(numpy.ndarray)をまとめて受け取ります.
+
+        集計の全量を1回で渡すバックエンド(vectorized)が利用します。
+        """
+        for key, count in zip(keys, counts.tolist()):
+            if count:
+                self.feed(key, count)
+
+
+class Totals(Aggregator):
+    """キー毎の件数をすべて保持します."""
+
+    def __init__(self, source: str) -> None:
+        super().__init__(source)
+        self.counts = Counter[str]()
+
+    def feed(self, key: str, count: int) -> None:
+        self.counts[key] += count
+
+
+class Ranking(Totals):
+    """件数の多い順に上位n件を返します. 同数の場合はキーの昇順です.
+
+    Args:
+        source: 受け取る集計行の種類 (SOURCESのキー)
+        n: 上位何件を返すか
+    """
+
+    def __init__(self, source: str, n: int) -> None:
+        super().__init__(source)
+        self.n = n
+
+    def feed_array(self, keys: List[str], counts: Any) -> None:
+        # 上位n件(同数を含む)の候補のみを保持する
+        from .vectorized import top_indices
+        for i in top_indices(keys, counts, self.n):
+            self.feed(keys[i], int(counts[i]))
+
+    def result(self) -> List[Tuple[str, int]]:
+        return heapq.nsmallest(
+            self.n, self.counts.items(), key=lambda x: (-x[1], x[0]))
+
+
+def run_reports(s: Session, since: datetime, until: datetime,
+                aggregators: Iterable[Aggregator]) -> None:
+    """期間内の集計行を1回のクエリで読み出し、全ての集計器に渡します.
+
+    Args:
+        s: transaction()で得たセッション
+        since: 集計開始日時
+        until: 集計終了日時
+        aggregators: 集計器。同じsourceの集計器が複数あっても1回だけ読み出す
+    """
+    by_source = group_by_source(aggregators)
+    if not by_source:
+        return
+    for source, key, count in s.execute(
+            _source_query(by_source, since, until)):
+        for a in by_source[source]:
+            a.feed(key, count)
+
+
+def run_series_reports(s: Session, ranges: Sequence[Tuple[datetime, datetime]],
+                       buckets: Sequence[Iterable[Aggregator]]) -> None:
+    """連続する期間毎の集計を1回のクエリで行います.
+
+    日毎の集計テーブルの日(端数の時間帯は区間の開始時刻)を期間の開始時刻に
+    変換するCASE式で(期間, キー)毎にGROUP BYし、期間毎の集計器に渡します。
+    日毎の期間では日のまま(日, キー)毎に集計します。
+
+    Args:
+        s: transaction()で得たセッション
+        ranges: bucket_ranges()で分割した期間
+        buckets: 期間毎の集計器
+    """
+    by_source = [group_by_source(b) for b in buckets]
+    sources = set().union(*by_source)
+    if not sources:
+        return
+    starts = [a.timestamp() for a, _ in ranges]
+    if all(b - a <= timedelta(days=1) for a, b in ranges):
+        # 日毎の期間では日がそのまま期間の開始時刻となる
+        def day_key(day: Any) -> Any:
+            return day
+    else:
+        def day_key(day: Any) -> Any:
+            return _bucket_start(day, starts)
+    for source, start, key, count in s.execute(_source_query(
+            sources, ranges[0][0], ranges[-1][1], day_key)):
+        for a in by_source[bisect_right(starts, start) - 1].get(source, []):
+            a.feed(key, count)
+
+
+def _bucket_start(day: Any, starts: Sequence[float]) -> Any:
+    # dayを含む期間の開始時刻を返すCASE式。行毎の比較回数を期間数の対数に
+    # 抑えるため、期間を二分した入れ子にする
+    if len(starts) == 1:
+        return literal(starts[0])
+    mid = len(starts) // 2
+    return case([(day < starts[mid], _bucket_start(day, starts[:mid]))],
+                else_=_bucket_start(day, starts[mid:]))
+
+
+def group_by_source(aggregators: Iterable[Aggregator]
+                    ) -> Dict[str, List[Aggregator]]:
+    """集計器をsource毎にまとめます."""
+    by_source: Dict[str, List[Aggregator]] = {}
+    for a in aggregators:
+        by_source.setdefault(a.source, []).append(a)
+    return by_source
+
+
+def _source_query(sources: Iterable[str], since: datetime, until: datetime,
+                  day_key: Optional[DayKey] = None) -> Any:
+    # (source, [day,] key, count) の集計行をUNION ALLしたクエリ
+    names = (['day'] if day_key else []) + ['key', 'count']
+    parts = []
+    for source in sorted(sources):
+        columns = list(SOURCES[source](since, until, day_key).c)
+        parts.append(select([literal(source).label('source')] + [
+            c.label(name) for c, name in zip(columns, names)]))
+    return union_all(*parts) if len(parts) > 1 else parts[0]
+
+
+def aggregate(s: Session, since: datetime, until: datetime,
+              aggregators: Iterable[Aggregator], backend: str = 'sql',
+              export_dir: Optional[str] = None) -> None:
+    """run_reports()と同じ集計を指定したバックエンドで行います.
+
+    Args:
+        s: transaction()で得たセッション
+        since: 集計開始日時
+        until: 集計終了日時
+        aggregators: 集計器
+        backend: ``sql`` (run_reports) または ``numpy`` (vectorized)
+        export_dir: 指定した場合はbackendに関わらずexportサブコマンドの
+            出力先ディレクトリのファイルから集計します
+    """
+    # pyarrow/numpyは利用する場合のみimportする
+    if export_dir:
+        from .columnar import run_reports as run_columnar_reports
+        run_columnar_reports(export_dir, since, until, aggregators)
+    elif backend == 'numpy':
+        from .vectorized import run_reports as run_vectorized_reports
+        run_vectorized_reports(s, since, until, aggregators)
+    else:
+        run_reports(s, since, until, aggregators)
+
+
+A = TypeVar('A', bound=Aggregator)
+
+
+def aggregate_series(s: Session, since: datetime, until: datetime,
+                     bucket: str, make: Callable[[], Dict[str, A]],
+                     backend: str = 'sql', export_dir: Optional[str] = None
+                     ) -> List[Tuple[datetime, datetime, Dict[str, A]]]:
+    """[since, until)をbucket毎に区切り、期間毎にaggregate()と同じ集計を行います.
+
+    期間毎に集計し直さず、全期間を1回だけ読み出して期間毎に振り分けます
+    (SQLは日毎の集計行の1回のクエリ、numpyは1回のFrameの読み込み、
+    export_dirはファイルの1回の読み込み)。
+
+    Args:
+        s: transaction()で得たセッション
+        since: 集計開始日時
+        until: 集計終了日時
+        bucket: 期間の区切り (BUCKETSの値)
+        make: 1つの期間の集計器を作成する関数 (leaderboard.aggregators等)
+        backend: aggregate()のbackend
+        export_dir: aggregate()のexport_dir
+    Returns:
+        期間毎の (開始日時, 終了日時, makeで作成し集計済みの集計器) の配列
+    """
+    ranges = bucket_ranges(since, until, bucket)
+    series = [(a, b, make()) for a, b in ranges]
+    if not series:
+        return series
+    buckets = [aggregators.values() for _, _, aggregators in series]
+    # pyarrow/numpyは利用する場合のみimportする
+    if export_dir:
+        from .columnar import run_series_reports as run_columnar_series
+        run_columnar_series(export_dir, ranges, buckets)
+    elif backend == 'numpy':
+        from .vectorized import run_series_reports as run_vectorized_series
+        run_vectorized_series(s, ranges, buckets)
+    else:
+        run_series_reports(s, ranges, buckets)
+    return series
+
+
+def bucket_ranges(since: datetime, until: datetime, bucket: str
+                  ) -> List[Tuple[datetime, datetime]]:
+    """[since, until)を日、週(月曜日から)、月毎の期間に分割します.
+
+    先頭と末尾の期間は区切りの途中から始まる(途中で終わる)ことがあります。
+
+    Args:
+        since: 開始日時
+        until: 終了日時
+        bucket: 期間の区切り (BUCKETSの値)
+    """
+    ranges = []
+    start = since
+    while start < until:
+        end = start.replace(hour=0, minute=0, second=0, microsecond=0)
+        if bucket == 'day':
+            end += timedelta(days=1)
+        elif bucket == 'week':
+            end += timedelta(days=7 - end.weekday())
+        else:
+            end = (end.replace(day=1) + timedelta(days=32)).replace(day=1)
+        end = min(end, until)
+        ranges.append((start, end))
+        start = end
+    return ranges
@@ -0,0 +1,126 @@
+from datetime import datetime, timedelta
+from typing import Any, Callable, List, Optional, Tuple
+
+from sqlalchemy import and_, func, literal, select, union_all
+from sqlalchemy.sql import Alias
+
+from .common import TARGET_SUBTYPES
+from .models import (
+    Message, Reaction, DailyUserCount, DailyChannelCount, DailyReactionCount)
+
+# 日毎の集計テーブルを利用した期間集計。
+# 集計期間のうち日単位で揃っている部分は日毎の集計テーブル
+# (daily_user_counts/daily_channel_counts/daily_reaction_counts)から、
+# 端数の時間帯のみmessages/message_reactionsから集計する。
+# 各関数は (キー, count) の2列を持つサブクエリを返す。day_keyを指定した場合は
+# (day, キー, count) の3列で、日の0時のUNIX時間(端数の時間帯は区間の開始時刻)を
+# day_keyで変換した値毎に集計する (reports.aggregate_series)。
+
+Range = Tuple[float, float]
+# 日の0時のUNIX時間の列から集計のキーとする式を返す関数
+DayKey = Callable[[Any], Any]
+
+
+def split_range(since: datetime, until: datetime
+                ) -> Tuple[Optional[Range], List[Range]]:
+    """[since, until)を日単位の区間と前後の端数の区間に分割します.
+
+    Returns:
+        日単位の区間 (無い場合はNone) と端数の区間の配列のタプル。
+        区間はUNIX時間の半開区間です。
+    """
+    first = since.replace(hour=0, minute=0, second=0, microsecond=0)
+    if first < since:
+        first += timedelta(days=1)
+    last = until.replace(hour=0, minute=0, second=0, microsecond=0)
+    if first >= last:
+        return None, [(since.timestamp(), until.timestamp())]
+    partial = [(a.timestamp(), b.timestamp())
+               for a, b in ((since, first), (last, until)) if a < b]
+    return (first.timestamp(), last.timestamp()), partial
+
+
+def user_post_counts(since: datetime, until: datetime,
+                     day_key: Optional[DayKey] = None) -> Alias:
+    """ユーザ毎の発言数 (user_id, count)."""
+    return _message_counts(DailyUserCount.user_id, Message.user_id,
+                           since, until, day_key)
+
+
+def channel_post_counts(since: datetime, until: datetime,
+                        day_key: Optional[DayKey] = None) -> Alias:
+    """チャンネル毎の発言数 (channel_id, count)."""
+    return _message_counts(DailyChannelCount.channel_id, Message.channel_id,
+                           since, until, day_key)
+
+
+def reaction_user_counts(since: datetime, until: datetime,
+                         day_key: Optional[DayKey] = None) -> Alias:
+    """ユーザ毎のリアクションした数 (user_id, count)."""
+    return _reaction_counts(DailyReactionCount.user_id, Reaction.user_id,
+                            since, until, day_key, users_only=True)
+
+
+def reaction_counts(since: datetime, until: datetime,
+                    day_key: Optional[DayKey] = None) -> Alias:
+    """リアクション毎の利用数 (reaction, count)."""
+    return _reaction_counts(DailyReactionCount.reaction, Reaction.reaction,
+                            since, until, day_key)
+
+
+def _message_counts(daily_key: Any, key: Any, since: datetime,
+                    until: datetime, day_key: Optional[DayKey] = None
+                    ) -> Alias:
+    t = daily_key.class_
+    whole, partial = split_range(since, until)
+    parts = []
+    if whole:
+        parts.append(select(_days(t.day, day_key) + [
+            daily_key, t.count,
+        ]).where(and_(t.day >= whole[0], t.day < whole[1])))
+    for a, b in partial:
+        parts.append(select(_days(literal(a), day_key) + [
+            key, func.count().label('count'),
+        ]).where(and_(
+            Message.timestamp >= a, Message.timestamp < b,
+            Message.subtype.in_(TARGET_SUBTYPES),
+        )).group_by(key))
+    return _sum(parts, day_key is not None)
+
+
+def _reaction_counts(daily_key: Any, key: Any, since: datetime,
+                     until: datetime, day_key: Optional[DayKey] = None,
+                     users_only: bool = False) -> Alias:
+    t, r = DailyReactionCount, Reaction
+    whole, partial = split_range(since, until)
+    parts = []
+    if whole:
+        cond = [t.day >= whole[0], t.day < whole[1]]
+        if users_only:
+            cond.append(t.user_id != '')
+        day = _days(t.day, day_key)
+        parts.append(select(day + [
+            daily_key, func.sum(t.count).label('count'),
+        ]).where(and_(*cond)).group_by(*day, daily_key))
+    for a, b in partial:
+        cond = [r.timestamp >= a, r.timestamp < b,
+                r.subtype.in_(TARGET_SUBTYPES)]
+        if users_only:
+            cond.append(r.user_id != '')
+        parts.append(select(_days(literal(a), day_key) + [
+            key, func.sum(r.count).label('count'),
+        ]).where(and_(*cond)).group_by(key))
+    return _sum(parts, day_key is not None)
+
+
+def _days(day: Any, day_key: Optional[DayKey]) -> List[Any]:
+    # day_keyを指定した場合に先頭に加えるday列
+    return [day_key(day).label('day')] if day_key else []
+
+
+def _sum(parts: List[Any], by_day: bool = False) -> Alias:
+    u = union_all(*parts).alias() if len(parts) > 1 else parts[0].alias()
+    keys = list(u.c)[:2 if by_day else 1]
+    return select([k.label(k.name) for k in keys] + [
+        func.sum(u.c.count).label('count'),
+    ]).group_by(*keys).alias()
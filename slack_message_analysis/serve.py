@@ -0,0 +1,276 @@
+from argparse import ArgumentParser, Namespace
+from datetime import datetime, timedelta
+import os
+import shlex
+import signal
+import sys
+import time
+import traceback
+from typing import Any, List, Optional, Set
+
+from .cli import build_parser, execute
+
+# serveサブコマンド。crontab形式のジョブ表に従い、1つのプロセスで各サブコマンドを
+# 順に実行する。データベースのエンジン(models.init_db)、Slack APIへの
+# Keep-Alive接続(keepalive.pool)、MeCabの辞書を読み込んだプロセス(wordcloud)は
+# プロセス内に残るため、2回目以降のジョブではこれらの初期化を省略できる。
+
+# 各フィールド(分 時 日 月 曜日)の値の範囲
+_FIELD_RANGES = [(0, 59), (0, 23), (1, 31), (1, 12), (0, 7)]
+
+_ALIASES = {
+    '@hourly': '0 * * * *',
+    '@daily': '0 0 * * *',
+    '@midnight': '0 0 * * *',
+    '@weekly': '0 0 * * 0',
+    '@monthly': '0 0 1 * *',
+    '@yearly': '0 0 1 1 *',
+    '@annually': '0 0 1 1 *',
+}
+
+# ジョブ表の更新を確認する間隔(秒)
+POLL_INTERVAL = 30.0
+
+
+class Schedule:
+    """crontab形式(分 時 日 月 曜日)の実行日時の指定.
+
+    各フィールドには ``*``, ``5``, ``1-5``, ``*/15``, ``1-10/2`` と
+    そのカンマ区切りを指定できます。曜日は0と7が日曜日です。
+    cronと同様に、日と曜日の両方を指定した場合はいずれかに一致する日が対象です。
+
+    Args:
+        spec: 5つのフィールドを空白で区切った文字列
+    Raises:
+        ValueError: 書式が正しくない場合
+    """
+
+    def __init__(self, spec: str) -> None:
+        fields = spec.split()
+        if len(fields) != 5:
+            raise ValueError('分 時 日 月 曜日 の5つのフィールドが必要です: {}'
+                             .format(spec))
+        (self.minutes, self.hours, self.days, self.months,
+         weekdays) = [_parse_field(f, lo, hi)
+                      for f, (lo, hi) in zip(fields, _FIELD_RANGES)]
+        self.weekdays = {d % 7 for d in weekdays}
+        self._any_day = fields[2].startswith('*')
+        self._any_weekday = fields[4].startswith('*')
+        self.spec = spec
+
+    def next_after(self, t: datetime) -> datetime:
+        """tより後の最初の実行日時(分単位)を返します."""
+        t = t.replace(second=0, microsecond=0) + timedelta(minutes=1)
+        # 2/30等の存在しない日付のみを指定した場合に止まらないよう上限を設ける
+        limit = t + timedelta(days=366 * 4)
+        while t < limit:
+            if not self._day_matches(t):
+                t = t.replace(hour=0, minute=0) + timedelta(days=1)
+            elif t.hour not in self.hours:
+                t = t.replace(minute=0) + timedelta(hours=1)
+            elif t.minute not in self.minutes:
+                t += timedelta(minutes=1)
+            else:
+                return t
+        raise ValueError('実行日時がありません: {}'.format(self.spec))
+
+    def _day_matches(self, t: datetime) -> bool:
+        if t.month not in self.months:
+            return False
+        day = t.day in self.days
+        # datetime.weekday()は月曜日が0、cronは日曜日が0
+        weekday = (t.weekday() + 1) % 7 in self.weekdays
+        if self._any_day or self._any_weekday:
+            return day and weekday
+        return day or weekday
+
+
+class Job:
+    """ジョブ表の1行.
+
+    Args:
+        line: ジョブ表の行番号
+        schedule: 実行日時の指定
+        argv: サブコマンド名と引数
+    """
+
+    def __init__(self, line: int, schedule: Schedule, argv: List[str]
+                 ) -> None:
+        self.line = line
+        self.schedule = schedule
+        self.argv = argv
+
+    def __str__(self) -> str:
+        # 引数には--token等が含まれ得るためサブコマンド名のみを表示する
+        return '{}行目 {}'.format(self.line, self.argv[0])
+
+
+def run(args: Namespace) -> None:
+    parser = build_parser()
+    try:
+        jobs = load_jobs(args.table, parser)
+    except (OSError, ValueError) as e:
+        print(e, file=sys.stderr)
+        sys.exit(1)
+
+    if args.once:
+        failed = [job for job in jobs if not _run_job(job, parser)]
+        if failed:
+            sys.exit(1)
+        return
+
+    signal.signal(signal.SIGTERM, _stop)
+    try:
+        _serve(args.table, jobs, parser)
+    except _Stop:
+        pass
+    print('[{}] 終了します'.format(_now()), file=sys.stderr)
+
+
+def load_jobs(path: str, parser: Optional[ArgumentParser] = None
+              ) -> List[Job]:
+    """ジョブ表を読み込みます.
+
+    各行は ``分 時 日 月 曜日 サブコマンド 引数...`` の形式です。
+    日時の指定の代わりに ``@daily`` 等も利用できます。
+    空行と ``#`` で始まる行は無視します。
+
+    Args:
+        path: ジョブ表のパス
+        parser: サブコマンドの引数の検証に利用するArgumentParser
+    Raises:
+        ValueError: 書式またはサブコマンドの引数が正しくない場合
+    """
+    parser = parser or build_parser()
+    jobs = []
+    with open(path, encoding='utf8') as f:
+        for n, line in enumerate(f, 1):
+            line = line.strip()
+            if not line or line.startswith('#'):
+                continue
+            try:
+                words = shlex.split(line)
+                if words[0].startswith('@'):
+                    if words[0] not in _ALIASES:
+                        raise ValueError('不明な指定です: {}'.format(words[0]))
+                    spec, argv = _ALIASES[words[0]], words[1:]
+                else:
+                    spec, argv = ' '.join(words[:5]), words[5:]
+                job = Job(n, Schedule(spec), argv)
+                job.schedule.next_after(datetime.now())
+                _parse_job_args(parser, argv)
+            except ValueError as e:
+                raise ValueError('{}:{}: {}'.format(path, n, e))
+            jobs.append(job)
+    return jobs
+
+
+def _serve(path: str, jobs: List[Job], parser: ArgumentParser) -> None:
+    mtime = _mtime(path)
+    next_runs = [job.schedule.next_after(datetime.now()) for job in jobs]
+    print('[{}] {}件のジョブを読み込みました'.format(_now(), len(jobs)),
+          file=sys.stderr, flush=True)
+    while True:
+        # ジョブ表が更新されていれば読み込み直す
+        m = _mtime(path)
+        if m != mtime:
+            mtime = m
+            try:
+                jobs = load_jobs(path, parser)
+            except (OSError, ValueError) as e:
+                print('[{}] ジョブ表を読み込めないため変更前のジョブを続けます: {}'
+                      .format(_now(), e), file=sys.stderr, flush=True)
+            else:
+                next_runs = [job.schedule.next_after(datetime.now())
+                             for job in jobs]
+                print('[{}] {}件のジョブを読み込み直しました'.format(
+                    _now(), len(jobs)), file=sys.stderr, flush=True)
+
+        # 同じ時刻のジョブはジョブ表の順に実行する。実行中に過ぎた時刻の
+        # ジョブは終了後に実行し、同じジョブの実行中に過ぎた回は省略する
+        now = datetime.now()
+        for i, job in enumerate(jobs):
+            if next_runs[i] <= now:
+                _run_job(job, parser)
+                next_runs[i] = job.schedule.next_after(datetime.now())
+
+        wait = POLL_INTERVAL
+        if next_runs:
+            wait = min(wait, (min(next_runs) - datetime.now()).total_seconds())
+        if wait > 0:
+            time.sleep(wait)
+
+
+def _run_job(job: Job, parser: ArgumentParser) -> bool:
+    print('[{}] 開始: {}'.format(_now(), job), file=sys.stderr, flush=True)
+    started = time.perf_counter()
+    ok = True
+    try:
+        # 実行毎に解釈し直し、前回の実行で変更された引数を引き継がない
+        execute(_parse_job_args(parser, job.argv))
+    except SystemExit as e:
+        # サブコマンドはエラー時にsys.exit(1)で終了するため失敗として扱う
+        ok = not e.code
+    except Exception:
+        traceback.print_exc()
+        ok = False
+    print('[{}] {}: {} ({:.1f}s)'.format(
+        _now(), '終了' if ok else '失敗', job,
+        time.perf_counter() - started), file=sys.stderr, flush=True)
+    return ok
+
+
+def _parse_job_args(parser: ArgumentParser, argv: List[str]) -> Namespace:
+    if not argv:
+        raise ValueError('サブコマンドが指定されていません')
+    if argv[0] == 'serve':
+        raise ValueError('serveはジョブに指定できません')
+    try:
+        args = parser.parse_args(argv)
+    except SystemExit:
+        # argparseがエラー内容を標準エラー出力に表示済み
+        raise ValueError('サブコマンドの引数が正しくありません: {}'.format(
+            argv[0]))
+    if not hasattr(args, 'func'):
+        raise ValueError('サブコマンドが指定されていません')
+    return args
+
+
+def _parse_field(field: str, lo: int, hi: int) -> Set[int]:
+    values: Set[int] = set()
+    for part in field.split(','):
+        spec, _, step = part.partition('/')
+        if spec == '*':
+            start, end = lo, hi
+        elif '-' in spec:
+            a, b = spec.split('-', 1)
+            start, end = int(a), int(b)
+        else:
+            start = end = int(spec)
+            if step:
+                end = hi
+        n = int(step) if step else 1
+        if not (lo <= start <= end <= hi) or n < 1:
+            raise ValueError('範囲外の値です: {}'.format(part))
+        values.update(range(start, end + 1, n))
+    return values
+
+
+def _mtime(path: str) -> Optional[float]:
+    try:
+        return os.stat(path).st_mtime
+    except OSError:
+        return None
+
+
+def _now() -> str:
+    return datetime.now().isoformat(sep=' ', timespec='seconds')
+
+
+class _Stop(BaseException):
+    # SIGTERMで終了する。ジョブ内のsys.exit()と区別するためSystemExitを使わない
+    pass
+
+
+def _stop(signum: int, frame: Any) -> None:
+    raise _Stop()
@@ -1,87 +1,74 @@
-from argparse import ArgumentParser, Namespace
+from argparse import Namespace
 import csv
 from dataclasses import dataclass
+from datetime import datetime, timedelta
 import json
+import sys
 import time
-from typing import Any, Callable, Dict
-
-from sqlalchemy import func
-
-from .common import (
-    setup_common_args, setup_token_args, setup_date_range_args, post,
-    setup_post_args, get_date_range, get_date_range_str, TARGET_SUBTYPES)
-from .models import init_db, transaction, User, Message
-
-
-def init_argparser(create_parser: Callable[..., ArgumentParser]) -> None:
-    parser = setup_common_args(setup_token_args(setup_date_range_args(
-        setup_post_args(create_parser(
-            'team', help='チームごとの発言数を集計します。\n'
-            '--sinceと--until または --day または --week または --month を指定する必要があります。'
-        )))))
-    parser.add_argument(
-        '--sort',
-        choices=['total', 'average'],
-        default='average',
-        help='順位の付け方を指定します。デフォルトは平均投稿数(合計投稿数÷所属メンバ数)です。')
-    parser.add_argument(
-        '--team',
-        default='team_master.csv',
-        help='メンバとチームを定義づけたCSVファイル')
-    parser.add_argument(
-        '--json', help='JSON形式で結果を出力します')
-    parser.set_defaults(func=run)
+from typing import Any, Dict, List, Optional, Tuple
+
+from sqlalchemy.orm import Session
+
+from .common import post, get_date_range, get_date_range_str, get_time_str
+from .directory import directory
+from .metrics import metrics
+from .models import init_db, read_transaction
+from .reports import aggregate, aggregate_series, Totals
 
 
 def run(args: Namespace) -> None:
-    init_db(args.db)
+    init_db(args.db, args.explain, args.sqlite_profile)
     since, until = get_date_range(args)
 
-    # CSVを読み込みユーザ(e-mail)とチーム名のマッピングを取得する
-    teams: Dict[str, TeamSummary] = {}
-    team_master = {}
-    with open(args.team, newline='', encoding='utf8') as csvfile:
-        reader = csv.reader(csvfile, delimiter=',', quotechar='"')
-        next(reader)  # skip header
-        for email, team_name, _, _ in reader:
-            team_master[email] = team_name
-            if team_name not in teams:
-                teams[team_name] = TeamSummary(name=team_name)
-            teams[team_name].total_members += 1
-
-    with transaction() as s:
-        sq = s.query(
-            Message.user_id.label('user_id'),
-            func.count(Message.user_id).label('count'),
-        ).filter(
-            Message.timestamp >= since.timestamp(),
-            Message.timestamp < until.timestamp(),
-            Message.subtype.in_(TARGET_SUBTYPES),
-        ).group_by(
-            Message.user_id,
-        ).subquery()
-        q = s.query(sq.c.count, User.email).join(User, sq.c.user_id == User.id)
-
-        for count, email in q:
-            t = teams.get(team_master.get(email))  # type: ignore
-            if t is None:
-                continue
-            t.total_posts += count
-            t.active_members += 1
-
-    if args.sort == 'total':
-        def _sort_key(x: 'TeamSummary') -> Any:
-            return x.total_posts
-    elif args.sort == 'average':
-        def _sort_key(x: 'TeamSummary') -> Any:
-            return x.total_posts / x.total_members
-    else:
-        assert(False)
-    leaderboard = sorted(teams.values(), key=_sort_key, reverse=True)
+    if args.bucket:
+        with read_transaction() as s:
+            with metrics.phase('aggregate'):
+                series = aggregate_series(
+                    s, since, until, args.bucket, lambda: aggregators(args),
+                    args.backend, args.from_export)
+            with metrics.phase('render'):
+                rows = render_series(s, series, args)
+        csv.writer(sys.stdout, lineterminator='\n').writerows(rows)
+        return
+
+    totals = aggregators(args)
+    with read_transaction() as s:
+        with metrics.phase('aggregate'):
+            aggregate(s, since, until, totals.values(), args.backend,
+                      args.from_export)
+        with metrics.phase('render'):
+            output = render(s, totals, since, until, args)
+    with metrics.phase('post'):
+        publish(output, args)
+
+
+def aggregators(args: Namespace) -> Dict[str, Totals]:
+    """チーム毎の集計に必要な集計器を返します."""
+    return {'user_posts': Totals('user_posts')}
+
+
+def render(s: Session, totals: Dict[str, Totals], since: datetime,
+           until: datetime, args: Namespace) -> List[str]:
+    """集計結果からチーム発言数ランキング(行の配列)を作成します.
+
+    --json指定時はJSON形式の結果もファイルに出力します。
+
+    Args:
+        s: transaction()で得たセッション (ユーザのe-mailの取得に利用)
+        totals: run_reports()で集計済みのaggregators()の戻り値
+        since: 集計開始日時
+        until: 集計終了日時
+        args: コマンドライン引数
+    Returns:
+        チーム発言数ランキング
+    """
+    team_master = _load_team_master(args.team)
+    counts = totals['user_posts'].counts
+    leaderboard = _rank(counts, directory.user_emails(s, counts),
+                        team_master, args.sort)
 
     output = ['{} のチーム発言数ランキング'.format(
         get_date_range_str(since, until, args))]
-    output_json = []
     for i, t in enumerate(leaderboard):
         inactive = ''
         if t.active_members < t.total_members:
@@ -92,28 +79,135 @@ def run(args: Namespace) -> None:
             '{} members{}'.format(
                 i + 1, t.name, t.total_posts, t.total_posts / t.total_members,
                 t.total_members, inactive))
-        output_json.append({
-            'leaderboard_rank': i + 1,
-            'name': t.name,
-            'rating': "{0:.1f}".format(t.total_posts / t.total_members),
-            'members': t.total_members,
-            'inactive_members': t.total_members - t.active_members,
-        })
-    print('\n'.join(output))
-    print()
 
     if args.json:
         if args.month or args.this_month:
             current_season: Any = '{:%Y-%m}'.format(since)
         else:
-            current_season = {'since': '{:%Y-%m-%d}'.format(since),
-                              'until': '{:%Y-%m-%d}'.format(until)}
+            current_season = _season(since, until)
         with open(args.json, 'w', encoding='utf8') as f:
             json.dump({
                 'current_season': current_season,
                 'last_updated': int(time.time() * 1000),
-                'teams': output_json}, f, ensure_ascii=False, indent=2)
+                'teams': _teams_json(leaderboard)},
+                f, ensure_ascii=False, indent=2)
 
+    return output
+
+
+def render_series(s: Session,
+                  series: List[Tuple[datetime, datetime, Dict[str, Totals]]],
+                  args: Namespace) -> List[List[Any]]:
+    """期間毎の集計結果からチーム発言数ランキングの時系列(CSVの行の配列)を作成します.
+
+    --json指定時は期間毎のJSON形式の結果(seasons)もファイルに出力します。
+
+    Args:
+        s: transaction()で得たセッション (ユーザのe-mailの取得に利用)
+        series: aggregate_series()で集計済みの期間毎のaggregators()の戻り値
+        args: コマンドライン引数
+    Returns:
+        見出しと、期間(開始/終了日時)、順位、チーム名、発言数、
+        メンバあたりの発言数、メンバ数、発言の無いメンバ数の行
+    """
+    team_master = _load_team_master(args.team)
+    emails = directory.user_emails(
+        s, set(k for _, _, totals in series
+               for k in totals['user_posts'].counts))
+
+    rows: List[List[Any]] = [
+        ['since', 'until', 'rank', 'team', 'posts', 'posts_per_member',
+         'members', 'inactive_members']]
+    seasons = []
+    for since, until, totals in series:
+        leaderboard = _rank(totals['user_posts'].counts, emails, team_master,
+                            args.sort)
+        for i, t in enumerate(leaderboard):
+            rows.append([
+                get_time_str(since), get_time_str(until), i + 1, t.name,
+                t.total_posts,
+                '{:.2f}'.format(t.total_posts / t.total_members),
+                t.total_members, t.total_members - t.active_members])
+        # 月全体を集計した期間は--monthと同じ形式とする
+        month = since.replace(day=1, hour=0, minute=0, second=0,
+                              microsecond=0)
+        if since == month and until == (
+                month + timedelta(days=32)).replace(day=1):
+            season: Any = '{:%Y-%m}'.format(since)
+        else:
+            season = _season(since, until)
+        seasons.append({'current_season': season,
+                        'teams': _teams_json(leaderboard)})
+
+    if args.json:
+        with open(args.json, 'w', encoding='utf8') as f:
+            json.dump({
+                'bucket': args.bucket,
+                'last_updated': int(time.time() * 1000),
+                'seasons': seasons}, f, ensure_ascii=False, indent=2)
+
+    return rows
+
+
+def _load_team_master(path: str) -> Dict[str, str]:
+    # CSVを読み込みユーザ(e-mail)とチーム名のマッピングを取得する
+    team_master = {}
+    with open(path, newline='', encoding='utf8') as csvfile:
+        reader = csv.reader(csvfile, delimiter=',', quotechar='"')
+        next(reader)  # skip header
+        for email, team_name, _, _ in reader:
+            team_master[email] = team_name
+    return team_master
+
+
+def _rank(counts: Dict[str, int], emails: Dict[str, Optional[str]],
+          team_master: Dict[str, str], sort: str) -> List['TeamSummary']:
+    # ユーザ毎の発言数をチーム毎に合計し、順位順に並べる
+    teams: Dict[str, TeamSummary] = {}
+    for team_name in team_master.values():
+        if team_name not in teams:
+            teams[team_name] = TeamSummary(name=team_name)
+        teams[team_name].total_members += 1
+
+    for user_id, count in counts.items():
+        if user_id not in emails:
+            continue
+        t = teams.get(team_master.get(emails[user_id]))  # type: ignore
+        if t is None:
+            continue
+        t.total_posts += count
+        t.active_members += 1
+
+    if sort == 'total':
+        def _sort_key(x: 'TeamSummary') -> Any:
+            return x.total_posts
+    elif sort == 'average':
+        def _sort_key(x: 'TeamSummary') -> Any:
+            return x.total_posts / x.total_members
+    else:
+        assert(False)
+    return sorted(teams.values(), key=_sort_key, reverse=True)
+
+
+def _teams_json(leaderboard: List['TeamSummary']) -> List[Dict[str, Any]]:
+    return [{
+        'leaderboard_rank': i + 1,
+        'name': t.name,
+        'rating': "{0:.1f}".format(t.total_posts / t.total_members),
+        'members': t.total_members,
+        'inactive_members': t.total_members - t.active_members,
+    } for i, t in enumerate(leaderboard)]
+
+
+def _season(since: datetime, until: datetime) -> Dict[str, str]:
+    return {'since': '{:%Y-%m-%d}'.format(since),
+            'until': '{:%Y-%m-%d}'.format(until)}
+
+
+def publish(output: List[str], args: Namespace) -> None:
+    """ランキングを表示し、--dry-run未指定時は投稿します."""
+    print('\n'.join(output))
+    print()
     if not args.dry_run and len(output) > 1:
         post(args, '\n'.join(output))
 
@@ -0,0 +1,264 @@
+from collections import defaultdict
+from datetime import datetime
+import sys
+from typing import (
+    Any, DefaultDict, Dict, Iterable, Iterator, List, Sequence, Tuple)
+
+from sqlalchemy import and_, select
+from sqlalchemy.orm import Session
+
+from .common import TARGET_SUBTYPES
+from .models import Message, Reaction
+from .reports import Aggregator, group_by_source
+
+try:
+    import numpy as np
+except ImportError:  # pragma: no cover
+    np = None
+
+# NumPyによる集計バックエンド (--backend numpy)。
+# 期間内のメッセージとリアクションを1回だけ読み込み、ユーザ/チャンネル/
+# リアクションのIDを整数のコードに辞書符号化した配列として保持する。
+# 各集計はコードのnp.bincountで求め、順位表はnp.argpartitionで上位を選ぶ。
+
+# 1回のfetchmanyで読み込む行数
+_FETCH_SIZE = 100000
+
+
+class Dictionary:
+    """文字列のIDと0から始まる整数のコードの対応表."""
+
+    def __init__(self) -> None:
+        # 未知のIDのみdefault_factoryで新しいコードを割り当てる。
+        # 既知のIDの変換はdictの参照のみでPythonの関数呼び出しを伴わない
+        self.index: DefaultDict[str, int] = defaultdict()
+        self.index.default_factory = self.index.__len__
+
+    @property
+    def keys(self) -> List[str]:
+        """コード順のIDの一覧."""
+        return list(self.index)
+
+    def encode(self, values: Sequence[str]) -> Any:
+        """IDの列をコードの配列に変換します. 未知のIDには新しいコードを割り当てます."""
+        return np.fromiter(map(self.index.__getitem__, values),
+                           dtype=np.int32, count=len(values))
+
+    def __len__(self) -> int:
+        return len(self.index)
+
+
+class Frame:
+    """期間内の集計対象のメッセージとリアクションを列毎の配列で保持します.
+
+    Attributes:
+        timestamps: メッセージのUNIX時間 (float64)
+        user_codes: メッセージの投稿者のコード (usersのコード)
+        channel_codes: メッセージのチャンネルのコード (channelsのコード)
+        reaction_timestamps: リアクションを付けたメッセージのUNIX時間
+        reaction_codes: リアクション毎の名前のコード (reactionsのコード)
+        reaction_user_codes: リアクション毎の利用者のコード (usersのコード)。
+            利用者が省略された分は空文字列のユーザのコードです
+        reaction_counts: リアクション毎の利用数
+    """
+
+    def __init__(self) -> None:
+        self.users = Dictionary()
+        self.channels = Dictionary()
+        self.reactions = Dictionary()
+        self.timestamps = np.empty(0, dtype=np.float64)
+        self.user_codes = np.empty(0, dtype=np.int32)
+        self.channel_codes = np.empty(0, dtype=np.int32)
+        self.reaction_timestamps = np.empty(0, dtype=np.float64)
+        self.reaction_codes = np.empty(0, dtype=np.int32)
+        self.reaction_user_codes = np.empty(0, dtype=np.int32)
+        self.reaction_counts = np.empty(0, dtype=np.int64)
+
+    @classmethod
+    def load(cls, s: Session, since: datetime, until: datetime,
+             messages: bool = True, reactions: bool = True) -> 'Frame':
+        """期間内のメッセージ/リアクションを読み込みます.
+
+        Args:
+            s: transaction()で得たセッション
+            since: 集計開始日時
+            until: 集計終了日時
+            messages: Falseの場合はメッセージを読み込まない
+            reactions: Falseの場合はリアクションを読み込まない
+        """
+        f = cls()
+        a, b = since.timestamp(), until.timestamp()
+        if messages:
+            m = Message
+            chunks = _fetch(s, select([
+                m.timestamp, m.user_id, m.channel_id]).where(and_(
+                    m.subtype.in_(TARGET_SUBTYPES),
+                    m.timestamp >= a, m.timestamp < b)))
+            parts = [(np.array(ts, dtype=np.float64), f.users.encode(users),
+                      f.channels.encode(channels))
+                     for ts, users, channels in chunks]
+            if parts:
+                f.timestamps, f.user_codes, f.channel_codes = (
+                    np.concatenate(c) for c in zip(*parts))
+        if reactions:
+            t = Reaction
+            chunks = _fetch(s, select([
+                t.timestamp, t.reaction, t.user_id, t.count]).where(and_(
+                    t.subtype.in_(TARGET_SUBTYPES),
+                    t.timestamp >= a, t.timestamp < b)))
+            rparts = [(np.array(ts, dtype=np.float64),
+                       f.reactions.encode(names), f.users.encode(users),
+                       np.array(counts, dtype=np.int64))
+                      for ts, names, users, counts in chunks]
+            if rparts:
+                (f.reaction_timestamps, f.reaction_codes,
+                 f.reaction_user_codes, f.reaction_counts) = (
+                    np.concatenate(c) for c in zip(*rparts))
+        return f
+
+    def split(self, starts: Sequence[float]) -> List['Frame']:
+        """行を期間毎に分けたFrameを返します. IDのコードは全てのFrameで共通です.
+
+        Args:
+            starts: 昇順の各期間の開始時刻 (UNIX時間)。最後の期間は
+                読み込んだ範囲の終わりまでです
+        """
+        frames = [Frame() for _ in starts]
+        for f in frames:
+            f.users, f.channels, f.reactions = (
+                self.users, self.channels, self.reactions)
+        for names in (('timestamps', 'user_codes', 'channel_codes'),
+                      ('reaction_timestamps', 'reaction_codes',
+                       'reaction_user_codes', 'reaction_counts')):
+            # 期間の番号で安定ソートし、期間毎の連続した範囲に切り出す
+            index = np.searchsorted(
+                starts, getattr(self, names[0]), side='right') - 1
+            order = np.argsort(index, kind='stable')
+            bounds = np.searchsorted(index[order], np.arange(len(starts) + 1))
+            for name in names:
+                values = getattr(self, name)[order]
+                for i, f in enumerate(frames):
+                    setattr(f, name, values[bounds[i]:bounds[i + 1]])
+        return frames
+
+    def counts(self, source: str) -> Tuple[List[str], Any]:
+        """集計行の種類(reports.SOURCESのキー)毎のキーと件数の配列を返します."""
+        if source == 'user_posts':
+            return self.users.keys, np.bincount(
+                self.user_codes, minlength=len(self.users))
+        if source == 'channel_posts':
+            return self.channels.keys, np.bincount(
+                self.channel_codes, minlength=len(self.channels))
+        if source == 'reactions':
+            return self.reactions.keys, _weighted_bincount(
+                self.reaction_codes, self.reaction_counts,
+                len(self.reactions))
+        if source == 'reaction_users':
+            # 利用者が省略された分(空文字列のユーザ)は除く
+            counts = _weighted_bincount(
+                self.reaction_user_codes, self.reaction_counts,
+                len(self.users))
+            omitted = self.users.index.get('')
+            if omitted is not None:
+                counts[omitted] = 0
+            return self.users.keys, counts
+        raise ValueError('unknown source: {}'.format(source))
+
+
+def require() -> None:
+    """numpyがインストールされていない場合は終了します."""
+    if np is None:
+        print('numpyが必要です (pip install numpy)', file=sys.stderr)
+        sys.exit(1)
+
+
+def run_reports(s: Session, since: datetime, until: datetime,
+                aggregators: Iterable[Aggregator]) -> None:
+    """reports.run_reports()と同じ集計をFrameの配列演算で行います.
+
+    Args:
+        s: transaction()で得たセッション
+        since: 集計開始日時
+        until: 集計終了日時
+        aggregators: 集計器
+    """
+    require()
+    by_source = group_by_source(aggregators)
+    if not by_source:
+        return
+    _feed(_load(s, since, until, by_source), by_source)
+
+
+def run_series_reports(s: Session, ranges: Sequence[Tuple[datetime, datetime]],
+                       buckets: Sequence[Iterable[Aggregator]]) -> None:
+    """reports.run_series_reports()と同じ集計を行います.
+
+    全期間のFrameを1回だけ読み込み、期間毎に分けて集計します。
+
+    Args:
+        s: transaction()で得たセッション
+        ranges: reports.bucket_ranges()で分割した期間
+        buckets: 期間毎の集計器
+    """
+    require()
+    by_source = [group_by_source(b) for b in buckets]
+    sources = set().union(*by_source)
+    if not sources:
+        return
+    f = _load(s, ranges[0][0], ranges[-1][1], sources)
+    for part, aggregators in zip(
+            f.split([a.timestamp() for a, _ in ranges]), by_source):
+        _feed(part, aggregators)
+
+
+def _load(s: Session, since: datetime, until: datetime,
+          sources: Iterable[str]) -> Frame:
+    # 集計に必要なテーブルのみを読み込む
+    sources = set(sources)
+    return Frame.load(
+        s, since, until,
+        messages=bool(sources & {'user_posts', 'channel_posts'}),
+        reactions=bool(sources & {'reactions', 'reaction_users'}))
+
+
+def _feed(f: Frame, by_source: Dict[str, List[Aggregator]]) -> None:
+    for source in sorted(by_source):
+        keys, counts = f.counts(source)
+        for a in by_source[source]:
+            a.feed_array(keys, counts)
+
+
+def top_indices(keys: List[str], counts: Any, n: int) -> List[int]:
+    """件数の多い順(同数の場合はキーの昇順)に上位n件のインデックスを返します.
+
+    np.argpartitionでn位の件数を求め、それ以上の件数(同数を含む)の候補のみを
+    並べ替えるため、同数の扱いはreports.Ranking.result()と一致します。
+    """
+    nonzero = np.flatnonzero(counts)
+    if n <= 0 or len(nonzero) == 0:
+        return []
+    values = counts[nonzero]
+    if len(values) > n:
+        threshold = values[np.argpartition(-values, n - 1)[n - 1]]
+        nonzero = nonzero[values >= threshold]
+    candidates = nonzero.tolist()
+    candidates.sort(key=lambda i: (-int(counts[i]), keys[i]))
+    return candidates[:n]
+
+
+def _fetch(s: Session, q: Any) -> Iterator[List[Tuple[Any, ...]]]:
+    # 行毎の型変換を省くためDBAPIのカーソルから直接読み込み、
+    # _FETCH_SIZE行毎に列のタプルの配列に転置して返す
+    cursor = s.execute(q).cursor
+    while True:
+        rows = cursor.fetchmany(_FETCH_SIZE)
+        if not rows:
+            return
+        yield list(zip(*rows))
+
+
+def _weighted_bincount(codes: Any, weights: Any, size: int) -> Any:
+    # weightsを指定したbincountはfloat64を返すが、合計が2**53未満であれば
+    # 誤差なく整数に戻せる
+    return np.bincount(codes, weights=weights, minlength=size).astype(
+        np.int64)
@@ -1,62 +1,65 @@
-from argparse import ArgumentParser, Namespace
-from typing import Callable
+from argparse import Namespace
+from concurrent.futures import (
+    FIRST_COMPLETED, ProcessPoolExecutor, Future, wait)
+from datetime import datetime
+import hashlib
+from itertools import islice
+import json
+import os
+import re
+import sys
+import time
+from typing import (
+    Counter, Dict, FrozenSet, Iterable, Iterator, List, Optional, Set, Tuple,
+    TypeVar)
 
 from fugashi import GenericTagger  # type: ignore
-from wordcloud import WordCloud  # type: ignore
+from sqlalchemy import and_, bindparam, func, tuple_
+from sqlalchemy.orm import Session
+from wordcloud import WordCloud, STOPWORDS  # type: ignore
 
 from .common import (
-    setup_common_args, setup_token_args, setup_date_range_args,
-    setup_post_args, get_date_range, get_date_range_str, create_slack_client,
-    TARGET_SUBTYPES)
-from .models import init_db, transaction, Message
+    get_date_range, get_date_range_str, shared_slack_client, TARGET_SUBTYPES)
+from .metrics import metrics
+from .models import (
+    get_meta, init_db, message_field, read_transaction, set_meta,
+    transaction, upsert, Message, TokenCacheEntry, TokenCount, BATCH_SIZE)
 
 
-def init_argparser(create_parser: Callable[..., ArgumentParser]) -> None:
-    parser = create_parser(
-        'wordcloud', help='MeCabで形態素解析した結果を用いてWordCloudを作成します\n'
-        '--sinceと--until または --day または --week または --month を指定する必要があります。'
-    )
-    parser.add_argument(
-        '-r', '--mecab-rcfile',
-        help='MeCabのリソースファイルパス',
-        required=True)
-    parser.add_argument(
-        '-d', '--mecab-dicdir',
-        help='MeCabの辞書パス',
-        required=True)
-    setup_common_args(setup_token_args(setup_date_range_args(setup_post_args(
-        parser))))
-    parser.add_argument(
-        '--font',
-        default='meiryo.ttc',
-        help='フォントファイル名 (デフォルト: meiryo.ttc)')
-    parser.add_argument(
-        '-u', '--mecab-userdic',
-        help='MeCabのユーザ辞書のパス')
-    parser.add_argument(
-        '--exclude',
-        default='助詞,助動詞',
-        help='除去する品詞をカンマ区切りで指定 (デフォルト: 助詞,助動詞)')
-    parser.add_argument(
-        '--width', type=int, default=1280,
-        help='画像の幅 (デフォルト: 1280px)')
-    parser.add_argument(
-        '--height', type=int, default=720,
-        help='画像の高さ (デフォルト: 720px)')
-    parser.add_argument(
-        '--background', default='white',
-        help='背景色。transparentを指定すると透明。(デフォルト: white)')
-    parser.add_argument(
-        '--max-words', default=200, type=int,
-        help='最大表示単語数 (デフォルト: 200)')
-    parser.add_argument(
-        '--stop-word-file',
-        help='ストップワードを記載したテキストファイルパス (改行や空白区切り)')
-    parser.set_defaults(func=run)
+# WordCloud.process_textと同様に2文字以上の単語のみを対象とする
+_WORD_PATTERN = re.compile(r"\w[\w']+")
+
+# 形態素解析を行うプロセスに1つずつ生成するTagger
+_tagger: Optional[GenericTagger] = None
+_tagger_args = ''
+_excludes: Set[str] = set()
+
+# 形態素解析を行うプロセスプールと作成時の(プロセス数, MeCabの引数, 除去する品詞)。
+# serveで繰り返し実行する場合に辞書を読み込み済みのプロセスを使い回すため、
+# 引数が変わるまで終了させない
+_pool: Optional[ProcessPoolExecutor] = None
+_pool_key: Optional[Tuple[int, str, FrozenSet[str]]] = None
+
+# 形態素解析の処理内容を変更した場合に上げ、既存のキャッシュを無効にする
+_CACHE_VERSION = 1
+
+# キャッシュを残す設定(config)の数。serveで--exclude等の異なるジョブを交互に
+# 実行しても再解析しないよう、最近利用したものから順に残す
+_KEEP_CONFIGS = 3
+# 最近利用した設定の一覧(JSON)を格納するmetaのキー
+_CONFIGS_META = 'token_cache_configs'
+
+# メッセージを識別するキー (timestamp, channel_id, user_id, subtype)
+MessageKey = Tuple[float, str, str, str]
+_KEY_COLUMNS = ('timestamp', 'channel_id', 'user_id', 'subtype')
+
+K = TypeVar('K')
+T = TypeVar('T')
+_TimedResult = Tuple[List[Tuple[K, Counter[str]]], float]
 
 
 def run(args: Namespace) -> None:
-    init_db(args.db)
+    init_db(args.db, args.explain, args.sqlite_profile)
     since, until = get_date_range(args)
 
     # MeCab初期化
@@ -64,7 +67,7 @@ def run(args: Namespace) -> None:
         args.mecab_rcfile, args.mecab_dicdir)
     if args.mecab_userdic:
         mecab_args += ' -u "{}"'.format(args.mecab_userdic)
-    tagger = GenericTagger(args=mecab_args)
+    excludes = set(args.exclude.split(','))
 
     # WordCloudのパラメータを解釈し設定
     wc_kwargs = dict(
@@ -75,39 +78,310 @@ def run(args: Namespace) -> None:
         wc_kwargs.update(dict(mode='RGBA', background_color=None))
     else:
         wc_kwargs['background_color'] = args.background
+    stopwords = set(STOPWORDS)
     if args.stop_word_file:
         with open(args.stop_word_file, 'r', encoding='utf8') as f:
-            wc_kwargs['stopwords'] = set(f.read().split())
+            stopwords = set(f.read().split())
 
-    text_list = []
-    excludes = set(args.exclude.split(','))
-    with transaction() as s:
-        q = s.query(Message).filter(
-            Message.timestamp >= since.timestamp(),
-            Message.timestamp < until.timestamp(),
-            Message.subtype.in_(TARGET_SUBTYPES),
-        )
-        for m in q:
-            if m.raw.get('bot_id'):
-                continue  # botの発言は集計対象外
-            text = m.raw.get('text', '')
-            if not text:
-                continue
-            tokens = [
-                w.surface for w in tagger(text)
-                if (w.feature_raw and
-                    w.feature_raw.split(',')[0] not in excludes)]
-            if tokens:
-                text_list.append(' '.join(tokens))
+    # 形態素解析済みの結果をキャッシュから読み出し、新規または編集された
+    # メッセージのみを並列に形態素解析した上で単語の出現頻度を集計する
+    config = tagger_config_hash(
+        args.mecab_rcfile, args.mecab_dicdir, args.mecab_userdic, excludes)
+    with metrics.phase('tokenize'):
+        _update_token_cache(since, until, config, mecab_args, excludes,
+                            args.jobs)
+    with metrics.phase('aggregate'), read_transaction() as s:
+        counts = _aggregate_tokens(s, since, until, config)
+    with metrics.phase('render'):
+        frequencies = {
+            w: c for w, c in counts.items() if w.lower() not in stopwords}
+        wordcloud = WordCloud(**wc_kwargs).generate_from_frequencies(
+            frequencies)
 
-    wordcloud = WordCloud(**wc_kwargs).generate(' '.join(text_list))
-
-    print('Save to "wordcloud.png"')
-    wordcloud.to_file('wordcloud.png')
+        print('Save to "wordcloud.png"')
+        wordcloud.to_file('wordcloud.png')
     if args.dry_run:
         return
 
     title = '{} の頻出単語'.format(get_date_range_str(since, until, args))
-    client = create_slack_client(args)
-    client.files_upload(
-        channels=args.post, file='wordcloud.png', title=title)
+    client = shared_slack_client(args)
+    with metrics.phase('post'):
+        client.files_upload(
+            channels=args.post, file='wordcloud.png', title=title)
+
+
+def tagger_config_hash(rcfile: str, dicdir: str, userdic: Optional[str],
+                       excludes: Set[str]) -> str:
+    """形態素解析の結果に影響する設定のハッシュを返します.
+
+    辞書やリソースファイルは更新を検知できるようパスに加えて
+    サイズと更新日時もハッシュに含めます。
+
+    Args:
+        rcfile: MeCabのリソースファイルパス
+        dicdir: MeCabの辞書パス
+        userdic: MeCabのユーザ辞書のパス
+        excludes: 除去する品詞
+    Returns:
+        token_cache/token_countsのconfig列に格納するハッシュ
+    """
+    files = [rcfile] + ([userdic] if userdic else [])
+    if os.path.isdir(dicdir):
+        files += sorted(e.path for e in os.scandir(dicdir) if e.is_file())
+    h = hashlib.sha1()
+    h.update(json.dumps([
+        _CACHE_VERSION, rcfile, dicdir, userdic, sorted(excludes),
+        [_file_stamp(f) for f in files],
+    ]).encode('utf8'))
+    return h.hexdigest()
+
+
+def tokenize(items: Iterable[Tuple[K, str]], mecab_args: str,
+             excludes: Set[str], jobs: int = 1, chunk_size: int = 1000
+             ) -> Iterator[Tuple[K, Counter[str]]]:
+    """テキストを形態素解析しテキスト毎の単語の出現回数を返します.
+
+    Args:
+        items: (キー, テキスト)のイテラブル。chunk_size件ずつ読み出します
+        mecab_args: GenericTaggerに渡すMeCabの引数
+        excludes: 除去する品詞
+        jobs: 形態素解析を行うプロセス数。1の場合は呼び出し元のプロセスで解析する。
+            2以上の場合のプロセスプールは同じ引数での次回の呼び出しでも利用します
+        chunk_size: 1プロセスに1度に渡すテキストの件数
+    Returns:
+        (キー, 単語毎の出現回数)のイテレータ。順序はitemsと一致しません
+    """
+    chunks = _chunks(items, chunk_size)
+    if jobs <= 1:
+        _init_worker(mecab_args, excludes)
+        for chunk in chunks:
+            yield from _record(_count_tokens_timed(chunk))
+        return
+
+    pool = _worker_pool(jobs, mecab_args, excludes)
+    # 処理待ちのテキストがメモリに溜まらないよう投入数を制限する
+    pending: Set['Future[_TimedResult[K]]'] = set()
+    try:
+        for chunk in chunks:
+            if len(pending) >= jobs * 2:
+                done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                for f in done:
+                    yield from _record(f.result())
+            pending.add(pool.submit(_count_tokens_timed, chunk))
+        for f in pending:
+            yield from _record(f.result())
+    except BaseException:
+        # 中断した場合は処理待ちのチャンクが残るためプールごと破棄する
+        # (shutdownのcancel_futuresはPython 3.9以降のため個別に取り消す)
+        for f in pending:
+            f.cancel()
+        _shutdown_pool()
+        raise
+
+
+def _worker_pool(jobs: int, mecab_args: str, excludes: Set[str]
+                 ) -> ProcessPoolExecutor:
+    global _pool, _pool_key
+    key = (jobs, mecab_args, frozenset(excludes))
+    if _pool is None or _pool_key != key:
+        _shutdown_pool()
+        _pool = ProcessPoolExecutor(
+            jobs, initializer=_init_worker, initargs=(mecab_args, excludes))
+        _pool_key = key
+    return _pool
+
+
+def _shutdown_pool() -> None:
+    global _pool, _pool_key
+    if _pool is not None:
+        _pool.shutdown()
+    _pool, _pool_key = None, None
+
+
+def _file_stamp(path: str) -> Tuple[str, int, int]:
+    try:
+        st = os.stat(path)
+    except OSError:
+        return path, -1, -1
+    return path, st.st_size, st.st_mtime_ns
+
+
+def _update_token_cache(since: datetime, until: datetime, config: str,
+                        mecab_args: str, excludes: Set[str], jobs: int
+                        ) -> None:
+    """期間内のメッセージのうちキャッシュに無いものを形態素解析して保存します.
+
+    形態素解析には時間がかかるため、メッセージは読み取り専用の接続から読み出し、
+    解析結果はBATCH_SIZE件毎に別のトランザクションでコミットします。
+    書き込みのロックを短く保ち、並行して実行するcollect/ingestを待たせません。
+    """
+    _retire_configs(config)
+    with read_transaction() as r:
+        _tokenize_misses(r, since, until, config, mecab_args, excludes, jobs)
+
+
+def _retire_configs(config: str) -> None:
+    # 辞書や--excludeを変更すると以前の設定の解析結果は参照されなくなるため、
+    # 最近利用した_KEEP_CONFIGS個以外の設定の解析結果を削除する
+    with transaction() as s:
+        value = get_meta(s, _CONFIGS_META)
+        recent: List[str] = json.loads(value) if value else []
+        if recent[:1] == [config]:
+            return
+        if value is None:
+            # 一覧を記録する前のキャッシュは現在の設定以外を全て削除する
+            stale = [c for c, in s.query(TokenCacheEntry.config).distinct()
+                     if c != config]
+            recent = [config]
+        else:
+            recent = [config] + [c for c in recent if c != config]
+            stale = recent[_KEEP_CONFIGS:]
+            recent = recent[:_KEEP_CONFIGS]
+        for t in (TokenCount, TokenCacheEntry):
+            s.query(t).filter(t.config.in_(stale)).delete(
+                synchronize_session=False)
+        set_meta(s, _CONFIGS_META, json.dumps(recent))
+
+
+def _tokenize_misses(r: Session, since: datetime, until: datetime,
+                     config: str, mecab_args: str, excludes: Set[str],
+                     jobs: int) -> None:
+    cached: Dict[MessageKey, str] = {
+        (ts, channel_id, user_id, subtype): text_hash
+        for ts, channel_id, user_id, subtype, text_hash in r.query(
+            TokenCacheEntry.timestamp, TokenCacheEntry.channel_id,
+            TokenCacheEntry.user_id, TokenCacheEntry.subtype,
+            TokenCacheEntry.text_hash,
+        ).filter(
+            TokenCacheEntry.config == config,
+            TokenCacheEntry.timestamp >= since.timestamp(),
+            TokenCacheEntry.timestamp < until.timestamp(),
+        )}
+    hashes: Dict[MessageKey, str] = {}
+
+    def _misses() -> Iterator[Tuple[MessageKey, str]]:
+        for key, text in _iter_texts(r, since, until):
+            text_hash = hashlib.sha1(text.encode('utf8')).hexdigest()
+            if cached.pop(key, None) != text_hash:
+                hashes[key] = text_hash
+                yield key, text
+
+    results = tokenize(_misses(), mecab_args, excludes, jobs)
+    n = 0
+    while True:
+        batch = list(islice(results, BATCH_SIZE))
+        if not batch:
+            break
+        with transaction() as s:
+            _delete_tokens(s, config, [key for key, _ in batch])
+            upsert(s, TokenCount.__table__, (
+                dict(zip(_KEY_COLUMNS, key), config=config, token=w, count=c)
+                for key, counts in batch for w, c in counts.items()))
+            upsert(s, TokenCacheEntry.__table__, (
+                dict(zip(_KEY_COLUMNS, key), config=config,
+                     text_hash=hashes.pop(key))
+                for key, _ in batch))
+        n += len(batch)
+    # 削除されたり集計対象外となったメッセージの解析結果を取り除く
+    with transaction() as s:
+        _delete_tokens(s, config, list(cached))
+    print('形態素解析 {}件 (キャッシュ済み以外)'.format(n), file=sys.stderr)
+
+
+def _delete_tokens(s: Session, config: str, keys: List[MessageKey]) -> None:
+    if not keys:
+        return
+    params = [dict(zip(_KEY_COLUMNS, key), config=config) for key in keys]
+    for t in (TokenCount.__table__, TokenCacheEntry.__table__):
+        s.execute(t.delete().where(and_(
+            t.c.config == bindparam('config'),
+            *[t.c[c] == bindparam(c) for c in _KEY_COLUMNS])), params)
+
+
+def _aggregate_tokens(s: Session, since: datetime, until: datetime,
+                      config: str) -> Counter[str]:
+    q = s.query(TokenCount.token, func.sum(TokenCount.count)).filter(
+        TokenCount.config == config,
+        TokenCount.timestamp >= since.timestamp(),
+        TokenCount.timestamp < until.timestamp(),
+        TokenCount.subtype.in_(TARGET_SUBTYPES),
+    ).group_by(TokenCount.token)
+    return Counter[str](dict(q))
+
+
+def _iter_texts(s: Session, since: datetime, until: datetime,
+                page_size: int = BATCH_SIZE
+                ) -> Iterator[Tuple[MessageKey, str]]:
+    # 解析結果のコミットはメッセージの読み出しの合間に行われる。読み取りの
+    # カーソルを開いたままにするとSHAREDロックが残り、ロールバックジャーナル
+    # (--sqlite-profile rollback)ではコミットできないため、主キー順の
+    # ページ毎に読み切ってから返す
+    key = (Message.timestamp, Message.channel_id, Message.user_id,
+           Message.subtype)
+    q = s.query(
+        *key, message_field('text'), message_field('bot_id'),
+    ).filter(
+        Message.timestamp >= since.timestamp(),
+        Message.timestamp < until.timestamp(),
+        Message.subtype.in_(TARGET_SUBTYPES),
+    ).order_by(*key)
+    last: Optional[MessageKey] = None
+    while True:
+        page = (q if last is None else q.filter(
+            tuple_(*key) > tuple_(*last))).limit(page_size).all()
+        if not page:
+            return
+        last = tuple(page[-1][:4])  # type: ignore
+        for ts, channel_id, user_id, subtype, text, bot_id in page:
+            if bot_id:
+                continue  # botの発言は集計対象外
+            if text:
+                yield (ts, channel_id, user_id, subtype), text
+
+
+def _chunks(items: Iterable[T], size: int) -> Iterator[List[T]]:
+    it = iter(items)
+    while True:
+        chunk = list(islice(it, size))
+        if not chunk:
+            return
+        yield chunk
+
+
+def _init_worker(mecab_args: str, excludes: Set[str]) -> None:
+    global _tagger, _tagger_args, _excludes
+    # 同じ引数で読み込み済みであれば辞書を読み込み直さない
+    if _tagger is None or _tagger_args != mecab_args:
+        _tagger = GenericTagger(args=mecab_args)
+        _tagger_args = mecab_args
+    _excludes = excludes
+
+
+def _count_tokens_timed(items: List[Tuple[K, str]]) -> '_TimedResult[K]':
+    # ワーカープロセスでの形態素解析の所要時間を呼び出し元で記録するため
+    # 結果と共に返す
+    started = time.perf_counter()
+    return _count_tokens(items), time.perf_counter() - started
+
+
+def _record(result: '_TimedResult[K]') -> List[Tuple[K, Counter[str]]]:
+    counts, elapsed = result
+    metrics.inc('mecab_seconds', elapsed)
+    metrics.inc('messages_tokenized_total', len(counts))
+    return counts
+
+
+def _count_tokens(items: List[Tuple[K, str]]) -> List[Tuple[K, Counter[str]]]:
+    assert _tagger is not None
+    results = []
+    for key, text in items:
+        counts = Counter[str]()
+        for w in _tagger(text):
+            if (not w.feature_raw or
+                    w.feature_raw.partition(',')[0] in _excludes):
+                continue
+            for word in _WORD_PATTERN.findall(w.surface):
+                if not word.isdigit():
+                    counts[word] += 1
+        results.append((key, counts))
+    return results
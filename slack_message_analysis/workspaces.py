@@ -0,0 +1,164 @@
+from argparse import Namespace
+from concurrent.futures import ProcessPoolExecutor, as_completed
+import configparser
+from contextlib import redirect_stderr, redirect_stdout
+from dataclasses import dataclass
+from importlib import import_module
+import io
+import multiprocessing
+import os
+import sys
+import time
+import traceback
+from typing import Any, Dict, List, Optional, Tuple
+
+from .metrics import metrics
+
+# 複数のワークスペースに対するサブコマンドの並列実行。
+# --workspacesで指定した設定ファイルのワークスペース毎に、トークン/API URL/
+# データベースを差し替えた引数でサブコマンドを別々のプロセスで同時に実行する。
+# models._session等のプロセス内の状態はワークスペース毎のプロセスに閉じるため、
+# 全体の所要時間は最も遅いワークスペースの所要時間程度になる。
+
+
+@dataclass
+class Workspace:
+    """設定ファイルに記載された1つのワークスペース."""
+    name: str
+    db: str
+    token: Optional[str] = None
+    base_url: Optional[str] = None
+    post: Optional[str] = None
+
+
+def load_workspaces(path: str) -> List[Workspace]:
+    """ワークスペースの設定ファイル(INI形式)を読み込みます.
+
+    セクション名をワークスペース名とし、db(必須)、token または token_env
+    (トークンを格納した環境変数名)、base_url、post(投稿先チャンネルID)を
+    指定します。``[DEFAULT]`` の値は全てのワークスペースに適用されます。
+
+    Raises:
+        ValueError: 設定ファイルを読み込めない、または値が正しくない場合
+    """
+    parser = configparser.ConfigParser(interpolation=None)
+    try:
+        with open(path, encoding='utf8') as f:
+            parser.read_file(f)
+    except (OSError, configparser.Error) as e:
+        raise ValueError('{}: {}'.format(path, e))
+    workspaces = []
+    for name in parser.sections():
+        section = parser[name]
+        if not section.get('db'):
+            raise ValueError('{}: [{}] dbが指定されていません'.format(path, name))
+        token = section.get('token')
+        if section.get('token_env'):
+            token = os.environ.get(section['token_env'])
+            if not token:
+                raise ValueError('{}: [{}] 環境変数{}が設定されていません'.format(
+                    path, name, section['token_env']))
+        workspaces.append(Workspace(
+            name=name, db=section['db'], token=token,
+            base_url=section.get('base_url'), post=section.get('post')))
+    if not workspaces:
+        raise ValueError('{}: ワークスペースが記載されていません'.format(path))
+    return workspaces
+
+
+def run(args: Namespace) -> None:
+    """args.workspacesの全てのワークスペースでサブコマンドを並列に実行します.
+
+    各ワークスペースの出力は終了した順にまとめて表示します。
+    leaderboardの--merge指定時は各ワークスペースの集計結果を合算した
+    順位表を作成し、コマンドラインの--token/--postで投稿します。
+    """
+    try:
+        workspaces = load_workspaces(args.workspaces)
+    except ValueError as e:
+        print(e, file=sys.stderr)
+        sys.exit(1)
+    merge = getattr(args, 'merge', False)
+    if merge and args.bucket:
+        print('--mergeと--bucketは同時に指定できません', file=sys.stderr)
+        sys.exit(1)
+
+    results: Dict[str, Any] = {}
+    failed = []
+    # serveから実行した場合に親プロセスのデータベース接続等を引き継がないよう
+    # forkではなくspawnで起動する
+    with ProcessPoolExecutor(
+            len(workspaces),
+            mp_context=multiprocessing.get_context('spawn')) as pool:
+        futures = {
+            pool.submit(_run, args.command, merge, _options(args, ws)): ws
+            for ws in workspaces}
+        for future in as_completed(futures):
+            ws = futures[future]
+            code, out, err, elapsed, result = future.result()
+            if out:
+                print('== {} =='.format(ws.name))
+                sys.stdout.write(out)
+                sys.stdout.flush()
+            sys.stderr.write(err)
+            print('[{}] {} ({:.1f}s)'.format(
+                ws.name, '失敗' if code else '終了', elapsed),
+                file=sys.stderr, flush=True)
+            metrics.inc('workspace_seconds', elapsed, workspace=ws.name)
+            if code:
+                failed.append(ws.name)
+            else:
+                results[ws.name] = result
+    if failed:
+        print('失敗したワークスペース: {}'.format(', '.join(
+            ws.name for ws in workspaces if ws.name in failed)),
+            file=sys.stderr)
+        sys.exit(1)
+
+    if merge:
+        from .leaderboard import publish_merged
+        publish_merged([(ws.name, results[ws.name]) for ws in workspaces],
+                       args)
+
+
+def _options(args: Namespace, ws: Workspace) -> Dict[str, Any]:
+    # argsのうちワークスペース毎の値を差し替えた子プロセスの引数。
+    # 計測結果の書き出し先は全ワークスペースで共通のため子プロセスでは無効にする
+    options = dict(vars(args))
+    del options['func']
+    options.update(db=ws.db, workspaces=None, metrics=None, profile=None,
+                   tracemalloc=0)
+    for key in ('token', 'base_url', 'post'):
+        if getattr(ws, key):
+            options[key] = getattr(ws, key)
+    # teamの--jsonはワークスペース名を付けたファイルに出力する (team.json -> team.ws.json)
+    if options.get('json'):
+        root, ext = os.path.splitext(options['json'])
+        options['json'] = '{}.{}{}'.format(root, ws.name, ext)
+    return options
+
+
+def _run(command: str, merge: bool, options: Dict[str, Any]
+         ) -> Tuple[int, str, str, float, Any]:
+    # 子プロセスでサブコマンドを実行し、終了コード、標準出力、標準エラー出力、
+    # 所要時間、--merge指定時は集計結果を返す
+    args = Namespace(**options)
+    out, err = io.StringIO(), io.StringIO()
+    code = 0
+    result = None
+    started = time.perf_counter()
+    with redirect_stdout(out), redirect_stderr(err):
+        try:
+            module = import_module('.' + command, __package__)
+            if merge:
+                result = module.partial_results(args)
+            else:
+                module.run(args)
+        except SystemExit as e:
+            # サブコマンドはエラー時にsys.exit(1)で終了する
+            code = 1 if e.code else 0
+        except Exception:
+            traceback.print_exc()
+            code = 1
+    return code, out.getvalue(), err.getvalue(), \
+        time.perf_counter() - started, result
@@ -0,0 +1,58 @@
+import os
+import time
+from typing import Iterator
+
+import pytest
+from sqlalchemy import create_engine
+
+from slack_message_analysis import models
+
+from .helpers import close_db
+
+# 日毎の集計(day_start)はローカルタイムで行うため、実行環境に依らず固定する
+os.environ['TZ'] = 'Asia/Tokyo'
+time.tzset()
+
+# PostgreSQLのテストはこの環境変数にデータベースのURLを指定した場合のみ実行する
+# (例: postgresql://postgres@127.0.0.1:5432/sma_test)。
+# テスト毎にmodelsの全テーブルを削除するため、テスト専用のデータベースを指定する
+DATABASE_URL_ENV = 'SMA_TEST_DATABASE_URL'
+
+
+def pytest_collection_modifyitems(config: pytest.Config,
+                                  items: list) -> None:
+    if os.environ.get(DATABASE_URL_ENV):
+        return
+    skip = pytest.mark.skip(
+        reason='{}が設定されていません'.format(DATABASE_URL_ENV))
+    for item in items:
+        if 'postgres' in item.keywords:
+            item.add_marker(skip)
+
+
+@pytest.fixture
+def sqlite_db(tmp_path) -> Iterator[str]:
+    """空のSQLiteのデータベースに接続し、そのパスを返します."""
+    path = str(tmp_path / 'slack.sqlite')
+    models.init_db(path)
+    yield path
+    close_db()
+
+
+@pytest.fixture
+def postgres_db() -> Iterator[str]:
+    """テーブルを全て削除したPostgreSQLのデータベースに接続し、URLを返します."""
+    url = os.environ[DATABASE_URL_ENV]
+    engine = create_engine(url)
+    models.Base.metadata.drop_all(engine)
+    engine.dispose()
+    models.init_db(url)
+    yield url
+    close_db()
+
+
+@pytest.fixture(params=[
+    'sqlite', pytest.param('postgres', marks=pytest.mark.postgres)])
+def db(request) -> str:
+    """SQLiteとPostgreSQLのそれぞれのデータベースで実行するためのfixture."""
+    return request.getfixturevalue('{}_db'.format(request.param))
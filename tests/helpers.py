@@ -0,0 +1,57 @@
+from typing import Any, Dict, List, Optional
+
+from slack_message_analysis import models
+from slack_message_analysis.models import (
+    backfill_reactions, backfill_rollups, transaction, DailyChannelCount,
+    DailyReactionCount, DailyUserCount, Reaction)
+
+# 2020-09-01 00:00 (Asia/Tokyo)
+DAY = 1598886000.0
+
+
+def message(ts: float, channel_id: str = 'C1', user_id: str = 'U1',
+            subtype: str = '', text: str = 'hello',
+            reactions: Optional[List[Dict[str, Any]]] = None
+            ) -> Dict[str, Any]:
+    raw: Dict[str, Any] = dict(
+        type='message', ts='{:.6f}'.format(ts), user=user_id, text=text)
+    if subtype:
+        raw['subtype'] = subtype
+    if reactions:
+        raw['reactions'] = reactions
+    return dict(timestamp=ts, channel_id=channel_id, user_id=user_id,
+                subtype=subtype, raw=raw)
+
+
+def reaction(name: str, users: List[str], count: Optional[int] = None
+             ) -> Dict[str, Any]:
+    return dict(name=name, users=users,
+                count=len(users) if count is None else count)
+
+
+def rollups() -> Dict[str, List[tuple]]:
+    with transaction() as s:
+        return {
+            t.__tablename__: sorted(
+                tuple(row) for row in s.query(*t.__table__.columns))
+            for t in (DailyUserCount, DailyChannelCount, DailyReactionCount,
+                      Reaction)}
+
+
+def assert_matches_backfill() -> None:
+    """増分で更新した集計が、全メッセージから作り直した集計と一致すること."""
+    incremental = rollups()
+    with transaction() as s:
+        backfill_reactions(s)
+        backfill_rollups(s)
+    assert incremental == rollups()
+
+
+def close_db() -> None:
+    """init_dbで作成した接続を閉じ、次のinit_dbで接続し直すようにします."""
+    if models._session is not None:
+        models._session.kw['bind'].dispose()  # type: ignore
+    if models._read_session is not None:
+        models._read_session.kw['bind'].dispose()  # type: ignore
+    models._session = models._read_session = None
+    models._db_path = models._profile = None
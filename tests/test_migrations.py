@@ -0,0 +1,102 @@
+import json
+import sqlite3
+
+from sqlalchemy import inspect
+
+from slack_message_analysis import models
+from slack_message_analysis.models import (
+    get_meta, init_db, message_payload, set_meta, transaction,
+    upsert_messages, CollectState, DailyUserCount, Message, Reaction,
+    MIGRATIONS)
+
+from .helpers import (
+    DAY, assert_matches_backfill, close_db, message, reaction)
+
+# マイグレーション導入前(v0)のスキーマ
+V0_SCHEMA = '''
+CREATE TABLE users (
+    id VARCHAR NOT NULL, name VARCHAR NOT NULL, email VARCHAR,
+    raw JSON NOT NULL, PRIMARY KEY (id) ON CONFLICT REPLACE);
+CREATE TABLE channels (
+    id VARCHAR NOT NULL, name VARCHAR NOT NULL, is_member BOOLEAN NOT NULL,
+    raw JSON NOT NULL, PRIMARY KEY (id) ON CONFLICT REPLACE);
+CREATE TABLE messages (
+    timestamp FLOAT NOT NULL, channel_id VARCHAR NOT NULL,
+    user_id VARCHAR NOT NULL, subtype VARCHAR NOT NULL, raw JSON,
+    PRIMARY KEY (timestamp, channel_id, user_id, subtype)
+    ON CONFLICT REPLACE);
+'''
+
+
+def create_v0_db(path: str) -> list:
+    rows = [
+        message(DAY + 10, reactions=[reaction('+1', ['U2', 'U3'])]),
+        message(DAY + 86400, channel_id='C2', user_id='U2',
+                reactions=[reaction('eyes', ['U1'], count=2)]),
+        message(DAY + 86500, subtype='channel_join'),
+    ]
+    conn = sqlite3.connect(path)
+    conn.executescript(V0_SCHEMA)
+    conn.executemany('INSERT INTO messages VALUES (?, ?, ?, ?, ?)', [
+        (m['timestamp'], m['channel_id'], m['user_id'], m['subtype'],
+         json.dumps(m['raw'])) for m in rows])
+    conn.commit()
+    conn.close()
+    return rows
+
+
+def test_migrate_from_v0(tmp_path, capsys) -> None:
+    path = str(tmp_path / 'slack.sqlite')
+    rows = create_v0_db(path)
+    try:
+        init_db(path)
+        # 全てのマイグレーションを順に適用する。v1(message_reactions)は
+        # v5で追加するmessagesの列を参照するため、v0からも適用できること
+        out = capsys.readouterr().out
+        assert [line.split()[1] for line in out.splitlines()] == [
+            'v{}'.format(i + 1) for i in range(len(MIGRATIONS))]
+        with transaction() as s:
+            assert get_meta(s, 'schema_version') == str(len(MIGRATIONS))
+            columns = set(c['name'] for c in inspect(
+                s.connection()).get_columns(Message.__tablename__))
+            assert columns >= set(models.HOT_FIELDS + ('cold', 'revision'))
+            # 既存の行はrawのまま読み出せる
+            assert [message_payload(m) for m in s.query(Message).order_by(
+                Message.timestamp)] == [m['raw'] for m in rows]
+            assert sorted(s.query(Reaction.reaction, Reaction.user_id,
+                                  Reaction.count)) == [
+                ('+1', 'U2', 1), ('+1', 'U3', 1), ('eyes', '', 1),
+                ('eyes', 'U1', 1)]
+            assert dict(s.query(CollectState.channel_id,
+                                CollectState.high_water)) == {
+                'C1': DAY + 86500, 'C2': DAY + 86400}
+        assert_matches_backfill()
+
+        # rawのまま残した行を置き換えても二重に数えない
+        with transaction() as s:
+            upsert_messages(s, [message(DAY + 10, text='edited')])
+        with transaction() as s:
+            assert s.query(Message).count() == len(rows)
+            assert sum(c for c, in s.query(DailyUserCount.count)) == 2
+        assert_matches_backfill()
+    finally:
+        close_db()
+
+
+def test_migrations_are_idempotent(tmp_path, capsys) -> None:
+    # 途中で中断したマイグレーションを再実行しても失敗しない
+    path = str(tmp_path / 'slack.sqlite')
+    try:
+        init_db(path)
+        with transaction() as s:
+            upsert_messages(s, [message(DAY + 10, reactions=[
+                reaction('+1', ['U2'])])])
+            set_meta(s, 'schema_version', '0')
+        close_db()
+        init_db(path)
+        with transaction() as s:
+            assert get_meta(s, 'schema_version') == str(len(MIGRATIONS))
+            assert s.query(Reaction).count() == 1
+        assert_matches_backfill()
+    finally:
+        close_db()
@@ -0,0 +1,149 @@
+import random
+import time
+from typing import Any, Dict, Iterator
+
+import pytest
+
+from slack_message_analysis import columnar
+from slack_message_analysis.models import (
+    day_start, delete_messages, message_payload, transaction,
+    upsert_messages, DailyChannelCount, DailyReactionCount, DailyUserCount,
+    Message, Reaction)
+
+from .helpers import DAY, assert_matches_backfill, message, reaction
+
+
+@pytest.fixture(params=['JST-9', 'UTC-9', '-9'])
+def posix_tz(request, monkeypatch) -> Iterator[str]:
+    """POSIX形式のタイムゾーンをTZに設定します."""
+    monkeypatch.setenv('TZ', request.param)
+    time.tzset()
+    yield request.param
+    monkeypatch.undo()
+    time.tzset()
+
+
+def test_upsert_messages(db: str) -> None:
+    with transaction() as s:
+        n = upsert_messages(s, [
+            message(DAY + 10, reactions=[
+                reaction('+1', ['U2', 'U3']),
+                reaction('eyes', ['U2'], count=3)]),
+            message(DAY + 20, user_id='U2', subtype='thread_broadcast'),
+            message(DAY + 30, subtype='channel_join'),
+        ])
+    assert n == 3
+    with transaction() as s:
+        stored = s.query(Message).order_by(Message.timestamp).all()
+        assert [m.raw for m in stored] == [None] * 3
+        assert message_payload(stored[0])['reactions'][0]['users'] == [
+            'U2', 'U3']
+        assert sorted(s.query(DailyUserCount.user_id, DailyUserCount.count)
+                      ) == [('U1', 1), ('U2', 1)]
+        assert s.query(DailyChannelCount.count).scalar() == 2
+        # usersを省略したリアクションはuser_id=''の行に省略数を格納する
+        assert sorted(s.query(Reaction.reaction, Reaction.user_id,
+                              Reaction.count)) == [
+            ('+1', 'U2', 1), ('+1', 'U3', 1), ('eyes', '', 2),
+            ('eyes', 'U2', 1)]
+    assert_matches_backfill()
+
+
+def test_upsert_messages_replaces_reactions(db: str) -> None:
+    with transaction() as s:
+        upsert_messages(s, [message(DAY + 10, reactions=[
+            reaction('+1', ['U2', 'U3'])])])
+    with transaction() as s:
+        upsert_messages(s, [message(DAY + 10, text='edited', reactions=[
+            reaction('+1', ['U3']), reaction('tada', ['U4'])])])
+    with transaction() as s:
+        assert s.query(Message).count() == 1
+        assert s.query(DailyUserCount.count).scalar() == 1
+        assert sorted(s.query(DailyReactionCount.reaction,
+                              DailyReactionCount.user_id,
+                              DailyReactionCount.count)) == [
+            ('+1', 'U3', 1), ('tada', 'U4', 1)]
+        assert message_payload(s.query(Message).one())['text'] == 'edited'
+    assert_matches_backfill()
+
+
+def test_delete_messages(db: str) -> None:
+    with transaction() as s:
+        upsert_messages(s, [
+            message(DAY + 10, reactions=[reaction('+1', ['U2'])]),
+            message(DAY + 20, user_id='U2'),
+        ])
+    with transaction() as s:
+        assert delete_messages(s, [
+            (DAY + 10, 'C1', 'U1', ''),
+            # 保存されていないメッセージは無視する
+            (DAY + 30, 'C1', 'U1', ''),
+        ]) == 2
+        assert delete_messages(s, []) == 0
+    with transaction() as s:
+        assert [m.user_id for m in s.query(Message)] == ['U2']
+        assert s.query(Reaction).count() == 0
+        # 0件になった集計の行は削除する
+        assert list(s.query(DailyUserCount.user_id, DailyUserCount.count)
+                    ) == [('U2', 1)]
+        assert s.query(DailyReactionCount).count() == 0
+    assert_matches_backfill()
+
+
+def test_rollups_match_backfill(db: str) -> None:
+    rand = random.Random(20200901)
+    subtypes = ['', '', '', 'thread_broadcast', 'channel_join']
+    stored: Dict[tuple, Dict[str, Any]] = {}
+    for _ in range(20):
+        with transaction() as s:
+            rows = []
+            for _ in range(rand.randrange(1, 30)):
+                if stored and rand.random() < 0.3:
+                    # 保存済みのメッセージの編集 (リアクションの増減)
+                    m = dict(stored[rand.choice(list(stored))])
+                else:
+                    # 日付の境界をまたぐよう数日に分散させる
+                    m = message(
+                        DAY + rand.randrange(3 * 86400),
+                        channel_id=rand.choice(['C1', 'C2']),
+                        user_id=rand.choice(['U1', 'U2', 'U3']),
+                        subtype=rand.choice(subtypes))
+                m['raw'] = dict(m['raw'], reactions=[
+                    reaction(name, rand.sample(['U1', 'U2', 'U3'],
+                                               rand.randrange(1, 3)),
+                             count=rand.randrange(3, 5))
+                    for name in rand.sample(['+1', 'eyes', 'tada'],
+                                            rand.randrange(0, 3))])
+                rows.append(m)
+            # 同じバッチ内の重複と、バッチをまたぐ更新の両方を含める
+            upsert_messages(s, rows, batch_size=7)
+            for m in rows:
+                stored[(m['timestamp'], m['channel_id'], m['user_id'],
+                        m['subtype'])] = m
+            deleted = rand.sample(list(stored), min(len(stored), 3))
+            delete_messages(s, deleted)
+            for key in deleted:
+                del stored[key]
+        assert_matches_backfill()
+    with transaction() as s:
+        assert s.query(Message).count() == len(stored)
+        assert sum(c for c, in s.query(DailyUserCount.count)) == sum(
+            1 for key in stored if key[3] in ('', 'thread_broadcast'))
+
+
+@pytest.mark.parametrize('ts', [DAY - 1, DAY, DAY + 86399])
+def test_day_start(ts: float) -> None:
+    assert day_start(ts) == (DAY - 86400 if ts < DAY else DAY)
+
+
+@pytest.mark.postgres
+def test_postgres_local_timezone(posix_tz: str, postgres_db: str) -> None:
+    # PostgreSQLでの月の判定がTZのローカルタイムと一致すること
+    timestamps = [DAY - 3600, DAY - 1, DAY, DAY + 32400]
+    with transaction() as s:
+        upsert_messages(s, [message(ts) for ts in timestamps])
+    with transaction() as s:
+        months = sorted(month for (month, _), _ in
+                        columnar._message_fingerprints(s))
+    assert months == sorted(set(
+        time.strftime('%Y-%m', time.localtime(ts)) for ts in timestamps))
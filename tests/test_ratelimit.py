@@ -0,0 +1,54 @@
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import threading
+from typing import Iterator, List
+
+import pytest
+
+from slack_message_analysis import ratelimit
+from slack_message_analysis.ratelimit import RateLimitedWebClient
+
+
+class _Handler(BaseHTTPRequestHandler):
+    # 残りの応答 (ステータス, 追加のヘッダ)
+    responses: List = []
+
+    def do_POST(self) -> None:
+        self.rfile.read(int(self.headers.get('Content-Length') or 0))
+        status, headers = self.responses.pop(0)
+        body = (b'{"ok": true}' if status == 200 else
+                b'{"ok": false, "error": "ratelimited"}')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json; charset=utf-8')
+        self.send_header('Content-Length', str(len(body)))
+        for k, v in headers:
+            self.send_header(k, v)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args) -> None:
+        pass
+
+
+@pytest.fixture
+def server() -> Iterator[str]:
+    httpd = ThreadingHTTPServer(('127.0.0.1', 0), _Handler)
+    threading.Thread(target=httpd.serve_forever, daemon=True).start()
+    yield 'http://127.0.0.1:{}/api/'.format(httpd.server_address[1])
+    httpd.shutdown()
+    httpd.server_close()
+
+
+@pytest.mark.parametrize('headers, expected', [
+    ([], 1.0),
+    ([('retry-after', '2')], 2.0),
+    ([('Retry-After', '0')], 0.0),
+])
+def test_ratelimited_retry_after(server, monkeypatch, headers,
+                                 expected) -> None:
+    slept: List[float] = []
+    monkeypatch.setattr(ratelimit.time, 'sleep', slept.append)
+    _Handler.responses = [(429, headers), (200, [])]
+    client = RateLimitedWebClient(token='xoxb-test', base_url=server)
+    assert client.chat_postMessage(channel='C1', text='hello')['ok']
+    assert slept == [expected]
+    assert not _Handler.responses
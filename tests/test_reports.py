@@ -0,0 +1,73 @@
+from datetime import datetime
+import random
+
+import pytest
+
+from slack_message_analysis.models import (
+    read_transaction, transaction, upsert_messages)
+from slack_message_analysis.reports import (
+    aggregate, aggregate_series, bucket_ranges, Ranking, Totals, SOURCES)
+
+from .helpers import DAY, message, reaction
+
+
+@pytest.fixture
+def messages(db: str) -> None:
+    # 2020-09-01から約2ヶ月分のメッセージ
+    rand = random.Random(24)
+    with transaction() as s:
+        upsert_messages(s, [
+            message(DAY + rand.randrange(62 * 86400),
+                    channel_id=rand.choice(['C1', 'C2', 'C3']),
+                    user_id=rand.choice(['U1', 'U2', 'U3', 'U4']),
+                    subtype=rand.choice(['', '', 'thread_broadcast',
+                                         'channel_join']),
+                    reactions=[reaction(
+                        name, rand.sample(['U1', 'U2', 'U3'], 2),
+                        count=rand.randrange(2, 4))
+                        for name in rand.sample(['+1', 'eyes', 'tada'],
+                                                rand.randrange(0, 3))])
+            for _ in range(2000)] + [
+            # 期間の境界ちょうどのメッセージ
+            message(DAY + i * 86400, reactions=[reaction('+1', ['U1'])])
+            for i in range(62)])
+
+
+def aggregators() -> dict:
+    return dict([(source, Totals(source)) for source in SOURCES] + [
+        ('top_' + source, Ranking(source, 2)) for source in SOURCES])
+
+
+@pytest.mark.parametrize('since,until,bucket', [
+    (datetime(2020, 9, 1), datetime(2020, 11, 1), 'day'),
+    (datetime(2020, 8, 25, 13, 30), datetime(2020, 10, 3, 7), 'week'),
+    (datetime(2020, 9, 3, 13, 30), datetime(2020, 10, 20, 7), 'month'),
+    (datetime(2020, 9, 3, 1), datetime(2020, 9, 3, 20), 'day'),
+])
+@pytest.mark.parametrize('backend', ['sql', 'numpy', 'export'])
+def test_aggregate_series(messages: None, tmp_path, since: datetime,
+                          until: datetime, bucket: str, backend: str
+                          ) -> None:
+    # 期間毎にaggregate()で集計した結果と一致すること
+    export_dir = None
+    if backend == 'numpy':
+        pytest.importorskip('numpy')
+    elif backend == 'export':
+        pytest.importorskip('pyarrow')
+        from slack_message_analysis.columnar import export
+        export_dir = str(tmp_path / 'export')
+        with transaction() as s:
+            export(s, export_dir)
+    with read_transaction() as s:
+        series = aggregate_series(
+            s, since, until, bucket, aggregators, backend, export_dir)
+        assert [(a, b) for a, b, _ in series] == bucket_ranges(
+            since, until, bucket)
+        for a, b, got in series:
+            expected = aggregators()
+            aggregate(s, a, b, expected.values(), backend, export_dir)
+            for name, e in expected.items():
+                if isinstance(e, Ranking):
+                    assert got[name].result() == e.result()
+                else:
+                    assert +got[name].counts == +e.counts
@@ -0,0 +1,57 @@
+from datetime import datetime
+import os
+from typing import Iterator
+
+import pytest
+
+from slack_message_analysis import models, wordcloud
+from slack_message_analysis.models import (
+    init_db, read_transaction, transaction, upsert_messages, BATCH_SIZE,
+    TokenCacheEntry)
+
+from .helpers import DAY, close_db, message
+
+ipadic = pytest.importorskip('ipadic')
+
+
+@pytest.fixture
+def rollback_db(tmp_path, monkeypatch) -> Iterator[str]:
+    """ロールバックジャーナル(--sqlite-profile rollback)のSQLite."""
+    # ロックを待ち続けず失敗させる
+    monkeypatch.setitem(models.ENGINE_PROFILES, 'rollback', dict(
+        models.ENGINE_PROFILES['rollback'], busy_timeout=1000))
+    path = str(tmp_path / 'slack.sqlite')
+    init_db(path, profile='rollback')
+    yield path
+    close_db()
+
+
+def test_update_token_cache(db: str, capsys) -> None:
+    _check_update_token_cache(capsys)
+
+
+def test_update_token_cache_rollback(rollback_db: str, capsys) -> None:
+    # 読み取り中のメッセージが残ったまま解析結果をコミットしないこと
+    # (rollbackではSHAREDロックを保持した接続がある間はコミットできない)
+    _check_update_token_cache(capsys)
+
+
+def _check_update_token_cache(capsys) -> None:
+    # BATCH_SIZEを超える件数を解析し、2回目は全てキャッシュから読み出す
+    n = BATCH_SIZE + 1000
+    with transaction() as s:
+        upsert_messages(s, (
+            message(DAY + i, user_id='U{}'.format(i % 10),
+                    text='東京で会議 {}'.format(i)) for i in range(n)))
+    since = datetime.fromtimestamp(DAY)
+    until = datetime.fromtimestamp(DAY + 86400)
+    config = wordcloud.tagger_config_hash(
+        os.path.join(ipadic.DICDIR, 'mecabrc'), ipadic.DICDIR, None, set())
+    for expected in (n, 0):
+        wordcloud._update_token_cache(
+            since, until, config, ipadic.MECAB_ARGS, set(), 1)
+        assert '形態素解析 {}件'.format(expected) in capsys.readouterr().err
+    with read_transaction() as r:
+        assert r.query(TokenCacheEntry).count() == n
+        assert wordcloud._aggregate_tokens(r, since, until, config)[
+            '会議'] == n